@@ -0,0 +1,359 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from Chatbot.services import retrieval
+from Chatbot.services.corpus_registry import corpus_registry
+from Chatbot.services.providers import LocalEmbeddings
+from Chatbot.services.query_embedding_cache import query_embedding_cache
+from Chatbot.services.rag_chatbot_service import RAGChatbotService
+from Chatbot.services.user_embedding_service import UserEmbeddingService, UserMatrixCache
+from Chatbot.services.user_vector_store import UserVectorStore
+from Chatbot.services.vector_store import write_vector_store
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Từ vựng sinh text chunk tổng hợp (đủ đa dạng để BM25 có ý nghĩa)
+_WORDS = (
+    "hàm số đạo hàm tích phân giới hạn phương trình bất đẳng thức vectơ ma trận xác suất thống kê "
+    "lực gia tốc vận tốc năng lượng động lượng điện trường từ trường dao động sóng ánh sáng nhiệt "
+    "nguyên tử phân tử liên kết phản ứng axit bazơ muối oxi hóa khử tế bào gen enzim quang hợp "
+    "thuật toán biến vòng lặp mảng đồ thị cây đệ quy sắp xếp tìm kiếm độ phức tạp dữ liệu"
+).split()
+
+
+class SyntheticEmbeddings(LocalEmbeddings):
+    """
+    Embedding của provider local (tất định, không gọi mạng), thêm các câu hỏi đăng ký sẵn
+    vector đích (gần một chunk trong corpus giả lập).
+    """
+
+    def __init__(self, dim: int, seed: int):
+        super().__init__(f"synthetic-{seed}", dim, latency_ms=0)
+        self._vectors = {}
+
+    def register(self, text: str, vector):
+        self._vectors[text] = np.asarray(vector, dtype=np.float32)
+
+    def embed_query(self, text: str):
+        vector = self._vectors.get(text)
+        return vector.tolist() if vector is not None else super().embed_query(text)
+
+    async def aembed_query(self, text: str):
+        return self.embed_query(text)
+
+    def embed_documents(self, texts):
+        return [self.embed_query(t) for t in texts]
+
+
+class Command(BaseCommand):
+    help = ('Offline benchmark of RAGChatbotService / UserEmbeddingService on seeded synthetic corpora: '
+            'load time, resident memory and p50/p99 per-query latency, written as a JSON report')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=str,
+            default='10000,100000,1000000',
+            help='Comma-separated corpus sizes (default: 10000,100000,1000000)',
+        )
+        parser.add_argument('--dim', type=int, default=1536, help='Embedding dimension (default: 1536)')
+        parser.add_argument('--queries', type=int, default=200, help='Queries per benchmark (default: 200)')
+        parser.add_argument('--top-k', type=int, default=5, help='top_k per query (default: 5)')
+        parser.add_argument(
+            '--dtype',
+            choices=['float32', 'float16'],
+            default='float32',
+            help='Storage dtype of the synthetic stores (default: float32)',
+        )
+        parser.add_argument('--ann', choices=['none', 'ivf'], default='none', help='ANN index to build (default: none)')
+        parser.add_argument(
+            '--quantization',
+            choices=['none', 'int8', 'pq', 'prefix'],
+            default='none',
+            help='Compressed codes to build (default: none)',
+        )
+        parser.add_argument(
+            '--retrieval-mode',
+            choices=['dense', 'hybrid', 'lexical'],
+            default='dense',
+            help='RAGChatbotService retrieval mode; hybrid/lexical also build a BM25 index (default: dense)',
+        )
+        parser.add_argument('--users', type=int, default=500, help='Users in the synthetic user store (default: 500)')
+        parser.add_argument('--user-chunks', type=int, default=40, help='Chunks per user (default: 40)')
+        parser.add_argument('--seed', type=int, default=42, help='Random seed (default: 42)')
+        parser.add_argument('--output', type=str, default=None, help='Write the JSON report to this file')
+        parser.add_argument(
+            '--compare',
+            type=str,
+            default=None,
+            help='Previous JSON report: print the change of each latency / load-time / memory figure',
+        )
+        parser.add_argument(
+            '--work-dir',
+            type=str,
+            default=None,
+            help='Directory for the synthetic stores (default: a temporary directory, removed afterwards)',
+        )
+
+    def handle(self, *args, **options):
+        # Không có request nào ra mạng: chỉ cần key để khởi tạo service
+        if not os.getenv("OPENAI_API_KEY"):
+            os.environ["OPENAI_API_KEY"] = "offline-benchmark"
+        sizes = [int(s) for s in options['sizes'].split(',') if s.strip()]
+        workdir = options['work_dir'] or tempfile.mkdtemp(prefix='rag_bench_')
+        os.makedirs(workdir, exist_ok=True)
+
+        report = {
+            'benchmark': 'rag',
+            'created_at': str(datetime.now()),
+            'environment': self._environment(),
+            'config': {k: options[k] for k in ('sizes', 'dim', 'queries', 'top_k', 'dtype', 'ann', 'quantization',
+                                               'retrieval_mode', 'users', 'user_chunks', 'seed')},
+            'global': [],
+            'user': None,
+        }
+        try:
+            for n in sizes:
+                result = self._bench_global(n, options, workdir)
+                report['global'].append(result)
+                self._print_result(f"global {n}", result)
+            if options['users'] > 0 and options['user_chunks'] > 0:
+                report['user'] = self._bench_user(options, workdir)
+                self._print_result(f"user {options['users']}x{options['user_chunks']}", report['user'])
+        finally:
+            if not options['work_dir']:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(f"\nĐã ghi báo cáo: {options['output']}")
+        if options['compare']:
+            self._compare(options['compare'], report)
+
+    # -------- Corpus chung --------
+    def _bench_global(self, n, options, workdir):
+        dim, top_k = options['dim'], options['top_k']
+        rng = np.random.RandomState(options['seed'] + n)
+        path = os.path.join(workdir, f'global_{n}')
+
+        started = time.perf_counter()
+        chunks = self._synthetic_chunks(n, rng)
+        raw = self._synthetic_vectors(os.path.join(workdir, f'raw_{n}.npy'), n, dim, rng)
+        lexical = 'bm25' if options['retrieval_mode'] != 'dense' else None
+        manifest = write_vector_store(
+            path, chunks, raw, dtype=options['dtype'],
+            ann=options['ann'] if options['ann'] != 'none' else None,
+            quantization=options['quantization'] if options['quantization'] != 'none' else None,
+            lexical=lexical,
+        )
+        write_seconds = time.perf_counter() - started
+        del raw
+        os.remove(os.path.join(workdir, f'raw_{n}.npy'))
+
+        # Câu hỏi: vector gần một chunk có sẵn, text lấy vài từ của chunk đó
+        embeddings = SyntheticEmbeddings(dim, options['seed'])
+        targets = rng.randint(n, size=options['queries'])
+        queries = []
+        store_vectors = np.load(os.path.join(path, manifest['files']['vectors']), mmap_mode='r')
+        for i, target in enumerate(targets):
+            words = chunks[target].split()[2:]
+            text = f"q{i} " + ' '.join(rng.choice(words, size=min(4, len(words)), replace=False))
+            noise = 0.05 * rng.standard_normal(dim).astype(np.float32)
+            embeddings.register(text, np.asarray(store_vectors[target], dtype=np.float32) + noise)
+            queries.append(text)
+        del chunks, store_vectors
+
+        service = RAGChatbotService(embeddings_file=path)
+        service.embeddings_model = embeddings
+        service.retrieval_mode = options['retrieval_mode']
+        query_embedding_cache.clear()
+
+        rss_before = self._rss_mb()
+        corpus_registry.invalidate(path)
+        started = time.perf_counter()
+        store = service.corpus
+        load_seconds = time.perf_counter() - started
+        rss_loaded = self._rss_mb()
+
+        first_ms = self._timed(lambda: service.get_global_context(queries[0], top_k))
+        latencies = [self._timed(lambda q=q: service.get_global_context(q, top_k)) for q in queries[1:] or queries]
+        result = {
+            'size': n,
+            'dim': dim,
+            'nbytes': store.nbytes if store is not None else 0,
+            'write_seconds': round(write_seconds, 3),
+            'load_seconds': round(load_seconds, 4),
+            'first_query_ms': round(first_ms, 3),
+            'latency_ms': self._summary(latencies),
+            'rss_mb': {'before': rss_before, 'loaded': rss_loaded, 'after_queries': self._rss_mb()},
+        }
+        corpus_registry.invalidate(path)
+        return result
+
+    # -------- Kho vector cá nhân --------
+    def _bench_user(self, options, workdir):
+        dim, top_k = options['dim'], options['top_k']
+        users, per_user = options['users'], options['user_chunks']
+        rng = np.random.RandomState(options['seed'])
+        store = UserVectorStore(os.path.join(workdir, 'user_index'))
+
+        started = time.perf_counter()
+        items = {}
+        user_vectors = {}
+        for u in range(users):
+            vectors = retrieval.normalize_rows(rng.standard_normal((per_user, dim)).astype(np.float32))
+            items[str(u)] = (self._synthetic_chunks(per_user, rng), vectors, {})
+            # Giữ một dòng mỗi user làm đích của câu hỏi
+            user_vectors[str(u)] = vectors[0]
+        store.replace_users(items)
+        write_seconds = time.perf_counter() - started
+        del items
+
+        embeddings = SyntheticEmbeddings(dim, options['seed'])
+        service = UserEmbeddingService(sim_threshold=0.0, cache=UserMatrixCache(), store=store)
+        service.embeddings_model = embeddings
+        query_embedding_cache.clear()
+
+        # Lượt lạnh: mỗi câu hỏi một user chưa có trong cache (đọc slice từ mmap);
+        # lượt nóng: hỏi lại đúng các user đó (slice đã trong cache LRU)
+        picked = [str(u) for u in rng.choice(users, size=min(options['queries'], users), replace=False)]
+        queries = []
+        for i, user_id in enumerate(picked):
+            text = f"user {user_id} q{i}"
+            embeddings.register(text, user_vectors[user_id] + 0.05 * rng.standard_normal(dim).astype(np.float32))
+            queries.append((user_id, text))
+
+        rss_before = self._rss_mb()
+        cold = [self._timed(lambda u=u, q=q: service.get_user_context(u, q, top_k)) for u, q in queries]
+        warm = [self._timed(lambda u=u, q=q: service.get_user_context(u, q, top_k)) for u, q in queries]
+        return {
+            'users': users,
+            'chunks_per_user': per_user,
+            'dim': dim,
+            'write_seconds': round(write_seconds, 3),
+            'cold_latency_ms': self._summary(cold),
+            'latency_ms': self._summary(warm),
+            'cache': service.cache.stats(),
+            'rss_mb': {'before': rss_before, 'after_queries': self._rss_mb()},
+        }
+
+    # -------- Dữ liệu tổng hợp --------
+    def _synthetic_chunks(self, n, rng, words_per_chunk=12):
+        words = np.asarray(_WORDS)
+        picks = words[rng.randint(len(words), size=(n, words_per_chunk))]
+        return [f"Chunk {i}: " + ' '.join(row) for i, row in enumerate(picks)]
+
+    def _synthetic_vectors(self, path, n, dim, rng, block=50000):
+        """Sinh vector theo từng khối vào file .npy (mmap) để corpus 1M chunk không cần nằm trọn trong RAM"""
+        matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n, dim))
+        for start in range(0, n, block):
+            rows = min(block, n - start)
+            matrix[start:start + rows] = rng.standard_normal((rows, dim)).astype(np.float32)
+        matrix.flush()
+        del matrix
+        return np.load(path, mmap_mode='r')
+
+    # -------- Đo đạc --------
+    @staticmethod
+    def _timed(fn):
+        started = time.perf_counter()
+        fn()
+        return (time.perf_counter() - started) * 1000
+
+    @staticmethod
+    def _summary(timings):
+        timings = np.asarray(timings, dtype=np.float64)
+        return {
+            'count': int(len(timings)),
+            'p50': round(float(np.percentile(timings, 50)), 3),
+            'p99': round(float(np.percentile(timings, 99)), 3),
+            'mean': round(float(timings.mean()), 3),
+            'max': round(float(timings.max()), 3),
+        }
+
+    @staticmethod
+    def _rss_mb():
+        """RSS hiện tại (MB) từ /proc, tách phần ẩn danh (heap) và phần file (mmap); nơi khác dùng đỉnh RSS"""
+        try:
+            values = {}
+            with open('/proc/self/status', 'r') as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in ('VmRSS', 'RssAnon', 'RssFile'):
+                        values[key] = round(int(value.split()[0]) / 1024, 1)
+            return {'total': values.get('VmRSS'), 'anon': values.get('RssAnon'), 'file': values.get('RssFile')}
+        except OSError:
+            if resource is None:
+                return None
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # macOS báo byte, Linux báo KB
+            return {'peak': round(peak / (1024 * 1024 if platform.system() == 'Darwin' else 1024), 1)}
+
+    @staticmethod
+    def _environment():
+        try:
+            commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                    timeout=5).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            commit = None
+        return {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'git_commit': commit,
+        }
+
+    # -------- In kết quả --------
+    def _print_result(self, label, result):
+        latency = result['latency_ms']
+        line = f"{label:>16} | p50 {latency['p50']:>8.2f} ms | p99 {latency['p99']:>8.2f} ms"
+        if 'load_seconds' in result:
+            line += (f" | load {result['load_seconds'] * 1000:>8.1f} ms | first {result['first_query_ms']:>8.2f} ms"
+                     f" | {result['nbytes'] / 1e6:>8.1f} MB")
+        else:
+            cold = result['cold_latency_ms']
+            line += f" | cold p50 {cold['p50']:>8.2f} ms | cold p99 {cold['p99']:>8.2f} ms"
+        self.stdout.write(line)
+
+    def _compare(self, path, report):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                previous = json.load(f)
+        except (OSError, ValueError) as e:
+            self.stderr.write(f"Không đọc được báo cáo {path}: {e}")
+            return
+        self.stdout.write(f"\nSo với {path} (commit {previous.get('environment', {}).get('git_commit')}):")
+        changed = sorted(k for k, v in report['config'].items()
+                         if k != 'sizes' and previous.get('config', {}).get(k) != v)
+        if changed:
+            self.stdout.write(f"  Cảnh báo: cấu hình khác báo cáo cũ ({', '.join(changed)}), số liệu không so sánh trực tiếp được")
+        old_global = {r['size']: r for r in previous.get('global', [])}
+        rows = [(f"global {r['size']}", old_global.get(r['size']), r) for r in report['global']]
+        if report['user'] is not None:
+            rows.append(('user', previous.get('user'), report['user']))
+        for label, old, new in rows:
+            if old is None:
+                self.stdout.write(f"{label:>16} | (không có trong báo cáo cũ)")
+                continue
+            parts = []
+            for name, getter in (('p50', lambda r: r['latency_ms']['p50']),
+                                 ('p99', lambda r: r['latency_ms']['p99']),
+                                 ('load', lambda r: r.get('load_seconds'))):
+                before, after = getter(old), getter(new)
+                if before and after is not None:
+                    parts.append(f"{name} {100 * (after - before) / before:+.1f}%")
+            self.stdout.write(f"{label:>16} | " + ' | '.join(parts))
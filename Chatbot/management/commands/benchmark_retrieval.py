@@ -0,0 +1,230 @@
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from sklearn.metrics.pairwise import cosine_similarity
+
+from Chatbot.services import retrieval
+from Chatbot.services.ann_index import IVFIndex
+from Chatbot.services.quantization import build_quantizer
+from Chatbot.services.vector_store import load_vector_store
+
+
+class Command(BaseCommand):
+    help = ('Micro-benchmark of the retrieval kernel (per-query latency, ANN / quantization / Matryoshka prefix '
+            'recall@k) on synthetic or real corpora')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            type=str,
+            default='10000,100000,1000000',
+            help='Comma-separated corpus sizes (default: 10000,100000,1000000)',
+        )
+        parser.add_argument('--dim', type=int, default=1536, help='Embedding dimension (default: 1536)')
+        parser.add_argument('--queries', type=int, default=50, help='Number of queries per size (default: 50)')
+        parser.add_argument('--top-k', type=int, default=5, help='top_k per query (default: 5)')
+        parser.add_argument(
+            '--dtype',
+            choices=['float32', 'float16'],
+            default='float32',
+            help='Storage dtype of the synthetic matrix (default: float32)',
+        )
+        parser.add_argument(
+            '--baseline-max',
+            type=int,
+            default=100000,
+            help='Skip the sklearn cosine_similarity + argsort baseline above this size (default: 100000)',
+        )
+        parser.add_argument(
+            '--clusters',
+            type=int,
+            default=0,
+            help='Generate clustered synthetic data with this many topics (default: 0 = isotropic noise)',
+        )
+        parser.add_argument(
+            '--decay',
+            type=float,
+            default=0.0,
+            help='Scale synthetic dimension d by (1 + d) ** -decay so information concentrates in the leading '
+                 'dimensions, like Matryoshka-trained embeddings (default: 0 = uniform)',
+        )
+        parser.add_argument(
+            '--index-dir',
+            type=str,
+            default=None,
+            help='Benchmark a real vector store instead of synthetic corpora (queries = perturbed chunks)',
+        )
+        parser.add_argument('--ann', action='store_true', help='Also report IVF recall@k vs latency')
+        parser.add_argument('--n-lists', type=int, default=None, help='IVF lists (default: sqrt(chunks))')
+        parser.add_argument(
+            '--nprobe',
+            type=str,
+            default='1,4,8,16,32',
+            help='Comma-separated IVF n_probe values to sweep (default: 1,4,8,16,32)',
+        )
+        parser.add_argument(
+            '--quant',
+            type=str,
+            default='',
+            help='Comma-separated quantizations to report (int8,pq): memory per vector and recall@k',
+        )
+        parser.add_argument(
+            '--rescore',
+            type=str,
+            default='50,200,1000',
+            help='Comma-separated numbers of candidates rescored with full vectors (default: 50,200,1000)',
+        )
+        parser.add_argument('--pq-subspaces', type=int, default=None, help='PQ bytes per vector (default: dim/16)')
+        parser.add_argument(
+            '--prefix-dims',
+            type=str,
+            default='',
+            help='Comma-separated Matryoshka prefix lengths to report (e.g. 64,128,256,512): '
+                 'latency and recall@k of prefix scoring + full-vector rescoring',
+        )
+        parser.add_argument('--seed', type=int, default=42, help='Random seed (default: 42)')
+
+    def handle(self, *args, **options):
+        top_k = options['top_k']
+        rng = np.random.RandomState(options['seed'])
+
+        workdir = tempfile.mkdtemp(prefix='rag_bench_')
+        try:
+            for label, matrix, queries in self._corpora(options, rng, workdir):
+                n = len(matrix)
+                self.stdout.write(f"\n== {label}: {n} chunks, dim={matrix.shape[1]}, top_k={top_k}, "
+                                  f"dtype={matrix.dtype}, queries={len(queries)}")
+
+                exact = [retrieval.search(matrix, q, top_k)[0] for q in queries]
+                kernel_ms = self._time_queries(queries, lambda q: retrieval.search(matrix, q, top_k))
+                self.stdout.write(f"{'method':>22} | {'p50 ms':>8} | {'p99 ms':>8} | {'recall@k':>8}")
+                self._row('exact kernel', kernel_ms, 1.0)
+                self._row('search_many', self._time_batch(queries, lambda qs: retrieval.search_many(matrix, qs, top_k)), 1.0)
+
+                if n <= options['baseline_max']:
+                    baseline_ms = self._time_queries(queries, lambda q: self._baseline(matrix, q, top_k))
+                    self._row('sklearn + argsort', baseline_ms, 1.0)
+
+                if options['ann']:
+                    self._report_ann(matrix, queries, exact, top_k, options)
+
+                for kind in [q.strip() for q in options['quant'].split(',') if q.strip()]:
+                    self._report_quant(kind, matrix, queries, exact, top_k, options)
+                for dims in [int(d) for d in options['prefix_dims'].split(',') if d.strip()]:
+                    self._report_quant('prefix', matrix, queries, exact, top_k, options, {'dims': dims},
+                                       label=f'prefix{dims}')
+                del matrix
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def _corpora(self, options, rng, workdir):
+        if options['index_dir']:
+            store = load_vector_store(options['index_dir'])
+            if store is None or len(store) == 0:
+                self.stderr.write(f"Không mở được kho vector {options['index_dir']}")
+                return
+            rows = rng.choice(len(store), min(options['queries'], len(store)), replace=False)
+            base = np.asarray(store.vectors[np.sort(rows)], dtype=np.float32)
+            queries = base + 0.05 * rng.standard_normal(base.shape).astype(np.float32)
+            yield options['index_dir'], store.vectors, queries
+            return
+
+        dim = options['dim']
+        sizes = [int(s) for s in options['sizes'].split(',') if s.strip()]
+        centers = None
+        if options['clusters']:
+            centers = retrieval.normalize_rows(rng.standard_normal((options['clusters'], dim)))
+        self._scale = (1.0 + np.arange(dim, dtype=np.float32)) ** -options['decay'] if options['decay'] else None
+        label = 'synthetic' + (f" ({options['clusters']} clusters)" if centers is not None else '')
+        if options['decay']:
+            label += f" decay={options['decay']}"
+        for n in sizes:
+            matrix = self._synthetic_matrix(os.path.join(workdir, f'{n}.npy'), n, dim,
+                                            options['dtype'], rng, centers)
+            queries = self._synthetic_rows(options['queries'], dim, rng, centers)
+            yield label, matrix, queries
+
+    def _synthetic_rows(self, rows, dim, rng, centers):
+        rows = self._synthetic_unscaled(rows, dim, rng, centers)
+        return rows * self._scale if self._scale is not None else rows
+
+    def _synthetic_unscaled(self, rows, dim, rng, centers):
+        noise = rng.standard_normal((rows, dim)).astype(np.float32)
+        if centers is None:
+            return noise
+        # Điểm quanh tâm cụm, mô phỏng corpus có chủ đề (Toán, Lý, Hóa...)
+        return centers[rng.randint(len(centers), size=rows)] + noise * (0.6 / np.sqrt(dim))
+
+    def _synthetic_matrix(self, path, n, dim, dtype, rng, centers=None, block=50000):
+        """Sinh ma trận chuẩn hóa theo từng khối vào file .npy rồi mở bằng mmap như production"""
+        matrix = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(n, dim))
+        for start in range(0, n, block):
+            rows = min(block, n - start)
+            matrix[start:start + rows] = retrieval.normalize_rows(self._synthetic_rows(rows, dim, rng, centers))
+        matrix.flush()
+        del matrix
+        return np.load(path, mmap_mode='r')
+
+    def _report_ann(self, matrix, queries, exact, top_k, options):
+        started = time.perf_counter()
+        index = IVFIndex.build(matrix, n_lists=options['n_lists'])
+        self.stdout.write(f"{'':>22}   IVF build: {index.n_lists} lists, {time.perf_counter() - started:.1f} s")
+        for n_probe in [int(p) for p in options['nprobe'].split(',') if p.strip()]:
+            found = [index.search(matrix, q, top_k, n_probe)[0] for q in queries]
+            recall = np.mean([
+                len(set(f.tolist()) & set(e.tolist())) / max(len(e), 1) for f, e in zip(found, exact)
+            ])
+            timings = self._time_queries(queries, lambda q: index.search(matrix, q, top_k, n_probe))
+            self._row(f'ivf nprobe={n_probe}', timings, recall)
+
+    def _report_quant(self, kind, matrix, queries, exact, top_k, options, quant_options=None, label=None):
+        started = time.perf_counter()
+        if quant_options is None:
+            quant_options = {'m': options['pq_subspaces']} if kind == 'pq' else {}
+        quantizer = build_quantizer(kind, matrix, **quant_options)
+        codes = quantizer.encode(matrix)
+        full_bytes = matrix.shape[1] * matrix.dtype.itemsize
+        label = label or kind
+        self.stdout.write(
+            f"{'':>22}   {label}: {quantizer.code_bytes} B/vector vs {full_bytes} B "
+            f"({full_bytes / quantizer.code_bytes:.0f}x), build {time.perf_counter() - started:.1f} s"
+        )
+        for rescore in [int(r) for r in options['rescore'].split(',') if r.strip()]:
+            search = lambda q: quantizer.search(codes, matrix, q, top_k, rescore)
+            found = [search(q)[0] for q in queries]
+            recall = np.mean([
+                len(set(f.tolist()) & set(e.tolist())) / max(len(e), 1) for f, e in zip(found, exact)
+            ])
+            self._row(f'{label} rescore={rescore}', self._time_queries(queries, search), recall)
+
+    def _row(self, name, timings, recall):
+        self.stdout.write(
+            f"{name:>22} | {np.percentile(timings, 50):>8.2f} | {np.percentile(timings, 99):>8.2f} | {recall:>8.3f}"
+        )
+
+    def _baseline(self, matrix, query, top_k):
+        similarities = cosine_similarity(query.reshape(1, -1), matrix)[0]
+        return np.argsort(similarities)[-top_k:][::-1]
+
+    def _time_batch(self, queries, fn, repeats=5):
+        """Thời gian mỗi câu hỏi (ms) khi chấm cả lô bằng một phép nhân ma trận-ma trận"""
+        fn(queries)  # warm-up
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            fn(queries)
+            timings.append((time.perf_counter() - started) * 1000 / len(queries))
+        return np.array(timings)
+
+    def _time_queries(self, queries, fn):
+        fn(queries[0])  # warm-up (page cache)
+        timings = []
+        for q in queries:
+            started = time.perf_counter()
+            fn(q)
+            timings.append((time.perf_counter() - started) * 1000)
+        return np.array(timings)
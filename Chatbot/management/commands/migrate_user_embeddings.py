@@ -0,0 +1,84 @@
+import os
+import re
+import shutil
+
+from django.core.management.base import BaseCommand
+
+from Chatbot.services.user_vector_store import get_user_vector_store
+from Chatbot.services.vector_store import load_vector_store
+
+# user_<id>_embeddings.json (JSON cũ) hoặc user_<id>_embeddings/ (kho nhị phân riêng)
+LEGACY_NAME = re.compile(r'^user_(.+)_embeddings(\.json)?$')
+
+
+class Command(BaseCommand):
+    help = 'Import legacy per-user embedding files into the consolidated sharded user vector store'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source-dir',
+            type=str,
+            default='.',
+            help='Directory containing user_<id>_embeddings.json files / user_<id>_embeddings/ stores (default: .)',
+        )
+        parser.add_argument('--batch-size', type=int, default=200, help='Users written per batch (default: 200)')
+        parser.add_argument('--delete', action='store_true', help='Delete legacy files after a successful import')
+
+    def handle(self, *args, **options):
+        source_dir = options['source_dir']
+        store = get_user_vector_store()
+
+        # Nếu một user có cả thư mục nhị phân và file JSON thì ưu tiên thư mục (mới hơn)
+        sources = {}
+        for name in sorted(os.listdir(source_dir)):
+            match = LEGACY_NAME.match(name)
+            path = os.path.join(source_dir, name)
+            if not match:
+                continue
+            user_id, is_json = match.group(1), bool(match.group(2))
+            if is_json and user_id in sources:
+                continue
+            sources[user_id] = path
+
+        if not sources:
+            self.stdout.write(f"Không tìm thấy embeddings cá nhân kiểu cũ trong {source_dir}")
+            return
+
+        imported, failed = 0, 0
+        batch, batch_paths = {}, []
+        items = list(sources.items())
+        for position, (user_id, path) in enumerate(items, start=1):
+            try:
+                legacy = load_vector_store(path)
+                if legacy is None or len(legacy) == 0:
+                    self.stdout.write(f"Bỏ qua {path}: không có dữ liệu")
+                else:
+                    metadata = {k: v for k, v in legacy.manifest.get('metadata', {}).items() if k != 'user_id'}
+                    metadata['migrated_from'] = os.path.basename(path)
+                    batch[user_id] = (list(legacy.chunks), legacy.vectors, metadata)
+                    batch_paths.append(path)
+            except Exception as e:
+                failed += 1
+                self.stdout.write(self.style.ERROR(f"Lỗi khi đọc {path}: {e}"))
+
+            if len(batch) >= options['batch_size'] or (position == len(items) and batch):
+                store.replace_users(batch)
+                imported += len(batch)
+                self.stdout.write(f"Đã import {imported}/{len(items)} users")
+                if options['delete']:
+                    for done_path in batch_paths:
+                        self._remove(done_path)
+                batch, batch_paths = {}, []
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Hoàn tất: {imported} users vào {store.root}, {failed} lỗi")
+        )
+
+    def _remove(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -3,8 +3,6 @@ import json
 import numpy as np
 from dotenv import load_dotenv
 from sklearn.metrics.pairwise import cosine_similarity
-import openai
-from langchain_openai import OpenAIEmbeddings
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from File_sharing_platform.models import File, Category
@@ -12,8 +10,20 @@ from Social_Platform.models import Post, Comment
 from datetime import datetime
 
 # Import service từ Chatbot app
-from Chatbot.services.rag_chatbot_service import RAGChatbotService
+from Chatbot.services.rag_chatbot_service import RAGChatbotService, DEFAULT_INDEX_DIR
 from Chatbot.services.user_embedding_service import UserEmbeddingService
+from Chatbot.services.providers import get_provider
+from Chatbot.services.user_vector_store import get_user_vector_store
+from Chatbot.services.vector_store import VectorStore, write_vector_store, add_lexical_index, load_vector_store
+from Chatbot.services.chunk_table import make_chunk_id
+from Chatbot.services.incremental_index import (
+    COMPACT_RATIO, SourceDocument, compact_vector_store, diff_sources, incremental_unavailable_reason,
+    previous_source_hashes, source_hash, source_info, source_key, update_vector_store,
+    write_options_from_manifest,
+)
+from Chatbot.services.embedding_batcher import (
+    EmbeddingBatcher, RateLimiter, EMBED_BATCH_SIZE, EMBED_BATCH_TOKENS, EMBED_WORKERS, EMBED_RPM, EMBED_TPM
+)
 
 class Command(BaseCommand):
     help = 'Train RAG chatbot by creating embeddings from database data using Chatbot services'
@@ -35,11 +45,120 @@ class Command(BaseCommand):
             default=500,
             help='Size of text chunks (default: 500)',
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=EMBED_BATCH_SIZE,
+            help=f'Max chunks per embedding request (default: {EMBED_BATCH_SIZE})',
+        )
+        parser.add_argument(
+            '--batch-tokens',
+            type=int,
+            default=EMBED_BATCH_TOKENS,
+            help=f'Max total tokens per embedding request (default: {EMBED_BATCH_TOKENS})',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=EMBED_WORKERS,
+            help=f'Number of embedding batches sent concurrently (default: {EMBED_WORKERS})',
+        )
+        parser.add_argument(
+            '--rpm',
+            type=int,
+            default=EMBED_RPM,
+            help='Embedding requests-per-minute limit shared by all workers, 0 = unlimited (default: %(default)s)',
+        )
+        parser.add_argument(
+            '--tpm',
+            type=int,
+            default=EMBED_TPM,
+            help='Embedding tokens-per-minute limit shared by all workers, 0 = unlimited (default: %(default)s)',
+        )
+        parser.add_argument(
+            '--index-dir',
+            type=str,
+            default=DEFAULT_INDEX_DIR,
+            help=f'Output directory for the binary vector store (default: {DEFAULT_INDEX_DIR})',
+        )
+        parser.add_argument(
+            '--dtype',
+            choices=['float32', 'float16'],
+            default=None,
+            help='Storage dtype of the embedding matrix (default: float32)',
+        )
+        parser.add_argument(
+            '--ann',
+            choices=['none', 'ivf'],
+            default=None,
+            help='Build an approximate nearest-neighbour index next to the vectors (default: none)',
+        )
+        parser.add_argument(
+            '--ivf-lists',
+            type=int,
+            default=None,
+            help='Number of IVF lists (default: sqrt(number of chunks))',
+        )
+        parser.add_argument(
+            '--quantization',
+            choices=['none', 'int8', 'pq', 'prefix'],
+            default=None,
+            help='Also store compressed codes for two-stage search: int8 (4x smaller), pq, '
+                 'or prefix (Matryoshka: first --prefix-dims dims, re-normalized) (default: none)',
+        )
+        parser.add_argument(
+            '--pq-subspaces',
+            type=int,
+            default=None,
+            help='PQ bytes per vector, must divide the embedding dim (default: largest divisor <= dim/16)',
+        )
+        parser.add_argument(
+            '--prefix-dims',
+            type=int,
+            default=None,
+            help='Leading dimensions kept by --quantization prefix (default: 256)',
+        )
+        parser.add_argument(
+            '--lexical',
+            choices=['none', 'bm25'],
+            default=None,
+            help='Also build a BM25 keyword index over the chunks for hybrid / lexical-only retrieval (default: bm25)',
+        )
+        parser.add_argument(
+            '--add-lexical',
+            action='store_true',
+            help='Build the BM25 index for the existing --index-dir without re-embedding, then exit',
+        )
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help='Only embed new / changed files, posts and comments; rows of changed / deleted ones are '
+                 'tombstoned (falls back to a full build if the index has no source hashes). Keeps the dtype, '
+                 'ANN, quantization and lexical settings of the existing index unless those flags are passed',
+        )
+        parser.add_argument(
+            '--compact',
+            action='store_true',
+            help='Drop tombstoned rows: alone, compact the existing --index-dir and exit; '
+                 'with --incremental, always compact after the update',
+        )
+        parser.add_argument(
+            '--compact-ratio',
+            type=float,
+            default=COMPACT_RATIO,
+            help=f'Compact automatically once this fraction of rows is tombstoned (default: {COMPACT_RATIO})',
+        )
         parser.add_argument(
             '--embeddings-file',
             type=str,
-            default='stem_embeddings.json',
-            help='Output file for embeddings (default: stem_embeddings.json)',
+            default=None,
+            help='Also export the legacy JSON format to this file',
+        )
+        parser.add_argument(
+            '--import-json',
+            type=str,
+            default=None,
+            help='Import an existing legacy embeddings JSON into --index-dir without calling OpenAI',
         )
     
     def handle(self, *args, **options):
@@ -49,14 +168,65 @@ class Command(BaseCommand):
         all_users = options.get('all_users')
         chunk_size = options.get('chunk_size')
         embeddings_file = options.get('embeddings_file')
+        self.index_dir = options.get('index_dir')
+        self.dtype = options.get('dtype') or 'float32'
+        self.ann = options.get('ann') or 'none'
+        self.ann_options = {'n_lists': options.get('ivf_lists')} if self.ann == 'ivf' else None
+        self.quantization = options.get('quantization') or 'none'
+        self.quantization_options = {
+            'pq': {'m': options.get('pq_subspaces')},
+            'prefix': {'dims': options.get('prefix_dims')},
+        }.get(self.quantization)
+        self.lexical = options.get('lexical') or 'bm25'
+        # Cấu hình ghi kho người dùng truyền tường minh: build tăng dần chỉ đổi các mục này,
+        # còn lại giữ như index hiện có (dtype, IVF, mã nén, BM25)
+        self.write_overrides = {}
+        if options.get('dtype') is not None:
+            self.write_overrides['dtype'] = self.dtype
+        if options.get('ann') is not None:
+            self.write_overrides.update(ann=self.ann, ann_options=self.ann_options)
+        if options.get('quantization') is not None:
+            self.write_overrides.update(quantization=self.quantization, quantization_options=self.quantization_options)
+        if options.get('lexical') is not None:
+            self.write_overrides['lexical'] = self.lexical
+        self.compact = options.get('compact')
+        self.compact_ratio = options.get('compact_ratio')
+        incremental = options.get('incremental')
+
+        if options.get('add_lexical'):
+            manifest = add_lexical_index(self.index_dir)
+            lexical = manifest.get('lexical') or {}
+            self.stdout.write(self.style.SUCCESS(
+                f"Đã build BM25 cho {self.index_dir}: {lexical.get('terms', 0)} term, "
+                f"{lexical.get('postings_bytes', 0)} bytes posting"
+            ))
+            return
+
+        if self.compact and not incremental:
+            manifest = compact_vector_store(self.index_dir)
+            self.stdout.write(self.style.SUCCESS(
+                f"Đã nén {self.index_dir}: {manifest['count']} dòng (phiên bản {manifest['index_version']})"
+            ))
+            return
+
+        import_json = options.get('import_json')
+        if import_json:
+            self.import_legacy_json(import_json, self.index_dir)
+            return
         
         # Khởi tạo service từ Chatbot app
-        self.rag_service = RAGChatbotService(embeddings_file)
+        self.rag_service = RAGChatbotService(self.index_dir)
         self.user_service = UserEmbeddingService()
 
-        # Khởi tạo OpenAI embeddings (chỉ 1 lần)
-        embedding_model_name = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
-        self.embeddings_model = OpenAIEmbeddings(model=embedding_model_name)
+        # Khởi tạo model embeddings qua provider (chỉ 1 lần).
+        # EmbeddingBatcher tự thử lại qua rate limiter dùng chung: tắt retry riêng của OpenAI SDK để mọi
+        # request HTTP đều được tính vào giới hạn RPM / TPM và backoff không bị cộng dồn
+        self.embedding_model_name = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+        self.embeddings_model = get_provider().embeddings(self.embedding_model_name, max_retries=0)
+        self.batcher = EmbeddingBatcher(
+            self.embeddings_model, options.get('batch_size'), options.get('batch_tokens'), log=self.stdout.write,
+            workers=options.get('workers'), rate_limiter=RateLimiter(options.get('rpm'), options.get('tpm'))
+        )
 
         if all_users:
             self.stdout.write("Tạo embeddings cho tất cả users...")
@@ -69,22 +239,35 @@ class Command(BaseCommand):
             )
         else:
             self.stdout.write("Tạo embeddings chung từ database...")
-            self.create_global_embeddings(chunk_size, embeddings_file)
+            self.create_global_embeddings(chunk_size, embeddings_file, incremental)
             self.stdout.write(
-                self.style.SUCCESS(f'Đã tạo embeddings và lưu vào {embeddings_file}')
+                self.style.SUCCESS(f'Đã tạo embeddings và lưu vào {self.index_dir}')
             )
+        self.write_throughput_report()
     
     def create_embeddings_for_all_users(self, chunk_size):
         from django.contrib.auth import get_user_model
         User = get_user_model()
+        store = get_user_vector_store()
         
-        users = User.objects.all()
-        total_users = users.count()
+        # Xử lý user theo thứ tự shard và ghi mỗi shard một lần (replace_users),
+        # thay vì ghi lại cả shard sau từng user
+        users = sorted(User.objects.all(), key=lambda user: store.shard_of(str(user.id)))
+        total_users = len(users)
+        pending, current_shard = {}, None
         
         for i, user in enumerate(users, 1):
+            shard = store.shard_of(str(user.id))
+            if shard != current_shard:
+                self._flush_user_embeddings(store, pending)
+                current_shard = shard
             self.stdout.write(f"Đang xử lý user {i}/{total_users}: {user.username} (ID: {user.id})")
             try:
-                self.create_user_embeddings(str(user.id), chunk_size)
+                item = self._embed_user(str(user.id), chunk_size)
+                if item is None:
+                    self.stdout.write(f"Không có dữ liệu cho user {user.id}")
+                else:
+                    pending[str(user.id)] = item
                 self.stdout.write(
                     self.style.SUCCESS(f'✓ Hoàn thành user {user.username}')
                 )
@@ -92,136 +275,220 @@ class Command(BaseCommand):
                 self.stdout.write(
                     self.style.ERROR(f'✗ Lỗi với user {user.username}: {e}')
                 )
+        self._flush_user_embeddings(store, pending)
     
     def create_user_embeddings(self, user_id, chunk_size):
-        all_chunks = []
-        all_embeddings = []
-        
         try:
-            # Files
-            files = File.objects.all()
-            for file in files:
-                if not self._belongs_to_user(file, user_id):
-                    continue
-                text = self._build_file_text(file)
-                if not text:
-                    continue
-                chunks = self.chunk_text(text, chunk_size)
-                for chunk in chunks:
-                    embedding = self.get_openai_embedding(chunk)
-                    if embedding:
-                        all_chunks.append(chunk)
-                        all_embeddings.append(embedding)
-            
-            # Posts
-            posts = Post.objects.all()
-            for post in posts:
-                if not self._belongs_to_user(post, user_id):
-                    continue
-                text = self._build_post_text(post)
-                if not text:
-                    continue
-                chunks = self.chunk_text(text, chunk_size)
-                for chunk in chunks:
-                    embedding = self.get_openai_embedding(chunk)
-                    if embedding:
-                        all_chunks.append(chunk)
-                        all_embeddings.append(embedding)
-            
-            # Comments
-            comments = Comment.objects.all()
-            for comment in comments:
-                if not self._belongs_to_user(comment, user_id):
-                    continue
-                text = self._build_comment_text(comment)
-                if not text:
-                    continue
-                chunks = self.chunk_text(text, chunk_size)
-                for chunk in chunks:
-                    embedding = self.get_openai_embedding(chunk)
-                    if embedding:
-                        all_chunks.append(chunk)
-                        all_embeddings.append(embedding)
-            
-            if all_chunks and all_embeddings:
-                data = {
-                    'user_id': user_id,
-                    'chunks': all_chunks,
-                    'embeddings': all_embeddings,
-                    'total_chunks': len(all_chunks),
-                    'created_at': str(datetime.now())
-                }
-                
-                filename = f"user_{user_id}_embeddings.json"
-                with open(filename, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-                
-                self.stdout.write(f"Đã tạo {len(all_chunks)} chunks cho user {user_id} -> {filename}")
-            else:
+            item = self._embed_user(user_id, chunk_size)
+            if item is None:
                 self.stdout.write(f"Không có dữ liệu cho user {user_id}")
-                
+                return
+            store = get_user_vector_store()
+            store.replace_users({str(user_id): item})
+            self.stdout.write(
+                f"Đã tạo {len(item[0])} chunks cho user {user_id} -> {store.root} (shard {store.shard_of(user_id)})"
+            )
         except Exception as e:
             self.stdout.write(self.style.ERROR(f"Lỗi khi tạo embeddings cho user {user_id}: {e}"))
     
-    def create_global_embeddings(self, chunk_size, embeddings_file):
-        all_chunks = []
-        all_embeddings = []
-        
-        try:
-            # Files
-            files = File.objects.all()
-            for file in files:
-                text = self._build_file_text(file)
-                if not text:
-                    continue
-                chunks = self.chunk_text(text, chunk_size)
-                for chunk in chunks:
-                    embedding = self.get_openai_embedding(chunk)
-                    if embedding:
-                        all_chunks.append(chunk)
-                        all_embeddings.append(embedding)
-            
-            # Posts
-            posts = Post.objects.all()
-            for post in posts:
-                text = self._build_post_text(post)
-                if not text:
+    def _embed_user(self, user_id, chunk_size):
+        """(chunks, embeddings, metadata) của một user, None nếu user không có dữ liệu"""
+        pending = []
+        sources = (
+            (File.objects.all(), self._build_file_text),
+            (Post.objects.all(), self._build_post_text),
+            (Comment.objects.all(), self._build_comment_text),
+        )
+        for queryset, build_text in sources:
+            for obj in queryset:
+                if not self._belongs_to_user(obj, user_id):
                     continue
-                chunks = self.chunk_text(text, chunk_size)
-                for chunk in chunks:
-                    embedding = self.get_openai_embedding(chunk)
-                    if embedding:
-                        all_chunks.append(chunk)
-                        all_embeddings.append(embedding)
-            
-            # Comments
-            comments = Comment.objects.all()
-            for comment in comments:
-                text = self._build_comment_text(comment)
+                text = build_text(obj)
                 if not text:
                     continue
-                chunks = self.chunk_text(text, chunk_size)
-                for chunk in chunks:
-                    embedding = self.get_openai_embedding(chunk)
-                    if embedding:
-                        all_chunks.append(chunk)
-                        all_embeddings.append(embedding)
+                pending.extend(self.chunk_text(text, chunk_size))
+        
+        # Embed theo lô sau khi đã gom đủ chunk của user
+        all_chunks = []
+        all_embeddings = []
+        for chunk, embedding in zip(pending, self.batcher.embed(pending)):
+            if embedding:
+                all_chunks.append(chunk)
+                all_embeddings.append(embedding)
+        if not all_chunks:
+            return None
+        metadata = {'embedding_model': getattr(self.embeddings_model, 'model', self.embedding_model_name)}
+        return all_chunks, all_embeddings, metadata
+    
+    def _flush_user_embeddings(self, store, pending):
+        """Ghi các user đã embed (cùng một shard) bằng một lần replace_users"""
+        if not pending:
+            return
+        try:
+            store.replace_users(pending)
+            chunk_count = sum(len(chunks) for chunks, _, _ in pending.values())
+            shard = store.shard_of(next(iter(pending)))
+            self.stdout.write(f"Đã ghi {chunk_count} chunks của {len(pending)} user -> {store.root} (shard {shard})")
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(f"Lỗi khi ghi embeddings của {len(pending)} user: {e}"))
+        pending.clear()
+    
+    def create_global_embeddings(self, chunk_size, embeddings_file, incremental=False):
+        try:
+            documents = self._collect_global_documents(chunk_size)
+            model_name = getattr(self.embeddings_model, 'model', self.embedding_model_name)
+
+            if incremental:
+                store = load_vector_store(self.index_dir)
+                reason = incremental_unavailable_reason(store, chunk_size, model_name)
+                if reason is None:
+                    self.update_global_embeddings(store, documents, chunk_size, model_name)
+                    if embeddings_file:
+                        self.export_embeddings_file(embeddings_file)
+                    return
+                self.stdout.write(self.style.WARNING(f"Không build tăng dần được ({reason}), build lại toàn bộ"))
+
+            all_chunks, all_embeddings, all_metadata, all_sources, source_hashes = self._embed_documents(documents)
             
             if all_chunks and all_embeddings:
-                data = {
-                    'chunks': all_chunks,
-                    'embeddings': all_embeddings
-                }
-                with open(embeddings_file, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-                
-                self.stdout.write(f"Đã tạo và lưu {len(all_chunks)} chunks vào {embeddings_file}")
+                manifest = write_vector_store(
+                    self.index_dir, all_chunks, all_embeddings, dtype=self.dtype,
+                    metadata={'embedding_model': model_name},
+                    ann=self.ann, ann_options=self.ann_options,
+                    quantization=self.quantization, quantization_options=self.quantization_options,
+                    lexical=self.lexical, chunk_metadata=all_metadata, chunk_sources=all_sources,
+                    sources=source_info(source_hashes, chunk_size)
+                )
+                self.stdout.write(
+                    f"Đã tạo và lưu {len(all_chunks)} chunks vào {self.index_dir} "
+                    f"(phiên bản {manifest['index_version']})"
+                )
+
+                if embeddings_file:
+                    # Xuất thêm định dạng JSON cũ nếu được yêu cầu
+                    self._write_embeddings_file(embeddings_file, all_chunks, all_embeddings)
             else:
                 self.stdout.write(self.style.WARNING("Không có dữ liệu để tạo embeddings"))
                 
         except Exception as e:
             self.stdout.write(self.style.ERROR(f"Lỗi khi tạo embeddings từ database: {e}"))
 
+    def export_embeddings_file(self, embeddings_file):
+        """Xuất định dạng JSON cũ từ kho hiện tại (bỏ dòng tombstone; vector đã chuẩn hóa)"""
+        store = VectorStore.open(self.index_dir)
+        rows = np.flatnonzero(store.live_mask) if store.live_mask is not None else np.arange(len(store))
+        chunks = [store.chunks[int(i)] for i in rows]
+        embeddings = np.asarray(store.vectors[rows], dtype=np.float32).tolist()
+        self._write_embeddings_file(embeddings_file, chunks, embeddings)
+
+    def _write_embeddings_file(self, embeddings_file, chunks, embeddings):
+        data = {
+            'chunks': chunks,
+            'embeddings': embeddings
+        }
+        with open(embeddings_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        self.stdout.write(f"Đã xuất thêm định dạng JSON vào {embeddings_file}")
+
+    def update_global_embeddings(self, store, documents, chunk_size, model_name):
+        """Build tăng dần: chỉ embed nguồn mới / đã sửa, dòng của nguồn đã sửa / đã xóa đánh tombstone"""
+        previous = previous_source_hashes(store)
+        delta = diff_sources(previous, {d.key: d.hash for d in documents})
+        self.stdout.write(
+            f"So với phiên bản {store.index_version}: {len(delta.new)} nguồn mới, {len(delta.changed)} đã sửa, "
+            f"{len(delta.deleted)} đã xóa, {len(delta.unchanged)} không đổi"
+        )
+        if not (delta.new or delta.changed or delta.deleted) and not self.compact:
+            self.stdout.write(self.style.SUCCESS("Index đã cập nhật, không cần ghi phiên bản mới"))
+            return
+
+        pending = [d for d in documents if d.key not in delta.unchanged]
+        chunks, embeddings, chunk_metadata, chunk_sources, embedded_hashes = self._embed_documents(pending)
+        source_hashes = {key: previous[key] for key in delta.unchanged}
+        source_hashes.update(embedded_hashes)
+        write_options = dict(write_options_from_manifest(store.manifest), **self.write_overrides)
+        manifest = update_vector_store(
+            self.index_dir, store, delta.unchanged, chunks, embeddings, chunk_sources,
+            chunk_metadata=chunk_metadata, source_hashes=source_hashes,
+            chunk_size=chunk_size, compact_ratio=self.compact_ratio, compact=self.compact,
+            metadata={'embedding_model': model_name}, **write_options
+        )
+        tombstones = (manifest.get('tombstones') or {}).get('count', 0)
+        self.stdout.write(
+            f"Đã thêm {len(chunks)} chunks vào {self.index_dir} (phiên bản {manifest['index_version']}): "
+            f"{manifest['count']} dòng, {tombstones} dòng đã xóa chờ nén"
+        )
+
+    def _collect_global_documents(self, chunk_size):
+        """Mỗi File / Post / Comment có nội dung thành một SourceDocument (chunk trùng trong cùng nguồn bỏ bớt)"""
+        documents = []
+        sources = (
+            ('file', File.objects.all(), self._build_file_text),
+            ('post', Post.objects.all(), self._build_post_text),
+            ('comment', Comment.objects.all(), self._build_comment_text),
+        )
+        for source_type, queryset, build_text in sources:
+            for obj in queryset:
+                text = build_text(obj)
+                if not text:
+                    continue
+                chunks = []
+                seen_ids = set()
+                for position, chunk in enumerate(self.chunk_text(text, chunk_size)):
+                    # Id ổn định (nguồn + hash nội dung): chunk trùng trong cùng nguồn chỉ embed một lần
+                    chunk_id = make_chunk_id(chunk, source_type, obj.pk)
+                    if chunk_id in seen_ids:
+                        continue
+                    seen_ids.add(chunk_id)
+                    # Vị trí tính theo từ, đúng cách chunk_text cắt văn bản
+                    chunks.append((chunk, position * chunk_size))
+                metadata = self._build_chunk_metadata(source_type, obj)
+                documents.append(SourceDocument(
+                    source_key(source_type, obj.pk), source_type, obj.pk, source_hash(text, metadata),
+                    metadata, chunks
+                ))
+        return documents
+
+    def _embed_documents(self, documents):
+        """
+        Embed theo lô (embed_documents) mọi chunk của các nguồn. Hash của nguồn chỉ được ghi khi mọi chunk
+        của nó embed thành công, để lần build tăng dần sau thử lại nguồn bị lỗi.
+        """
+        pending = [(document, chunk, offset) for document in documents for chunk, offset in document.chunks]
+        embeddings = self.batcher.embed([chunk for _, chunk, _ in pending])
+        all_chunks, all_embeddings, all_metadata, all_sources = [], [], [], []
+        failed = set()
+        for (document, chunk, offset), embedding in zip(pending, embeddings):
+            if not embedding:
+                failed.add(document.key)
+                continue
+            all_chunks.append(chunk)
+            all_embeddings.append(embedding)
+            all_metadata.append(document.metadata)
+            all_sources.append((document.model, document.pk, offset))
+        source_hashes = {d.key: d.hash for d in documents if d.key not in failed}
+        return all_chunks, all_embeddings, all_metadata, all_sources, source_hashes
+
+    def import_legacy_json(self, json_file, index_dir):
+        """Chuyển file embeddings JSON cũ sang kho vector nhị phân"""
+        if not os.path.exists(json_file):
+            self.stdout.write(self.style.ERROR(f"File {json_file} không tồn tại"))
+            return
+        store = VectorStore.from_json(json_file)
+        manifest = write_vector_store(
+            index_dir, list(store.chunks), store.vectors, dtype=self.dtype,
+            metadata={'imported_from': json_file},
+            ann=self.ann, ann_options=self.ann_options,
+            quantization=self.quantization, quantization_options=self.quantization_options,
+            lexical=self.lexical
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Đã import {manifest['count']} chunks từ {json_file} vào {index_dir} "
+                f"(phiên bản {manifest['index_version']})"
+            )
+        )
+
     # -------- Helpers để trích xuất nội dung an toàn --------
     def _get_first_attr(self, obj, names):
         for name in names:
@@ -244,6 +511,19 @@ class Command(BaseCommand):
         owner_id = getattr(owner, "id", None)
         return str(owner_id) == str(user_id)
 
+    def _build_chunk_metadata(self, source_type: str, obj) -> dict:
+        """Metadata gắn với mọi chunk của obj, để lọc khi truy hồi (danh mục, tác giả, file bán phí...)"""
+        owner = self._get_first_attr(obj, ["author", "user", "owner", "created_by"])
+        categories = getattr(obj, "categories", None)
+        return {
+            'source_type': source_type,
+            'source_id': obj.pk,
+            'category_ids': list(categories.values_list('id', flat=True)) if categories is not None else [],
+            'author_id': getattr(owner, "id", None),
+            # file_status của File (0 = miễn phí, 1 = bán); bài viết / bình luận luôn công khai
+            'status': getattr(obj, "file_status", 0),
+        }
+
     def _build_file_text(self, file_obj) -> str:
         title = self._get_first_attr(file_obj, ["title", "name"]) or ""
         description = self._get_first_attr(file_obj, ["file_description", "description", "summary"]) or ""
@@ -303,9 +583,11 @@ class Command(BaseCommand):
             chunks.append(' '.join(current_chunk))
         return chunks
     
-    def get_openai_embedding(self, text):
-        try:
-            return self.embeddings_model.embed_query(text)
-        except Exception as e:
-            self.stdout.write(f"Lỗi khi tạo embedding OpenAI: {e}")
-            return None
+    def write_throughput_report(self):
+        report = self.batcher.report()
+        self.stdout.write(
+            f"Embedding: {report['chunks']} chunks, {report['tokens']} tokens trong {report['seconds']}s "
+            f"({report['chunks_per_s']} chunks/s, {report['tokens_per_s']} tokens/s, {report['workers']} worker), "
+            f"{report['requests']} request, {report['retries']} lần thử lại, chờ giới hạn {report['throttled_seconds']}s, "
+            f"{report['splits']} lô bị chia lại, {report['failed']} chunk lỗi"
+        )
@@ -0,0 +1,132 @@
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+from . import retrieval
+
+# Số dòng gán cụm mỗi lượt khi build (giới hạn bộ nhớ tạm)
+ASSIGN_BLOCK_ROWS = 65536
+
+
+class IVFIndex:
+    """
+    Chỉ mục IVF (inverted file) thuần NumPy cho vector đã chuẩn hóa:
+    k-means cầu (spherical) làm coarse quantizer, mỗi cụm giữ danh sách dòng thuộc cụm.
+    Truy vấn chỉ chấm điểm các dòng trong n_probe cụm gần nhất.
+    """
+
+    def __init__(self, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @property
+    def n_lists(self) -> int:
+        return int(self.centroids.shape[0])
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.centroids.nbytes + self.order.nbytes + self.offsets.nbytes)
+
+    @staticmethod
+    def default_n_lists(count: int) -> int:
+        return max(1, int(np.sqrt(count)))
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, n_lists: int = None, iterations: int = 10,
+              sample_size: int = None, seed: int = 0) -> 'IVFIndex':
+        count = len(vectors)
+        n_lists = min(n_lists or cls.default_n_lists(count), max(count, 1))
+        rng = np.random.RandomState(seed)
+
+        # Huấn luyện centroid trên một mẫu con để build nhanh với corpus lớn
+        sample_size = min(count, sample_size or n_lists * 64)
+        sample_rows = np.sort(rng.choice(count, sample_size, replace=False))
+        sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=n_lists) == 0
+            # Cụm rỗng: khởi tạo lại bằng một điểm ngẫu nhiên
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            centroids = retrieval.normalize_rows(sums)
+
+        assignment = _assign(vectors, centroids)
+        order = np.argsort(assignment, kind='stable').astype(np.int64)
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignment, minlength=n_lists))
+        return cls(centroids, order, offsets)
+
+    def extend(self, vectors: np.ndarray, first_row: int) -> 'IVFIndex':
+        """
+        Thêm các dòng first_row, first_row + 1, ... (vector đã chuẩn hóa) vào cụm gần nhất, giữ nguyên centroid
+        (không chạy lại k-means; nén kho sẽ build lại IVF từ đầu).
+        """
+        assignment = np.concatenate([
+            np.repeat(np.arange(self.n_lists, dtype=np.int32), np.diff(self.offsets)),
+            _assign(vectors, self.centroids),
+        ])
+        rows = np.concatenate([np.asarray(self.order), np.arange(first_row, first_row + len(vectors), dtype=np.int64)])
+        offsets = np.zeros(self.n_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignment, minlength=self.n_lists))
+        return IVFIndex(self.centroids, rows[np.argsort(assignment, kind='stable')], offsets)
+
+    def candidates(self, query: np.ndarray, n_probe: int) -> np.ndarray:
+        n_probe = max(1, min(n_probe, self.n_lists))
+        lists = retrieval.top_k_indices(self.centroids @ query, n_probe)
+        parts = [self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists]
+        rows = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+        # Đọc theo thứ tự tăng dần để truy cập mmap tuần tự hơn
+        return np.sort(rows)
+
+    def search(self, matrix: np.ndarray, query, top_k: int, n_probe: int = 8,
+               threshold: Optional[float] = None, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        query = retrieval.normalize_vector(query)
+        rows = self.candidates(query, n_probe)
+        if mask is not None:
+            rows = rows[mask[rows]]
+            if len(rows) < top_k:
+                # Bộ lọc chọn lọc mạnh: các cụm gần nhất không đủ ứng viên, tìm chính xác trên các dòng được giữ
+                return retrieval.search(matrix, query, top_k, threshold, mask)
+        if len(rows) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        scores = np.asarray(matrix[rows], dtype=np.float32) @ query
+        best = retrieval.top_k_indices(scores, top_k)
+        indices, selected = rows[best], scores[best]
+        if threshold is not None:
+            keep = selected >= threshold
+            indices, selected = indices[keep], selected[keep]
+        return indices, selected
+
+    # -------- Lưu / đọc cạnh kho vector --------
+    def save(self, path: str, version: str) -> dict:
+        files = {
+            'centroids': f"ivf_centroids-{version}.npy",
+            'order': f"ivf_order-{version}.npy",
+            'offsets': f"ivf_offsets-{version}.npy",
+        }
+        np.save(os.path.join(path, files['centroids']), self.centroids.astype(np.float32))
+        np.save(os.path.join(path, files['order']), self.order)
+        np.save(os.path.join(path, files['offsets']), self.offsets)
+        return {'type': 'ivf', 'n_lists': self.n_lists, 'files': files}
+
+    @classmethod
+    def load(cls, path: str, info: dict) -> 'IVFIndex':
+        files = info['files']
+        return cls(
+            np.load(os.path.join(path, files['centroids'])),
+            np.load(os.path.join(path, files['order']), mmap_mode='r'),
+            np.load(os.path.join(path, files['offsets'])),
+        )
+
+
+def _assign(vectors, centroids: np.ndarray) -> np.ndarray:
+    """Cụm gần nhất của từng vector, tính theo khối dòng"""
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + ASSIGN_BLOCK_ROWS], dtype=np.float32)
+        assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignment
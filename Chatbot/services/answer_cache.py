@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from dotenv import load_dotenv
+
+from .query_embedding_cache import normalize_query
+from . import tracing
+
+load_dotenv()
+
+# Số câu trả lời giữ trong RAM mỗi process và thời gian sống (giây)
+ANSWER_CACHE_SIZE = int(os.getenv("RAG_ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = float(os.getenv("RAG_ANSWER_CACHE_TTL", "3600"))
+# "off" để tắt hẳn cache câu trả lời
+ANSWER_CACHE_MODE = os.getenv("RAG_ANSWER_CACHE", "on")
+
+
+class AnswerCache:
+    """
+    Cache câu trả lời đầy đủ của chatbot theo khóa:
+    (câu hỏi đã chuẩn hóa, id + phiên bản các chunk truy hồi được, model, tham số sinh, phiên bản prompt).
+    Giới hạn theo số entry (LRU) và TTL; bỏ các entry của phiên bản index cũ khi index đổi.
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 enabled: bool = ANSWER_CACHE_MODE != "off", clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (answer, expires_at, index_version)
+        self._lock = threading.Lock()
+        self._index_version = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.bypasses = 0
+
+    @staticmethod
+    def make_key(query: str, chunk_ids: Iterable[str], index_version: Optional[str], model: str,
+                 temperature: float, max_tokens: int, template_version) -> str:
+        raw = json.dumps([
+            normalize_query(query),
+            [str(i) for i in chunk_ids],
+            index_version,
+            model,
+            float(temperature),
+            int(max_tokens),
+            template_version,
+        ], ensure_ascii=False)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def sync_index_version(self, index_version: Optional[str]):
+        """Gọi với phiên bản index hiện tại: khi đổi phiên bản, bỏ các câu trả lời dựa trên index cũ"""
+        if index_version == self._index_version:
+            return
+        with self._lock:
+            if index_version == self._index_version:
+                return
+            stale = [k for k, (_, _, version) in self._entries.items() if version != index_version]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+            self._index_version = index_version
+
+    def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= self._clock():
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                tracing.count("answer_cache.miss")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            tracing.count("answer_cache.hit")
+            return entry[0]
+
+    def put(self, key: str, answer: str, index_version: Optional[str] = None):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (answer, self._clock() + self.ttl, index_version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def record_bypass(self):
+        """Câu trả lời có context cá nhân: không tra / không lưu cache"""
+        with self._lock:
+            self.bypasses += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.expired = self.evictions = self.invalidations = self.bypasses = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'index_version': self._index_version,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'bypasses': self.bypasses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# Cache mặc định của process
+answer_cache = AnswerCache()
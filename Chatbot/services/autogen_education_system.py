@@ -6,8 +6,10 @@ import openai
 from dotenv import load_dotenv
 
 # Import existing services
-from .rag_chatbot_service import RAGChatbotService
+from .rag_chatbot_service import get_rag_service
 from .user_embedding_service import UserEmbeddingService
+from .providers import get_provider
+from . import tracing
 
 # Try to import autogen with fallback
 try:
@@ -40,7 +42,7 @@ class EducationalMultiAgentSystem:
             self.api_key = "dummy_key"  # Fallback key
         
         # Khởi tạo các service hiện có
-        self.rag_service = RAGChatbotService()
+        self.rag_service = get_rag_service()
         try:
             self.user_embedding_service = UserEmbeddingService()
         except Exception as e:
@@ -67,6 +69,10 @@ class EducationalMultiAgentSystem:
         if not AUTOGEN_AVAILABLE:
             print("⚠️ AutoGen not available, using RAG fallback mode")
             self.autogen_available = False
+        elif get_provider().name != "openai":
+            # Agent AutoGen tự gọi OpenAI, không đi qua provider: chế độ local/record/replay dùng RAG fallback
+            print(f"⚠️ Provider {get_provider().name}: AutoGen disabled, using RAG fallback mode")
+            self.autogen_available = False
         else:
             self.autogen_available = True
             # Khởi tạo các agent
@@ -438,7 +444,7 @@ class EnhancedEducationSystem:
     
     def __init__(self):
         self.autogen_system = EducationalMultiAgentSystem()
-        self.rag_service = RAGChatbotService()  # Sử dụng RAG service chính
+        self.rag_service = get_rag_service()  # Sử dụng RAG service chính (dùng chung trong process)
         
     def process_request(self, user_input: str, user_id: str = None, use_autogen: bool = True):
         """
@@ -497,10 +503,11 @@ class EnhancedEducationSystem:
         Lấy context từ RAG service để bổ sung cho AutoGen
         """
         try:
-            if user_id:
-                context = self.rag_service.answer_question_with_user_context(user_input, user_id)
-            else:
-                context = self.rag_service.answer_question(user_input)
+            with tracing.span("hybrid.rag_context"):
+                if user_id:
+                    context = self.rag_service.answer_question_with_user_context(user_input, user_id)
+                else:
+                    context = self.rag_service.answer_question(user_input)
             
             # Giới hạn độ dài context để tránh quá dài
             if len(context) > 500:
@@ -515,9 +522,17 @@ class EnhancedEducationSystem:
         """
         Tạo response kết hợp giữa AutoGen và RAG
         """
+        with tracing.span("hybrid.response") as attrs:
+            result = self._hybrid_response(user_input, user_id)
+            attrs['intent'] = result.get('intent')
+            attrs['source'] = result.get('source')
+        return result
+
+    def _hybrid_response(self, user_input: str, user_id: str = None) -> dict:
         try:
             # Lấy response từ AutoGen system
-            autogen_result = self.autogen_system.smart_route_request(user_input, user_id)
+            with tracing.span("hybrid.autogen"):
+                autogen_result = self.autogen_system.smart_route_request(user_input, user_id)
             
             # Kiểm tra source của result
             if autogen_result.get('source') == 'rag':
@@ -0,0 +1,215 @@
+import hashlib
+import os
+import re
+import threading
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Encoding tiktoken để đếm token của chunk (o200k_base: họ gpt-4o / gpt-4.1)
+TOKEN_ENCODING = os.getenv("RAG_TOKEN_ENCODING", "o200k_base")
+# Model nguồn của chunk trong corpus chung; số thứ tự được lưu trong bảng chunk (uint8)
+SOURCE_MODELS = ("unknown", "file", "post", "comment")
+UNKNOWN_SOURCE = -1
+
+CHUNK_DTYPE = np.dtype([
+    ('hash', '<u8'),        # 8 byte đầu blake2b của text chunk
+    ('source', 'u1'),       # chỉ số trong SOURCE_MODELS
+    ('source_id', '<i8'),   # pk của File / Post / Comment (-1 nếu không rõ)
+    ('offset', '<i4'),      # vị trí (theo từ) của chunk trong text của nguồn
+    ('tokens', '<i4'),      # số token (tiktoken) của chunk
+    ('version', '<u2'),     # chỉ số trong danh sách phiên bản index đã thêm chunk
+])
+
+_FALLBACK_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding, _encoding_failed
+    if _encoding is None and not _encoding_failed:
+        with _encoding_lock:
+            if _encoding is None and not _encoding_failed:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+                except Exception as e:
+                    # Không có tiktoken / không tải được file encoding (máy offline): ước lượng theo từ
+                    print(f"⚠️ Không dùng được tiktoken ({e}), đếm token gần đúng theo từ")
+                    _encoding_failed = True
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text or '', disallowed_special=()))
+    return len(_FALLBACK_TOKEN_RE.findall(text or ''))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Giữ tối đa max_tokens token đầu của text (cùng cách đếm với count_tokens)"""
+    if max_tokens <= 0:
+        return ''
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text or '', disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    for i, match in enumerate(_FALLBACK_TOKEN_RE.finditer(text or '')):
+        if i == max_tokens:
+            return text[:match.start()].rstrip()
+    return text
+
+
+def content_hash(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b((text or '').encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def format_chunk_id(hash_value: int, source_model: Optional[str] = None, source_id: Optional[int] = None) -> str:
+    """Id ổn định của chunk: "<model>:<pk>:<hash>" (chỉ "<hash>" khi không rõ nguồn)"""
+    if source_model in (None, "unknown") or source_id is None or source_id == UNKNOWN_SOURCE:
+        return f"{hash_value:016x}"
+    return f"{source_model}:{int(source_id)}:{hash_value:016x}"
+
+
+def make_chunk_id(text: str, source_model: Optional[str] = None, source_id: Optional[int] = None) -> str:
+    return format_chunk_id(content_hash(text), source_model, source_id)
+
+
+def parse_chunk_id(chunk_id: str) -> Tuple[Optional[str], Optional[int], int]:
+    """Tách id thành (model, pk, hash); ValueError nếu id không hợp lệ"""
+    parts = str(chunk_id).split(':')
+    if len(parts) == 1:
+        return None, None, int(parts[0], 16)
+    if len(parts) == 3:
+        return parts[0], int(parts[1]), int(parts[2], 16)
+    raise ValueError(f"Chunk id không hợp lệ: {chunk_id}")
+
+
+class ChunkTable:
+    """
+    Bảng chunk của kho vector: mỗi dòng (cùng thứ tự với ma trận) giữ hash nội dung, nguồn (model + pk),
+    vị trí trong nguồn, số token và phiên bản index đã thêm chunk. Id của chunk suy ra từ hash + nguồn
+    nên không đổi giữa các lần build lại nếu nội dung không đổi.
+    """
+    type = "chunk_table"
+
+    def __init__(self, rows: np.ndarray, versions: List[str]):
+        self.rows = rows
+        self.versions = versions
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.rows.nbytes)
+
+    @classmethod
+    def build(cls, chunks: Sequence[str], version: str, sources: Optional[Sequence[tuple]] = None,
+              row_versions: Optional[Sequence[Optional[str]]] = None,
+              tokens: Optional[Sequence[int]] = None) -> 'ChunkTable':
+        """
+        sources: mỗi chunk một tuple (model, pk, offset); None = không rõ nguồn.
+        row_versions: phiên bản index đã thêm từng chunk (build tăng dần giữ phiên bản của dòng cũ);
+        None = phiên bản đang ghi.
+        tokens: số token đã đếm sẵn (lấy từ bảng chunk cũ khi nén), None = đếm bằng tiktoken.
+        """
+        if sources is not None and len(sources) != len(chunks):
+            raise ValueError(f"Số chunk ({len(chunks)}) khác số nguồn ({len(sources)})")
+        if tokens is not None and len(tokens) != len(chunks):
+            raise ValueError(f"Số chunk ({len(chunks)}) khác số token ({len(tokens)})")
+        rows = np.zeros(len(chunks), dtype=CHUNK_DTYPE)
+        rows['source_id'] = UNKNOWN_SOURCE
+        versions = [version]
+        if row_versions is not None:
+            # Chỉ giữ các phiên bản còn dòng tham chiếu
+            positions = {version: 0}
+            for i, row_version in enumerate(row_versions):
+                row_version = row_version or version
+                if row_version not in positions:
+                    positions[row_version] = len(versions)
+                    versions.append(row_version)
+                rows['version'][i] = positions[row_version]
+        if tokens is not None:
+            rows['tokens'] = np.asarray(tokens, dtype=np.int64)
+        for i, text in enumerate(chunks):
+            rows['hash'][i] = content_hash(text)
+            if tokens is None:
+                rows['tokens'][i] = count_tokens(text)
+            if sources is not None and sources[i] is not None:
+                model, pk, offset = sources[i]
+                rows['source'][i] = SOURCE_MODELS.index(model) if model in SOURCE_MODELS else 0
+                rows['source_id'][i] = UNKNOWN_SOURCE if pk is None else int(pk)
+                rows['offset'][i] = int(offset or 0)
+        return cls(rows, versions)
+
+    def extend(self, chunks: Sequence[str], version: str, sources: Optional[Sequence[tuple]] = None) -> 'ChunkTable':
+        """Bảng sau khi nối thêm chunk: dòng cũ giữ nguyên (kể cả số token), chỉ tính cho chunk mới"""
+        added = ChunkTable.build(chunks, version, sources)
+        versions = list(self.versions)
+        if version not in versions:
+            versions.append(version)
+        added.rows['version'] = versions.index(version)
+        return ChunkTable(np.concatenate([np.asarray(self.rows), added.rows]), versions)
+
+    def chunk_id(self, index: int) -> str:
+        row = self.rows[index]
+        return format_chunk_id(int(row['hash']), SOURCE_MODELS[int(row['source'])], int(row['source_id']))
+
+    def chunk_ids(self, indices) -> List[str]:
+        return [self.chunk_id(int(i)) for i in indices]
+
+    def record(self, index: int) -> dict:
+        row = self.rows[index]
+        source = SOURCE_MODELS[int(row['source'])]
+        return {
+            'id': self.chunk_id(index),
+            'source_model': None if source == "unknown" else source,
+            'source_id': None if int(row['source_id']) == UNKNOWN_SOURCE else int(row['source_id']),
+            'offset': int(row['offset']),
+            'tokens': int(row['tokens']),
+            'index_version': self.versions[int(row['version'])],
+        }
+
+    def source_rows(self, keys) -> np.ndarray:
+        """Mảng bool các dòng thuộc những nguồn "<model>:<pk>" cho trước"""
+        by_model = {}
+        for key in keys:
+            model, pk = str(key).rsplit(':', 1)
+            by_model.setdefault(model, []).append(int(pk))
+        selected = np.zeros(len(self.rows), dtype=bool)
+        for model, pks in by_model.items():
+            if model in SOURCE_MODELS:
+                selected |= ((self.rows['source'] == SOURCE_MODELS.index(model))
+                             & np.isin(self.rows['source_id'], np.asarray(pks, dtype=np.int64)))
+        return selected
+
+    def find(self, chunk_id: str) -> Optional[int]:
+        """Số dòng của chunk có id cho trước (None nếu không có); so trên cột hash, không đọc text"""
+        try:
+            model, pk, hash_value = parse_chunk_id(chunk_id)
+        except ValueError:
+            return None
+        for index in np.flatnonzero(self.rows['hash'] == np.uint64(hash_value)):
+            if self.chunk_id(int(index)) == format_chunk_id(hash_value, model, pk):
+                return int(index)
+        return None
+
+    # -------- Lưu / đọc cạnh kho vector --------
+    def save(self, path: str, version: str) -> dict:
+        files = {'rows': f"chunk_table-{version}.npy"}
+        np.save(os.path.join(path, files['rows']), self.rows)
+        return {'type': self.type, 'count': len(self.rows),
+                'token_encoding': TOKEN_ENCODING if _get_encoding() is not None else 'words',
+                'versions': list(self.versions), 'files': files}
+
+    @classmethod
+    def load(cls, path: str, info: dict) -> 'ChunkTable':
+        rows = np.load(os.path.join(path, info['files']['rows']), mmap_mode='r')
+        return cls(rows, list(info.get('versions', [])))
@@ -0,0 +1,171 @@
+import os
+import threading
+from collections import namedtuple
+from typing import List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from .chunk_table import content_hash, count_tokens, truncate_tokens
+from .retrieval import normalize_rows
+
+load_dotenv()
+
+# Số token tối đa của phần ngữ liệu trong prompt (0 = không giới hạn)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "2000"))
+# Hệ số MMR: 1.0 = chỉ xếp theo độ liên quan (tắt MMR), càng nhỏ càng ưu tiên chunk khác nhau
+MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "1.0"))
+# Token của tiền tố "- " và dấu xuống dòng trước mỗi chunk trong prompt
+CHUNK_OVERHEAD_TOKENS = 2
+
+# Một chunk ứng viên cho prompt: score là cosine với câu hỏi, vector là embedding đã chuẩn hóa (nếu có)
+ContextCandidate = namedtuple('ContextCandidate', ['text', 'score', 'vector', 'source'],
+                              defaults=(None, None, 'global'))
+AssembledContext = namedtuple('AssembledContext', ['chunks', 'metrics'])
+
+
+def as_candidate(chunk) -> ContextCandidate:
+    return chunk if isinstance(chunk, ContextCandidate) else ContextCandidate(chunk)
+
+
+class ContextAssembler:
+    """
+    Chọn ngữ liệu đưa vào prompt: bỏ chunk trùng giữa dữ liệu cá nhân và corpus chung, xếp theo điểm
+    (tùy chọn MMR để tránh các chunk gần giống nhau), rồi lấy lần lượt cho tới khi hết ngân sách token.
+    """
+
+    def __init__(self, budget: int = CONTEXT_TOKEN_BUDGET, mmr_lambda: float = MMR_LAMBDA,
+                 overhead: int = CHUNK_OVERHEAD_TOKENS):
+        self.budget = budget
+        self.mmr_lambda = mmr_lambda
+        self.overhead = overhead
+
+    def assemble(self, chunks) -> AssembledContext:
+        candidates = [as_candidate(c) for c in chunks]
+        unique = self._dedupe(candidates)
+        ordered = self._order(unique)
+
+        selected, used, truncated = [], 0, 0
+        candidate_tokens = 0
+        for candidate in ordered:
+            tokens = count_tokens(candidate.text) + self.overhead
+            candidate_tokens += tokens
+            if not self.budget or used + tokens <= self.budget:
+                selected.append(candidate.text)
+                used += tokens
+            elif not selected:
+                # Chunk liên quan nhất dài hơn cả ngân sách: cắt bớt thay vì bỏ trống ngữ liệu
+                text = truncate_tokens(candidate.text, self.budget - self.overhead)
+                if text:
+                    selected.append(text)
+                    used += count_tokens(text) + self.overhead
+                    truncated += 1
+        metrics = {
+            'candidates': len(candidates),
+            'duplicates': len(candidates) - len(unique),
+            'selected': len(selected),
+            'dropped': len(unique) - len(selected),
+            'truncated': truncated,
+            'candidate_tokens': candidate_tokens,
+            'context_tokens': used,
+            'budget': self.budget,
+        }
+        return AssembledContext(selected, metrics)
+
+    @staticmethod
+    def _dedupe(candidates: List[ContextCandidate]) -> List[ContextCandidate]:
+        """Chunk trùng nội dung (bỏ qua khoảng trắng) chỉ giữ một, với điểm cao nhất"""
+        unique = {}
+        for candidate in candidates:
+            key = content_hash(' '.join(candidate.text.split()))
+            kept = unique.get(key)
+            if kept is None:
+                unique[key] = candidate
+            elif candidate.score is not None and (kept.score is None or candidate.score > kept.score):
+                unique[key] = candidate
+        return list(unique.values())
+
+    def _order(self, candidates: List[ContextCandidate]) -> List[ContextCandidate]:
+        scored = all(c.score is not None for c in candidates)
+        if scored:
+            candidates = sorted(candidates, key=lambda c: c.score, reverse=True)
+        if self.mmr_lambda >= 1.0 or len(candidates) < 3 or any(c.vector is None for c in candidates):
+            return candidates
+        if scored:
+            relevance = np.asarray([c.score for c in candidates], dtype=np.float32)
+        else:
+            # Không có điểm: độ liên quan giảm dần theo thứ tự truy hồi
+            relevance = 1.0 - np.arange(len(candidates), dtype=np.float32) / len(candidates)
+        return [candidates[i] for i in mmr_order(np.stack([c.vector for c in candidates]), relevance,
+                                                 self.mmr_lambda)]
+
+
+def mmr_order(vectors: np.ndarray, relevance: np.ndarray, mmr_lambda: float) -> List[int]:
+    """
+    Thứ tự Maximal Marginal Relevance: mỗi bước chọn chunk có
+    lambda * liên quan - (1 - lambda) * (cosine lớn nhất với các chunk đã chọn).
+    Ma trận cosine giữa các ứng viên tính một lần, mỗi bước chỉ là vài phép toán trên vector.
+    """
+    vectors = normalize_rows(np.asarray(vectors, dtype=np.float32))
+    similarity = vectors @ vectors.T
+    count = len(relevance)
+    redundancy = np.zeros(count, dtype=np.float32)
+    remaining = np.ones(count, dtype=bool)
+    order = []
+    for _ in range(count):
+        gain = np.where(remaining, mmr_lambda * relevance - (1 - mmr_lambda) * redundancy, -np.inf)
+        best = int(np.argmax(gain))
+        order.append(best)
+        remaining[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return order
+
+
+class ContextStats:
+    """Số token prompt của từng request (tổng / lớn nhất / gần nhất) và số chunk bị bỏ do trùng / hết ngân sách"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def record(self, metrics: dict, prompt_tokens: int):
+        with self._lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.max_prompt_tokens = max(self.max_prompt_tokens, prompt_tokens)
+            self.context_tokens += metrics['context_tokens']
+            self.candidate_tokens += metrics['candidate_tokens']
+            self.duplicates += metrics['duplicates']
+            self.dropped += metrics['dropped']
+            self.truncated += metrics['truncated']
+            self.last = dict(metrics, prompt_tokens=prompt_tokens)
+
+    def clear(self):
+        with self._lock:
+            self.requests = 0
+            self.prompt_tokens = 0
+            self.max_prompt_tokens = 0
+            self.context_tokens = 0
+            self.candidate_tokens = 0
+            self.duplicates = 0
+            self.dropped = 0
+            self.truncated = 0
+            self.last: Optional[dict] = None
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'avg_prompt_tokens': round(self.prompt_tokens / self.requests, 1) if self.requests else 0.0,
+            'max_prompt_tokens': self.max_prompt_tokens,
+            'avg_context_tokens': round(self.context_tokens / self.requests, 1) if self.requests else 0.0,
+            # Token ngữ liệu tiết kiệm được so với ghép nguyên văn mọi chunk (đã bỏ trùng)
+            'saved_context_tokens': self.candidate_tokens - self.context_tokens,
+            'duplicates': self.duplicates,
+            'dropped': self.dropped,
+            'truncated': self.truncated,
+            'last': self.last,
+        }
+
+
+# Thống kê mặc định của process
+context_stats = ContextStats()
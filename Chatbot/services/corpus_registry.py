@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from .vector_store import VectorStore, load_vector_store, store_fingerprint
+from . import tracing
+
+load_dotenv()
+
+# Khoảng thời gian tối thiểu (giây) giữa hai lần kiểm tra file index trên đĩa
+CHECK_INTERVAL = float(os.getenv("RAG_INDEX_CHECK_INTERVAL", "2.0"))
+
+
+class _Entry:
+    def __init__(self, store: Optional[VectorStore], fingerprint, load_seconds: float):
+        self.store = store
+        self.fingerprint = fingerprint
+        self.load_seconds = load_seconds
+        self.loaded_at = time.time()
+        self.checked_at = time.monotonic()
+        self.reloads = 0
+
+
+class CorpusRegistry:
+    """
+    Registry dùng chung trong một worker process: mỗi corpus chỉ load một lần,
+    tự load lại khi file index đổi mtime hoặc sang phiên bản mới (manifest mới).
+    """
+
+    def __init__(self, check_interval: float = CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> Optional[VectorStore]:
+        entry = self._entries.get(path)
+        if entry is not None and time.monotonic() - entry.checked_at < self.check_interval:
+            return entry.store
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and time.monotonic() - entry.checked_at < self.check_interval:
+                return entry.store
+
+            fingerprint = store_fingerprint(path)
+            if entry is not None and entry.fingerprint == fingerprint:
+                entry.checked_at = time.monotonic()
+                return entry.store
+
+            started = time.perf_counter()
+            store = None
+            if fingerprint is not None:
+                try:
+                    with tracing.span("corpus.load"):
+                        store = load_vector_store(path)
+                except Exception as e:
+                    print(f"Lỗi khi load corpus {path}: {e}")
+                    if entry is not None:
+                        # Giữ phiên bản cũ nếu phiên bản mới lỗi, thử lại ở lần kiểm tra sau
+                        entry.checked_at = time.monotonic()
+                        return entry.store
+            load_seconds = time.perf_counter() - started
+
+            new_entry = _Entry(store, fingerprint, load_seconds)
+            if entry is not None:
+                new_entry.reloads = entry.reloads + 1
+            self._entries[path] = new_entry
+            if store is not None:
+                print(
+                    f"Đã load corpus {path}: {len(store)} chunks, "
+                    f"phiên bản {store.index_version}, {load_seconds * 1000:.1f} ms"
+                )
+            return store
+
+    def invalidate(self, path: str = None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def stats(self) -> dict:
+        """Thời gian load và dung lượng bộ nhớ của từng corpus đã load"""
+        result = {}
+        for path, entry in list(self._entries.items()):
+            store = entry.store
+            result[path] = {
+                'loaded': store is not None,
+                'chunks': len(store) if store is not None else 0,
+                'index_version': store.index_version if store is not None else None,
+                'load_ms': round(entry.load_seconds * 1000, 3),
+                'loaded_at': entry.loaded_at,
+                'reloads': entry.reloads,
+                'nbytes': store.nbytes if store is not None else 0,
+                'memory_mapped': isinstance(store.vectors, np.memmap) if store is not None else False,
+                'quantization': store.quantizer.type if store is not None and store.quantizer is not None else None,
+                'lexical': store.lexical.type if store is not None and store.lexical is not None else None,
+                'chunk_metadata': store.metadata_index is not None if store is not None else False,
+                'chunk_table': getattr(store, 'chunk_table', None) is not None,
+                'deleted_chunks': getattr(store, 'deleted_count', 0) if store is not None else 0,
+            }
+        return result
+
+
+# Registry mặc định của process
+corpus_registry = CorpusRegistry()
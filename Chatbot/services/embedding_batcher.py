@@ -0,0 +1,231 @@
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence
+
+import openai
+from dotenv import load_dotenv
+
+from .chunk_table import count_tokens
+
+load_dotenv()
+
+# Số chunk tối đa mỗi request embed_documents (OpenAI nhận tối đa 2048 input / request)
+EMBED_BATCH_SIZE = int(os.getenv("RAG_EMBED_BATCH_SIZE", "256"))
+# Tổng token tối đa mỗi request (OpenAI giới hạn 300k token / request, để dư cho sai số đếm)
+EMBED_BATCH_TOKENS = int(os.getenv("RAG_EMBED_BATCH_TOKENS", "100000"))
+# Số lô embed chạy đồng thời
+EMBED_WORKERS = int(os.getenv("RAG_EMBED_WORKERS", "1"))
+# Giới hạn request / token mỗi phút của tài khoản embedding (0 = không giới hạn)
+EMBED_RPM = int(os.getenv("RAG_EMBED_RPM", "0"))
+EMBED_TPM = int(os.getenv("RAG_EMBED_TPM", "0"))
+# Thử lại khi gặp 429 / 5xx / lỗi kết nối: backoff lũy thừa (giây) với jitter
+EMBED_MAX_RETRIES = int(os.getenv("RAG_EMBED_MAX_RETRIES", "6"))
+EMBED_BACKOFF_BASE = float(os.getenv("RAG_EMBED_BACKOFF_BASE", "1.0"))
+EMBED_BACKOFF_MAX = float(os.getenv("RAG_EMBED_BACKOFF_MAX", "60.0"))
+
+_RETRYABLE_ERRORS = (openai.APIConnectionError, openai.APITimeoutError)
+
+
+def plan_batches(token_counts: Sequence[int], max_items: int = EMBED_BATCH_SIZE,
+                 max_tokens: int = EMBED_BATCH_TOKENS) -> List[List[int]]:
+    """
+    Chia các chunk (theo thứ tự) thành lô không quá max_items chunk và max_tokens token.
+    Chunk dài hơn cả max_tokens đứng riêng một lô.
+    """
+    batches, current, current_tokens = [], [], 0
+    for index, tokens in enumerate(token_counts):
+        if current and (len(current) >= max_items or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(index)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def is_retryable(error: Exception) -> bool:
+    """429 (rate limit), lỗi 5xx của server và lỗi kết nối / timeout: thử lại; lỗi khác: lô bị từ chối"""
+    if isinstance(error, _RETRYABLE_ERRORS):
+        return True
+    status = getattr(error, 'status_code', None)
+    return status == 429 or (isinstance(status, int) and status >= 500)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Số giây server yêu cầu chờ (header Retry-After), None nếu không có"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base: float = EMBED_BACKOFF_BASE, cap: float = EMBED_BACKOFF_MAX,
+                  rng: random.Random = random) -> float:
+    """Full jitter: ngẫu nhiên trong [0, min(cap, base * 2^attempt)] để các worker không thử lại cùng lúc"""
+    return rng.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class TokenBucket:
+    """
+    Token bucket dùng chung giữa các thread: nạp lại rate_per_minute / 60 mỗi giây, chứa tối đa capacity
+    (mặc định một phút). Lượng lớn hơn phần còn lại vẫn được cấp nhưng người gọi chờ tới khi bù đủ.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1) -> float:
+        """Lấy amount token, chờ nếu cần; trả về số giây đã chờ"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+class RateLimiter:
+    """Giới hạn requests-per-minute và tokens-per-minute (0 = không giới hạn)"""
+
+    def __init__(self, rpm: int = EMBED_RPM, tpm: int = EMBED_TPM, **options):
+        self.requests = TokenBucket(rpm, **options) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm, **options) if tpm > 0 else None
+
+    def acquire(self, tokens: int) -> float:
+        waited = 0.0
+        if self.requests is not None:
+            waited += self.requests.acquire(1)
+        if self.tokens is not None:
+            waited += self.tokens.acquire(tokens)
+        return waited
+
+
+class EmbeddingBatcher:
+    """
+    Embed nhiều chunk qua embed_documents theo lô thay vì mỗi chunk một request, tối đa workers lô
+    chạy đồng thời qua thread pool, cùng một RateLimiter. Lỗi 429 / 5xx được thử lại với backoff; lô bị
+    provider từ chối (quá nhiều token, input lỗi...) được chia đôi và gửi lại, chunk lẻ vẫn lỗi thì trả
+    None như khi embed từng chunk. Kết quả luôn theo đúng thứ tự đầu vào.
+    """
+
+    def __init__(self, embeddings_model, max_items: int = EMBED_BATCH_SIZE, max_tokens: int = EMBED_BATCH_TOKENS,
+                 log: Callable[[str], None] = print, workers: int = EMBED_WORKERS,
+                 rate_limiter: Optional[RateLimiter] = None, max_retries: int = EMBED_MAX_RETRIES,
+                 backoff_base: float = EMBED_BACKOFF_BASE, backoff_max: float = EMBED_BACKOFF_MAX,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.embeddings_model = embeddings_model
+        self.max_items = max(1, max_items)
+        self.max_tokens = max(1, max_tokens)
+        self.log = log
+        self.workers = max(1, workers)
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self.chunks = 0
+        self.tokens = 0
+        self.requests = 0
+        self.retries = 0
+        self.splits = 0
+        self.failed = 0
+        self.throttled_seconds = 0.0
+        self.seconds = 0.0
+
+    def embed(self, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """Vector của từng text, cùng thứ tự (None với chunk không embed được)"""
+        started = time.perf_counter()
+        token_counts = [count_tokens(text) for text in texts]
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        batches = plan_batches(token_counts, self.max_items, self.max_tokens)
+        if self.workers == 1 or len(batches) <= 1:
+            for batch in batches:
+                self._embed_batch(texts, token_counts, batch, results)
+        else:
+            # Mỗi lô ghi vào các vị trí riêng của results nên thứ tự không phụ thuộc lô nào xong trước
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='embed') as pool:
+                futures = [pool.submit(self._embed_batch, texts, token_counts, batch, results) for batch in batches]
+                for future in futures:
+                    future.result()
+        self.seconds += time.perf_counter() - started
+        return results
+
+    def _embed_batch(self, texts, token_counts, batch: List[int], results: list):
+        try:
+            vectors = self._request([texts[i] for i in batch], sum(token_counts[i] for i in batch))
+            if len(vectors) != len(batch):
+                raise ValueError(f"Provider trả {len(vectors)} vector cho {len(batch)} chunk")
+        except Exception as e:
+            if len(batch) == 1 or is_retryable(e):
+                # Đã hết lượt thử lại (rate limit / server lỗi kéo dài): chia nhỏ lô cũng không giúp được
+                with self._lock:
+                    self.failed += len(batch)
+                self.log(f"Lỗi khi tạo embedding OpenAI: {e}")
+                return
+            # Chia đôi lô bị từ chối để chỉ chunk lỗi bị bỏ
+            with self._lock:
+                self.splits += 1
+            middle = len(batch) // 2
+            self._embed_batch(texts, token_counts, batch[:middle], results)
+            self._embed_batch(texts, token_counts, batch[middle:], results)
+            return
+        for i, vector in zip(batch, vectors):
+            results[i] = list(vector)
+        with self._lock:
+            self.chunks += len(batch)
+            self.tokens += sum(token_counts[i] for i in batch)
+
+    def _request(self, batch_texts: List[str], tokens: int):
+        """Một request embed_documents qua rate limiter, thử lại lỗi tạm thời với backoff + jitter"""
+        attempt = 0
+        while True:
+            waited = self.rate_limiter.acquire(tokens)
+            with self._lock:
+                self.requests += 1
+                self.throttled_seconds += waited
+            try:
+                return self.embeddings_model.embed_documents(batch_texts)
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = retry_after(e) or backoff_delay(attempt, self.backoff_base, self.backoff_max)
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                    self.throttled_seconds += delay
+                self.log(f"⚠️ Embedding bị giới hạn / lỗi tạm thời ({e}), thử lại lần {attempt} sau {delay:.1f}s")
+                self.sleep(delay)
+
+    def report(self) -> dict:
+        return {
+            'chunks': self.chunks,
+            'tokens': self.tokens,
+            'requests': self.requests,
+            'retries': self.retries,
+            'splits': self.splits,
+            'failed': self.failed,
+            'workers': self.workers,
+            'throttled_seconds': round(self.throttled_seconds, 3),
+            'seconds': round(self.seconds, 3),
+            'chunks_per_s': round(self.chunks / self.seconds, 1) if self.seconds else 0.0,
+            'tokens_per_s': round(self.tokens / self.seconds, 1) if self.seconds else 0.0,
+        }
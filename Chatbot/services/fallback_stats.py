@@ -0,0 +1,57 @@
+import threading
+
+
+class FallbackStats:
+    """
+    Đếm số lần câu trả lời dựa trên ngữ liệu bị loại và phải dùng câu trả lời tổng quát,
+    cùng thời gian chờ mà chế độ sinh song song (speculative) tiết kiệm được so với sinh lại tuần tự.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def record(self, fallback: bool, speculative: bool, grounded_seconds: float = 0.0,
+               fallback_seconds: float = 0.0, wall_seconds: float = 0.0, cancelled: bool = False):
+        """
+        grounded_seconds / fallback_seconds: thời gian của từng lần gọi,
+        wall_seconds: thời gian người dùng thực sự phải chờ cho cả hai.
+        """
+        with self._lock:
+            self.answers += 1
+            if speculative:
+                self.speculative += 1
+            if cancelled:
+                self.cancelled += 1
+            if fallback:
+                self.fallbacks += 1
+                self.fallback_seconds += fallback_seconds
+                if speculative:
+                    # Tuần tự sẽ tốn grounded + fallback, song song chỉ tốn wall
+                    self.saved_seconds += max(0.0, grounded_seconds + fallback_seconds - wall_seconds)
+
+    def clear(self):
+        with self._lock:
+            self.answers = 0
+            self.fallbacks = 0
+            self.speculative = 0
+            self.cancelled = 0
+            self.fallback_seconds = 0.0
+            self.saved_seconds = 0.0
+
+    def stats(self) -> dict:
+        return {
+            'answers': self.answers,
+            'fallbacks': self.fallbacks,
+            'fallback_rate': round(self.fallbacks / self.answers, 4) if self.answers else 0.0,
+            'speculative': self.speculative,
+            'cancelled': self.cancelled,
+            # Tổng thời gian các lần sinh lại tổng quát (chế độ tuần tự: đúng bằng độ trễ cộng thêm)
+            'fallback_seconds': round(self.fallback_seconds, 3),
+            'saved_seconds': round(self.saved_seconds, 3),
+            'saved_ms_per_fallback': round(1000 * self.saved_seconds / self.fallbacks, 1) if self.fallbacks else 0.0,
+        }
+
+
+# Thống kê mặc định của process
+fallback_stats = FallbackStats()
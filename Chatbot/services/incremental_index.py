@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import uuid
+from collections import namedtuple
+from typing import Dict, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from .chunk_table import SOURCE_MODELS, UNKNOWN_SOURCE, count_tokens
+from .vector_store import (
+    VectorStore, WRITE_BLOCK_ROWS, append_to_vector_store, read_source_hashes, write_vector_store,
+)
+
+load_dotenv()
+
+# Tỷ lệ dòng đã xóa (tombstone) trên tổng số dòng để tự nén kho khi build tăng dần
+COMPACT_RATIO = float(os.getenv("RAG_COMPACT_RATIO", "0.2"))
+# Định dạng hash nguồn (2 = nội dung + metadata lọc); kho ghi theo định dạng khác phải build lại toàn bộ
+SOURCE_HASH_VERSION = 2
+
+# Một File / Post / Comment có nội dung: key "<model>:<pk>", hash nội dung, metadata lọc, các (chunk, vị trí)
+SourceDocument = namedtuple('SourceDocument', ['key', 'model', 'pk', 'hash', 'metadata', 'chunks'])
+# Kết quả so sánh nguồn hiện tại với lần build trước (tập các key)
+IndexDelta = namedtuple('IndexDelta', ['new', 'changed', 'deleted', 'unchanged'])
+
+
+def source_key(model: str, pk) -> str:
+    return f"{model}:{int(pk)}"
+
+
+def source_hash(text: str, metadata: Optional[dict] = None) -> str:
+    """Hash nội dung + metadata lọc: đổi danh mục / trạng thái cũng tính là nguồn đã sửa"""
+    payload = (text or '') + '\0' + json.dumps(metadata or {}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def source_info(hashes: Dict[str, str], chunk_size: int) -> dict:
+    """Mục sources cho write_vector_store: hash nguồn + tham số build cần khớp ở lần build tăng dần sau"""
+    return {'hashes': hashes, 'chunk_size': chunk_size, 'hash_version': SOURCE_HASH_VERSION}
+
+
+def diff_sources(previous: Dict[str, str], current: Dict[str, str]) -> IndexDelta:
+    new = {key for key in current if key not in previous}
+    changed = {key for key in current if key in previous and previous[key] != current[key]}
+    deleted = {key for key in previous if key not in current}
+    unchanged = set(current) - new - changed
+    return IndexDelta(new, changed, deleted, unchanged)
+
+
+def incremental_unavailable_reason(store: Optional[VectorStore], chunk_size: int,
+                                   embedding_model: str) -> Optional[str]:
+    """Lý do phải build lại toàn bộ thay vì tăng dần (None = build tăng dần được)"""
+    if store is None or not isinstance(store, VectorStore) or 'files' not in store.manifest:
+        return "chưa có kho vector"
+    sources = store.manifest.get('sources')
+    if not sources or store.chunk_table is None:
+        return "kho vector chưa ghi hash nguồn"
+    if sources.get('hash_version') != SOURCE_HASH_VERSION:
+        return "hash nguồn theo định dạng cũ (chưa gồm metadata lọc)"
+    if sources.get('chunk_size') != chunk_size:
+        return f"--chunk-size khác lần build trước ({sources.get('chunk_size')})"
+    previous_model = (store.manifest.get('metadata') or {}).get('embedding_model')
+    if previous_model != embedding_model:
+        return f"model embedding khác lần build trước ({previous_model})"
+    return None
+
+
+def previous_source_hashes(store: VectorStore) -> Dict[str, str]:
+    return read_source_hashes(store.path, store.manifest) or {}
+
+
+def update_vector_store(path: str, store: VectorStore, unchanged, chunks: List[str], embeddings,
+                        chunk_sources: List[tuple], chunk_metadata: List[dict], source_hashes: Dict[str, str],
+                        chunk_size: int, compact_ratio: float = COMPACT_RATIO, compact: bool = False,
+                        metadata: Optional[dict] = None, **write_options) -> dict:
+    """
+    Phiên bản mới của kho từ phiên bản trước: dòng của nguồn không đổi giữ nguyên (không embed lại),
+    chunk của nguồn mới / đã sửa nối vào cuối. Dòng của nguồn đã sửa / đã xóa vẫn nằm trong kho nhưng được
+    đánh tombstone (loại khi truy hồi), nên số dòng của chunk cũ không đổi. Bình thường chỉ nối thêm
+    (xem append_to_vector_store); khi tỷ lệ tombstone đạt compact_ratio (hoặc compact=True) hay
+    write_options khác cấu hình hiện tại thì ghi lại cả kho: bỏ hẳn dòng đã xóa, build lại ANN / mã nén / BM25.
+    chunk_metadata: metadata lọc của từng chunk mới; write_options (dtype, ann, quantization, ...) mặc định
+    lấy theo manifest hiện tại.
+    """
+    table = store.chunk_table
+    keep = table.source_rows(unchanged)
+    if store.live_mask is not None:
+        keep &= store.live_mask
+    deleted = int(len(store) - np.count_nonzero(keep))
+    total = len(store) + len(chunks)
+    sources = source_info(source_hashes, chunk_size)
+    current = write_options_from_manifest(store.manifest)
+    requested = dict(current, **write_options)
+    has_metadata = store.metadata_index is not None or not len(store)
+    if (compact or (total and deleted / total >= compact_ratio) or _options_changed(current, requested)
+            or not has_metadata):
+        return _rewrite(path, store, np.flatnonzero(keep), chunks, embeddings, chunk_sources, chunk_metadata,
+                        sources, metadata, **requested)
+    tombstones = np.concatenate([~keep, np.zeros(len(chunks), dtype=bool)])
+    return append_to_vector_store(path, store, chunks, embeddings, chunk_metadata=chunk_metadata,
+                                  chunk_sources=chunk_sources, tombstones=tombstones, sources=sources,
+                                  metadata=metadata)
+
+
+def compact_vector_store(path: str, store: Optional[VectorStore] = None) -> dict:
+    """
+    Bỏ hẳn các dòng đã đánh tombstone (không cần DB hay embed lại): metadata lấy lại từ bitmap,
+    số token từ bảng chunk, ANN / mã nén / BM25 build lại với cùng tham số của phiên bản hiện tại.
+    """
+    store = store or VectorStore.open(path)
+    if store.live_mask is None:
+        return store.manifest
+    sources = store.manifest.get('sources')
+    if sources:
+        sources = dict({k: v for k, v in sources.items() if k not in ('count', 'files')},
+                       hashes=read_source_hashes(path, store.manifest))
+    return _rewrite(path, store, np.flatnonzero(store.live_mask), [], np.zeros((0, store.dim), dtype=np.float32),
+                    [], [], sources, store.manifest.get('metadata'), **write_options_from_manifest(store.manifest))
+
+
+def write_options_from_manifest(manifest: dict) -> dict:
+    """Tham số build (dtype, ANN, nén, BM25) của một phiên bản, để ghi lại kho với cùng cấu hình"""
+    ann = manifest.get('ann') or {}
+    quantization = manifest.get('quantization') or {}
+    quantization_options = {k: quantization[k] for k in ('m', 'dims') if k in quantization}
+    return {
+        'dtype': manifest.get('dtype', 'float32'),
+        'ann': ann.get('type'),
+        'ann_options': {'n_lists': ann.get('n_lists')} if ann else None,
+        'quantization': quantization.get('type'),
+        'quantization_options': quantization_options or None,
+        'lexical': (manifest.get('lexical') or {}).get('type'),
+    }
+
+
+def _options_changed(current: dict, requested: dict) -> bool:
+    """Cấu hình yêu cầu khác phiên bản hiện tại (tham số None = giữ như cũ, 'none' = không dùng)"""
+    for key in ('dtype', 'ann', 'quantization', 'lexical'):
+        if (requested.get(key) or 'none') != (current.get(key) or 'none'):
+            return True
+    for key in ('ann_options', 'quantization_options'):
+        have = current.get(key) or {}
+        if any(value is not None and have.get(name) != value for name, value in (requested.get(key) or {}).items()):
+            return True
+    return False
+
+
+def _rewrite(path: str, store: VectorStore, rows: np.ndarray, chunks: List[str], embeddings,
+             chunk_sources: List[tuple], chunk_metadata: List[dict], sources: Optional[dict],
+             metadata: Optional[dict] = None, dtype: str = 'float32', **write_options) -> dict:
+    """
+    Ghi lại cả kho = các dòng `rows` của kho cũ (theo thứ tự) + các chunk mới (nén / đổi cấu hình):
+    metadata dòng cũ lấy từ bitmap, số token từ bảng chunk, ANN / mã nén / BM25 build lại từ đầu.
+    """
+    table = store.chunk_table
+    new_vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(chunks), -1) if len(chunks) else None
+    old_rows = table.rows[rows]
+    texts = [store.chunks[int(index)] for index in rows] + list(chunks)
+    all_sources = [
+        (SOURCE_MODELS[int(row['source'])],
+         None if int(row['source_id']) == UNKNOWN_SOURCE else int(row['source_id']), int(row['offset']))
+        for row in old_rows
+    ] + list(chunk_sources)
+    all_versions = [table.versions[int(v)] for v in old_rows['version']] + [None] * len(chunks)
+    all_tokens = np.concatenate([old_rows['tokens'], np.asarray([count_tokens(c) for c in chunks], dtype=np.int64)])
+    has_metadata = store.metadata_index is not None or len(chunks) > 0
+    all_metadata = None
+    if has_metadata:
+        metadata_index = store.metadata_index
+        all_metadata = [
+            metadata_index.chunk_metadata(int(index)) if metadata_index is not None
+            else {'source_type': model, 'source_id': pk}
+            for index, (model, pk, _) in zip(rows, all_sources)
+        ] + list(chunk_metadata)
+
+    # Ghép vector cũ (đọc qua mmap theo khối) và vector mới vào file tạm, không nạp cả ma trận vào RAM
+    tmp_path = os.path.join(path, f".incremental-{uuid.uuid4().hex[:8]}.npy")
+    dim = store.dim or (new_vectors.shape[1] if new_vectors is not None else 0)
+    combined = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(len(texts), dim))
+    try:
+        for start in range(0, len(rows), WRITE_BLOCK_ROWS):
+            block = rows[start:start + WRITE_BLOCK_ROWS]
+            combined[start:start + len(block)] = store.vectors[block]
+        if new_vectors is not None:
+            combined[len(rows):] = new_vectors
+        combined.flush()
+        return write_vector_store(
+            path, texts, combined, dtype=dtype, metadata=metadata, chunk_metadata=all_metadata,
+            chunk_sources=all_sources, chunk_versions=all_versions, sources=sources, chunk_tokens=all_tokens,
+            **write_options
+        )
+    finally:
+        del combined
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
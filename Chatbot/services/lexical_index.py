@@ -0,0 +1,271 @@
+import json
+import os
+import re
+import unicodedata
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from . import retrieval
+
+# Tham số BM25 chuẩn
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Tiền tố của term đã bỏ dấu ("định" -> "~dinh"): câu hỏi gõ không dấu vẫn khớp chunk có dấu
+FOLDED_PREFIX = "~"
+# Hằng số của reciprocal rank fusion khi trộn kết quả dense và BM25
+RRF_K = 60
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+@lru_cache(maxsize=65536)
+def fold_diacritics(text: str) -> str:
+    """Bỏ dấu tiếng Việt: tách dấu (NFD), bỏ các ký tự dấu, đ -> d"""
+    decomposed = unicodedata.normalize('NFD', text)
+    stripped = ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return stripped.replace('đ', 'd').replace('Đ', 'D')
+
+
+def tokenize(text: str) -> List[str]:
+    """Token theo âm tiết (tiếng Việt viết tách âm tiết bằng khoảng trắng), chữ thường, NFC"""
+    return _TOKEN_RE.findall(unicodedata.normalize('NFC', text or '').lower())
+
+
+def document_terms(text: str) -> List[str]:
+    """Mỗi token được đánh chỉ mục hai lần: nguyên dạng có dấu và dạng đã bỏ dấu (có tiền tố)"""
+    terms = []
+    for token in tokenize(text):
+        terms.append(token)
+        terms.append(FOLDED_PREFIX + fold_diacritics(token))
+    return terms
+
+
+def query_terms(text: str) -> List[str]:
+    """
+    Token có dấu chỉ khớp đúng dạng có dấu (phân biệt "má" / "mà"),
+    token không dấu khớp mọi biến thể dấu (người dùng gõ không dấu).
+    """
+    terms = []
+    for token in tokenize(text):
+        folded = fold_diacritics(token)
+        terms.append(token if folded != token else FOLDED_PREFIX + folded)
+    return list(dict.fromkeys(terms))
+
+
+# -------- Varint (LEB128) cho posting list --------
+def varint_lengths(values) -> np.ndarray:
+    """Số byte varint của từng số"""
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        lengths += values >= np.uint64(1 << shift)
+    return lengths
+
+
+def varint_encode(values) -> np.ndarray:
+    """Mã hóa dãy số nguyên không âm thành bytes: 7 bit mỗi byte, bit cao = còn byte tiếp"""
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = varint_lengths(values)
+    starts = np.cumsum(lengths) - lengths
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for k in range(int(lengths.max()) if len(values) else 0):
+        mask = lengths > k
+        byte = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (lengths[mask] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[mask] + k] = (byte | more).astype(np.uint8)
+    return out
+
+
+def varint_decode(buffer) -> np.ndarray:
+    """Giải mã toàn bộ buffer varint (vector hóa, không vòng lặp Python theo từng số)"""
+    data = np.asarray(buffer, dtype=np.uint8)
+    if len(data) == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = data < 0x80
+    group = np.empty(len(data), dtype=np.int64)
+    group[0] = 0
+    np.cumsum(ends[:-1], out=group[1:])
+    group_starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    position = np.arange(len(data)) - group_starts[group]
+    parts = (data & 0x7F).astype(np.float64) * np.exp2(7 * position)
+    return np.rint(np.bincount(group, weights=parts)).astype(np.int64)
+
+
+class BM25Index:
+    """
+    Chỉ mục ngược BM25 trên các chunk của kho vector.
+    Posting list của mỗi term: các cặp (khoảng cách doc_id so với doc trước, tần suất) mã hóa varint,
+    nối liền trong một buffer; term_offsets[t]:term_offsets[t+1] là đoạn bytes của term t.
+    """
+    type = "bm25"
+
+    def __init__(self, vocabulary: Dict[str, int], postings: np.ndarray, term_offsets: np.ndarray,
+                 doc_freqs: np.ndarray, doc_lengths: np.ndarray, k1: float = BM25_K1, b: float = BM25_B):
+        self.vocabulary = vocabulary
+        self.postings = postings
+        self.term_offsets = term_offsets
+        self.doc_freqs = doc_freqs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        count = len(doc_lengths)
+        self.avgdl = float(doc_lengths.mean()) if count else 0.0
+        # idf kiểu Lucene (luôn dương)
+        self.idf = np.log1p((count - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        # Phần mẫu số chỉ phụ thuộc độ dài chunk: tính sẵn một lần
+        self._length_norm = (k1 * (1 - b + b * doc_lengths / max(self.avgdl, 1e-9))).astype(np.float32)
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.postings.nbytes + self.term_offsets.nbytes + self.doc_freqs.nbytes
+                   + self.doc_lengths.nbytes + self.idf.nbytes + self._length_norm.nbytes)
+
+    @classmethod
+    def build(cls, chunks, k1: float = BM25_K1, b: float = BM25_B) -> 'BM25Index':
+        vocabulary: Dict[str, int] = {}
+        term_ids, doc_ids, freqs, doc_lengths = _count_terms(chunks, vocabulary)
+        return cls._from_postings(vocabulary, term_ids, doc_ids, freqs, doc_lengths, k1, b)
+
+    def extend(self, chunks) -> 'BM25Index':
+        """
+        Chỉ mục sau khi nối thêm chunk: posting cũ được giải mã (vector hóa), chỉ tách từ các chunk mới.
+        """
+        vocabulary = dict(self.vocabulary)
+        old_terms, old_docs, old_freqs = self._all_postings()
+        term_ids, doc_ids, freqs, doc_lengths = _count_terms(chunks, vocabulary, first_doc=len(self))
+        return self._from_postings(
+            vocabulary, np.concatenate([old_terms, term_ids]), np.concatenate([old_docs, doc_ids]),
+            np.concatenate([old_freqs, freqs]), np.concatenate([np.asarray(self.doc_lengths), doc_lengths]),
+            self.k1, self.b,
+        )
+
+    def _all_postings(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(term_id, doc_id, tần suất) của mọi posting, theo thứ tự term"""
+        values = varint_decode(self.postings)
+        gaps, freqs = values[0::2], values[1::2]
+        counts = np.asarray(self.doc_freqs, dtype=np.int64)
+        term_ids = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+        # doc_id = tổng các khoảng cách tính từ đầu posting list của term
+        running = np.cumsum(gaps)
+        starts = np.cumsum(counts) - counts
+        base = np.zeros(len(counts), dtype=np.int64)
+        present = counts > 0
+        base[present] = running[starts[present]] - gaps[starts[present]]
+        return term_ids, running - np.repeat(base, counts), freqs
+
+    @classmethod
+    def _from_postings(cls, vocabulary: Dict[str, int], term_ids: np.ndarray, doc_ids: np.ndarray,
+                       freqs: np.ndarray, doc_lengths: np.ndarray, k1: float, b: float) -> 'BM25Index':
+        order = np.lexsort((doc_ids, term_ids))
+        term_ids, doc_ids, freqs = term_ids[order], doc_ids[order], freqs[order]
+
+        n_terms = len(vocabulary)
+        doc_freqs = np.bincount(term_ids, minlength=n_terms).astype(np.int32)
+        first = np.zeros(n_terms + 1, dtype=np.int64)
+        first[1:] = np.cumsum(doc_freqs)
+        # doc_id lưu dạng khoảng cách trong cùng một term (số nhỏ -> ít byte)
+        gaps = doc_ids.copy()
+        gaps[1:] -= doc_ids[:-1]
+        gaps[first[:-1][doc_freqs > 0]] = doc_ids[first[:-1][doc_freqs > 0]]
+
+        stream = np.empty(2 * len(gaps), dtype=np.int64)
+        stream[0::2] = gaps
+        stream[1::2] = freqs
+        lengths = varint_lengths(stream)
+        pair_bytes = lengths[0::2] + lengths[1::2]
+        byte_offsets = np.zeros(len(pair_bytes) + 1, dtype=np.int64)
+        byte_offsets[1:] = np.cumsum(pair_bytes)
+        term_offsets = byte_offsets[first]
+        return cls(vocabulary, varint_encode(stream), term_offsets, doc_freqs, doc_lengths, k1, b)
+
+    def _postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = int(self.term_offsets[term_id]), int(self.term_offsets[term_id + 1])
+        values = varint_decode(self.postings[start:end])
+        return np.cumsum(values[0::2]), values[1::2]
+
+    def scores(self, query: str) -> np.ndarray:
+        """Điểm BM25 của mọi chunk (0 với chunk không chứa term nào của câu hỏi)"""
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in query_terms(query):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            docs, freqs = self._postings(term_id)
+            freqs = freqs.astype(np.float32)
+            # Mỗi doc xuất hiện một lần trong posting list nên cộng trực tiếp được
+            scores[docs] += self.idf[term_id] * freqs * (self.k1 + 1) / (freqs + self._length_norm[docs])
+        return scores
+
+    def search(self, query: str, top_k: int, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        scores = self.scores(query)
+        if mask is not None:
+            scores[~mask] = 0
+        indices = retrieval.top_k_indices(scores, top_k)
+        selected = scores[indices]
+        keep = selected > 0
+        return indices[keep], selected[keep]
+
+    def save(self, path: str, version: str) -> dict:
+        files = {
+            'vocabulary': f"bm25_vocab-{version}.json",
+            'postings': f"bm25_postings-{version}.npy",
+            'term_offsets': f"bm25_offsets-{version}.npy",
+            'doc_freqs': f"bm25_df-{version}.npy",
+            'doc_lengths': f"bm25_doclen-{version}.npy",
+        }
+        # Danh sách term theo thứ tự id
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        with open(os.path.join(path, files['vocabulary']), 'w', encoding='utf-8') as f:
+            json.dump(terms, f, ensure_ascii=False)
+        np.save(os.path.join(path, files['postings']), self.postings)
+        np.save(os.path.join(path, files['term_offsets']), self.term_offsets)
+        np.save(os.path.join(path, files['doc_freqs']), self.doc_freqs)
+        np.save(os.path.join(path, files['doc_lengths']), self.doc_lengths)
+        return {'type': self.type, 'k1': self.k1, 'b': self.b, 'terms': len(terms),
+                'postings_bytes': int(self.postings.nbytes), 'files': files}
+
+    @classmethod
+    def load(cls, path: str, info: dict) -> 'BM25Index':
+        files = info['files']
+        with open(os.path.join(path, files['vocabulary']), 'r', encoding='utf-8') as f:
+            vocabulary = {term: i for i, term in enumerate(json.load(f))}
+        return cls(
+            vocabulary,
+            np.load(os.path.join(path, files['postings']), mmap_mode='r'),
+            np.load(os.path.join(path, files['term_offsets'])),
+            np.load(os.path.join(path, files['doc_freqs'])),
+            np.load(os.path.join(path, files['doc_lengths'])),
+            info.get('k1', BM25_K1), info.get('b', BM25_B),
+        )
+
+
+def _count_terms(chunks, vocabulary: Dict[str, int], first_doc: int = 0):
+    """Tách từ các chunk (doc_id bắt đầu từ first_doc), thêm term mới vào vocabulary"""
+    term_ids, doc_ids, freqs = [], [], []
+    doc_lengths = np.zeros(len(chunks), dtype=np.int32)
+    for i, text in enumerate(chunks):
+        terms = document_terms(text)
+        # Độ dài chunk tính theo token (mỗi token sinh hai term)
+        doc_lengths[i] = len(terms) // 2
+        for term, freq in Counter(terms).items():
+            term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+            doc_ids.append(first_doc + i)
+            freqs.append(freq)
+    return (np.asarray(term_ids, dtype=np.int64), np.asarray(doc_ids, dtype=np.int64),
+            np.asarray(freqs, dtype=np.int64), doc_lengths)
+
+
+def reciprocal_rank_fusion(rankings, top_k: int, k: int = RRF_K) -> np.ndarray:
+    """Trộn nhiều danh sách chỉ số đã xếp hạng: điểm = tổng 1 / (k + hạng)"""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, index in enumerate(ranking):
+            fused[int(index)] = fused.get(int(index), 0.0) + 1.0 / (k + rank + 1)
+    ordered = sorted(fused, key=lambda i: fused[i], reverse=True)
+    return np.asarray(ordered[:top_k], dtype=np.int64)
@@ -0,0 +1,183 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Thuộc tính ít giá trị khác nhau: mỗi giá trị một bitmap nén (np.packbits, 1 bit / chunk)
+BITMAP_ATTRIBUTES = ("source_type", "status", "category_ids")
+# Thuộc tính nhiều giá trị khác nhau (mỗi tài liệu / tác giả một giá trị): lưu cột int64, so khớp bằng np.isin
+COLUMN_ATTRIBUTES = ("source_id", "author_id")
+CHUNK_ATTRIBUTES = BITMAP_ATTRIBUTES + COLUMN_ATTRIBUTES
+# Thuộc tính một chunk có thể mang nhiều giá trị (file thuộc nhiều danh mục)
+MULTI_VALUED = ("category_ids",)
+# Hậu tố loại trừ kiểu Django: {'status__not': 1}
+EXCLUDE_SUFFIX = "__not"
+MISSING = -1
+
+
+class MetadataIndex:
+    """
+    Metadata của từng chunk (loại nguồn, id nguồn, danh mục, tác giả, trạng thái) dưới dạng
+    bitmap / cột tính sẵn lúc build index. mask(filters) trả về mảng bool theo chunk để lọc
+    ứng viên trước khi chấm điểm.
+    """
+    type = "bitmap"
+
+    def __init__(self, count: int, values: Dict[str, list], bitmaps: np.ndarray, columns: np.ndarray):
+        self.count = count
+        # attribute -> danh sách giá trị; _rows[attribute][giá trị] = số dòng bitmap trong self.bitmaps
+        self.values = values
+        self.bitmaps = bitmaps
+        self.columns = columns
+        self._rows = {}
+        offset = 0
+        for attribute in BITMAP_ATTRIBUTES:
+            self._rows[attribute] = {value: offset + j for j, value in enumerate(values.get(attribute, []))}
+            offset += len(values.get(attribute, []))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.bitmaps.nbytes + self.columns.nbytes)
+
+    @classmethod
+    def build(cls, chunk_metadata: List[dict]) -> 'MetadataIndex':
+        count = len(chunk_metadata)
+        values = {}
+        members = {}
+        for attribute in BITMAP_ATTRIBUTES:
+            by_value = {}
+            for i, meta in enumerate(chunk_metadata):
+                for value in _as_values(attribute, meta.get(attribute)):
+                    by_value.setdefault(value, []).append(i)
+            values[attribute] = sorted(by_value)
+            members[attribute] = by_value
+
+        # Dựng từng bitmap một (bộ nhớ tạm O(số chunk), không phải O(số giá trị x số chunk))
+        packed = np.zeros((sum(len(v) for v in values.values()), (count + 7) // 8), dtype=np.uint8)
+        row = 0
+        for attribute in BITMAP_ATTRIBUTES:
+            for value in values[attribute]:
+                bits = np.zeros(count, dtype=bool)
+                bits[members[attribute][value]] = True
+                packed[row] = np.packbits(bits, bitorder='little')
+                row += 1
+
+        columns = np.full((len(COLUMN_ATTRIBUTES), count), MISSING, dtype=np.int64)
+        for i, meta in enumerate(chunk_metadata):
+            for a, attribute in enumerate(COLUMN_ATTRIBUTES):
+                if meta.get(attribute) is not None:
+                    columns[a, i] = _coerce(attribute, meta[attribute])
+        return cls(count, values, packed, columns)
+
+    def extend(self, chunk_metadata: List[dict]) -> 'MetadataIndex':
+        """Index sau khi nối thêm chunk: bit của chunk cũ giữ nguyên, chỉ thêm bit / cột của chunk mới"""
+        added = MetadataIndex.build(chunk_metadata)
+        count = self.count + added.count
+        values, rows = {}, []
+        for attribute in BITMAP_ATTRIBUTES:
+            values[attribute] = sorted(set(self.values.get(attribute, [])) | set(added.values.get(attribute, [])))
+            for value in values[attribute]:
+                bits = np.concatenate([self._bits(attribute, value), added._bits(attribute, value)])
+                rows.append(np.packbits(bits, bitorder='little'))
+        packed = np.stack(rows) if rows else np.zeros((0, (count + 7) // 8), dtype=np.uint8)
+        return MetadataIndex(count, values, packed, np.concatenate([np.asarray(self.columns), added.columns], axis=1))
+
+    def _bits(self, attribute: str, value) -> np.ndarray:
+        row = self._rows[attribute].get(value)
+        if row is None:
+            return np.zeros(self.count, dtype=bool)
+        return np.unpackbits(self.bitmaps[row], count=self.count, bitorder='little').astype(bool)
+
+    # -------- Lọc --------
+    def _packed_any(self, attribute: str, wanted) -> np.ndarray:
+        """OR các bitmap của những giá trị được chọn (trên dữ liệu nén, 8 chunk mỗi byte)"""
+        result = np.zeros(self.bitmaps.shape[1], dtype=np.uint8)
+        rows = [self._rows[attribute][v] for v in wanted if v in self._rows[attribute]]
+        if rows:
+            np.bitwise_or.reduce(self.bitmaps[rows], axis=0, out=result)
+        return result
+
+    def _packed_column(self, attribute: str, wanted) -> np.ndarray:
+        column = self.columns[COLUMN_ATTRIBUTES.index(attribute)]
+        return np.packbits(np.isin(column, np.asarray(list(wanted), dtype=np.int64)), bitorder='little')
+
+    def mask(self, filters: Optional[dict]) -> Optional[np.ndarray]:
+        """
+        filters: {thuộc tính: giá trị hoặc danh sách giá trị (khớp một trong số đó)}, thêm hậu tố "__not"
+        để loại trừ; các điều kiện kết hợp bằng AND. Returns: mảng bool (True = chunk được giữ) hoặc None.
+        """
+        if not filters:
+            return None
+        packed = np.full((self.count + 7) // 8, 0xFF, dtype=np.uint8)
+        for key, value in filters.items():
+            attribute, exclude = key, False
+            if key.endswith(EXCLUDE_SUFFIX):
+                attribute, exclude = key[:-len(EXCLUDE_SUFFIX)], True
+            if attribute not in CHUNK_ATTRIBUTES:
+                raise ValueError(f"Thuộc tính lọc không được hỗ trợ: {attribute} (chọn trong {CHUNK_ATTRIBUTES})")
+            wanted = _as_values(attribute, value, multi=True)
+            if attribute in BITMAP_ATTRIBUTES:
+                selected = self._packed_any(attribute, wanted)
+            else:
+                selected = self._packed_column(attribute, wanted)
+            packed &= ~selected if exclude else selected
+        return np.unpackbits(packed, count=self.count, bitorder='little').astype(bool)
+
+    def chunk_metadata(self, index: int) -> dict:
+        """Metadata của một chunk (dựng lại từ bitmap / cột, dùng khi trả kết quả)"""
+        byte, bit = index >> 3, index & 7
+        hits = (self.bitmaps[:, byte] >> bit) & 1 if len(self.bitmaps) else np.zeros(0, dtype=np.uint8)
+        meta = {}
+        for attribute in BITMAP_ATTRIBUTES:
+            matched = [v for v, row in self._rows[attribute].items() if hits[row]]
+            meta[attribute] = matched if attribute in MULTI_VALUED else (matched[0] if matched else None)
+        for a, attribute in enumerate(COLUMN_ATTRIBUTES):
+            value = int(self.columns[a, index])
+            meta[attribute] = value if value != MISSING else None
+        return meta
+
+    # -------- Lưu / đọc cạnh kho vector --------
+    def save(self, path: str, version: str) -> dict:
+        files = {
+            'values': f"meta_values-{version}.json",
+            'bitmaps': f"meta_bitmaps-{version}.npy",
+            'columns': f"meta_columns-{version}.npy",
+        }
+        with open(os.path.join(path, files['values']), 'w', encoding='utf-8') as f:
+            json.dump(self.values, f, ensure_ascii=False)
+        np.save(os.path.join(path, files['bitmaps']), self.bitmaps)
+        np.save(os.path.join(path, files['columns']), self.columns)
+        return {'type': self.type, 'count': self.count, 'attributes': list(CHUNK_ATTRIBUTES),
+                'bitmaps': int(len(self.bitmaps)), 'files': files}
+
+    @classmethod
+    def load(cls, path: str, info: dict) -> 'MetadataIndex':
+        files = info['files']
+        with open(os.path.join(path, files['values']), 'r', encoding='utf-8') as f:
+            values = json.load(f)
+        return cls(
+            int(info['count']),
+            values,
+            np.load(os.path.join(path, files['bitmaps']), mmap_mode='r'),
+            np.load(os.path.join(path, files['columns']), mmap_mode='r'),
+        )
+
+
+def _coerce(attribute: str, value):
+    # Bộ lọc từ query string / JSON có thể là chuỗi: "1" và 1 phải khớp cùng một bitmap
+    return str(value) if attribute == "source_type" else int(value)
+
+
+def _as_values(attribute: str, value, multi: bool = False) -> list:
+    """Chuẩn hóa giá trị metadata / bộ lọc thành danh sách (bỏ None)"""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set, frozenset)):
+        if attribute not in MULTI_VALUED and not multi:
+            raise ValueError(f"Thuộc tính {attribute} chỉ có một giá trị mỗi chunk")
+        return [_coerce(attribute, v) for v in value if v is not None]
+    return [_coerce(attribute, value)]
@@ -0,0 +1,420 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+import weakref
+from functools import lru_cache
+from typing import Dict, List
+
+import numpy as np
+import openai
+from dotenv import load_dotenv
+from langchain_openai import OpenAIEmbeddings
+
+load_dotenv()
+
+# Nguồn model cho embedding và chat completion:
+#   "openai" - gọi OpenAI (mặc định)
+#   "local"  - tất định, không gọi mạng (vector từ hash, câu trả lời theo mẫu, độ trễ giả lập)
+#   "record" - gọi OpenAI và ghi lại mọi response vào RAG_RECORD_DIR
+#   "replay" - trả lại các response đã ghi, không gọi mạng
+MODEL_PROVIDER = os.getenv("RAG_MODEL_PROVIDER", "openai")
+# Provider local: số chiều vector, độ trễ (ms) trước token đầu / giữa các token stream / mỗi lần embed
+LOCAL_EMBEDDING_DIM = int(os.getenv("RAG_LOCAL_EMBEDDING_DIM", "1536"))
+LOCAL_LATENCY_MS = float(os.getenv("RAG_LOCAL_LATENCY_MS", "0"))
+LOCAL_TOKEN_LATENCY_MS = float(os.getenv("RAG_LOCAL_TOKEN_LATENCY_MS", "0"))
+LOCAL_EMBED_LATENCY_MS = float(os.getenv("RAG_LOCAL_EMBED_LATENCY_MS", "0"))
+# Mẫu câu trả lời: {model}, {chars} (độ dài prompt), {prompt} (đầu câu prompt)
+LOCAL_COMPLETION_TEMPLATE = os.getenv(
+    "RAG_LOCAL_COMPLETION_TEMPLATE",
+    "[{model} - local] Câu trả lời mô phỏng cho yêu cầu dài {chars} ký tự: {prompt}",
+)
+# Record/replay: thư mục chứa records.jsonl; "on" = replay giữ đúng thời gian đã ghi
+RECORD_DIR = os.getenv("RAG_RECORD_DIR", "provider_records")
+REPLAY_LATENCY = os.getenv("RAG_REPLAY_LATENCY", "off")
+
+SUPPORTED_PROVIDERS = ("openai", "local", "record", "replay")
+RECORD_FILE = "records.jsonl"
+# Số ký tự đầu của prompt đưa vào câu trả lời mẫu
+_PROMPT_EXCERPT = 200
+
+
+class ReplayMissError(LookupError):
+    """Chế độ replay gặp request chưa được ghi"""
+
+
+# -------- OpenAI --------
+class OpenAIProvider:
+    """Embedding qua langchain OpenAIEmbeddings, chat qua openai.chat.completions (sync / async / stream)"""
+    name = "openai"
+    requires_api_key = True
+
+    def __init__(self, api_key: str = None):
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        if self.api_key:
+            openai.api_key = self.api_key
+        # AsyncOpenAI giữ connection pool gắn với event loop tạo ra nó: mỗi loop một client
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def embeddings(self, model: str, **options):
+        return OpenAIEmbeddings(model=model, **options)
+
+    def _async_client(self):
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = openai.AsyncOpenAI(api_key=self.api_key)
+            self._async_clients[loop] = client
+        return client
+
+    def chat(self, model: str, messages: List[dict], max_tokens: int, temperature: float) -> str:
+        response = openai.chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature
+        )
+        return response.choices[0].message.content.strip()
+
+    def stream_chat(self, model: str, messages: List[dict], max_tokens: int, temperature: float):
+        stream = openai.chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, stream=True
+        )
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        finally:
+            # Người nhận dừng sớm (client ngắt, bản dự phòng bị hủy): đóng kết nối để OpenAI ngừng sinh
+            stream.close()
+
+    async def achat(self, model: str, messages: List[dict], max_tokens: int, temperature: float) -> str:
+        response = await self._async_client().chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature
+        )
+        return response.choices[0].message.content.strip()
+
+    async def astream_chat(self, model: str, messages: List[dict], max_tokens: int, temperature: float):
+        stream = await self._async_client().chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, stream=True
+        )
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        finally:
+            await stream.close()
+
+
+# -------- Local (tất định, không gọi mạng) --------
+@lru_cache(maxsize=65536)
+def _token_vector(token: str, dim: int) -> np.ndarray:
+    digest = hashlib.sha1(token.encode('utf-8')).digest()
+    rng = np.random.RandomState(int.from_bytes(digest[:4], 'big'))
+    vector = rng.standard_normal(dim).astype(np.float32)
+    vector.setflags(write=False)
+    return vector
+
+
+def hash_embedding(text: str, dim: int) -> np.ndarray:
+    """
+    Vector tất định của text: tổng vector ngẫu nhiên (seed = hash) của từng từ,
+    nên hai câu có nhiều từ chung có cosine cao, như một embedding thật ở mức thô.
+    """
+    tokens = (text or '').lower().split() or [text or '']
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in tokens:
+        vector += _token_vector(token, dim)
+    return vector
+
+
+class LocalEmbeddings:
+    """Cùng giao diện với OpenAIEmbeddings (embed_query / aembed_query / embed_documents)"""
+
+    def __init__(self, model: str, dim: int = LOCAL_EMBEDDING_DIM, latency_ms: float = LOCAL_EMBED_LATENCY_MS):
+        # Tên riêng để cache câu hỏi không lẫn với embedding thật
+        self.model = f"local-{model}-{dim}"
+        self.dim = dim
+        self.latency_ms = latency_ms
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        return hash_embedding(text, self.dim).tolist()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        return hash_embedding(text, self.dim).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        return [hash_embedding(t, self.dim).tolist() for t in texts]
+
+
+class LocalProvider:
+    """Provider cho load test / benchmark: không gọi mạng, kết quả chỉ phụ thuộc input"""
+    name = "local"
+    requires_api_key = False
+
+    def __init__(self, dim: int = LOCAL_EMBEDDING_DIM, latency_ms: float = LOCAL_LATENCY_MS,
+                 token_latency_ms: float = LOCAL_TOKEN_LATENCY_MS, embed_latency_ms: float = LOCAL_EMBED_LATENCY_MS,
+                 template: str = LOCAL_COMPLETION_TEMPLATE):
+        self.dim = dim
+        self.latency_ms = latency_ms
+        self.token_latency_ms = token_latency_ms
+        self.embed_latency_ms = embed_latency_ms
+        self.template = template
+
+    def embeddings(self, model: str, **options):
+        return LocalEmbeddings(model, self.dim, self.embed_latency_ms)
+
+    def completion(self, model: str, messages: List[dict]) -> str:
+        prompt = messages[-1].get('content', '') if messages else ''
+        excerpt = ' '.join(prompt.split())[:_PROMPT_EXCERPT]
+        return self.template.format(model=model, chars=len(prompt), prompt=excerpt)
+
+    def _tokens(self, answer: str) -> List[str]:
+        words = answer.split(' ')
+        return [w + ' ' for w in words[:-1]] + words[-1:]
+
+    def chat(self, model: str, messages: List[dict], max_tokens: int, temperature: float) -> str:
+        answer = self.completion(model, messages)
+        time.sleep((self.latency_ms + self.token_latency_ms * len(self._tokens(answer))) / 1000)
+        return answer
+
+    def stream_chat(self, model: str, messages: List[dict], max_tokens: int, temperature: float):
+        time.sleep(self.latency_ms / 1000)
+        for token in self._tokens(self.completion(model, messages)):
+            if self.token_latency_ms:
+                time.sleep(self.token_latency_ms / 1000)
+            yield token
+
+    async def achat(self, model: str, messages: List[dict], max_tokens: int, temperature: float) -> str:
+        answer = self.completion(model, messages)
+        await asyncio.sleep((self.latency_ms + self.token_latency_ms * len(self._tokens(answer))) / 1000)
+        return answer
+
+    async def astream_chat(self, model: str, messages: List[dict], max_tokens: int, temperature: float):
+        await asyncio.sleep(self.latency_ms / 1000)
+        for token in self._tokens(self.completion(model, messages)):
+            if self.token_latency_ms:
+                await asyncio.sleep(self.token_latency_ms / 1000)
+            yield token
+
+
+# -------- Record / replay --------
+class RecordStore:
+    """
+    Các response đã ghi, lưu nối tiếp trong <dir>/records.jsonl; mỗi dòng:
+    {'key', 'kind', 'model', 'response', 'seconds'}. Khóa = sha1 của request (loại, model, input, tham số).
+    """
+
+    def __init__(self, directory: str = RECORD_DIR):
+        self.directory = directory
+        self.path = os.path.join(directory, RECORD_FILE)
+        self._records: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def make_key(kind: str, model: str, payload) -> str:
+        raw = json.dumps([kind, model, payload], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Dòng cuối ghi dở (process bị dừng giữa chừng)
+                        continue
+                    self._records[record['key']] = record
+        except OSError:
+            pass
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, key: str):
+        return self._records.get(key)
+
+    def put(self, key: str, kind: str, model: str, response, seconds: float):
+        record = {'key': key, 'kind': kind, 'model': model, 'response': response, 'seconds': round(seconds, 4)}
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self._records[key] = record
+
+
+class RecordReplayEmbeddings:
+    def __init__(self, provider: 'RecordReplayProvider', model: str, inner=None):
+        self.provider = provider
+        # Giữ tên model thật: cache câu hỏi dùng chung khóa giữa record và replay
+        self.model = model
+        self.inner = inner
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.provider.call('embedding', self.model, text, lambda: self.inner.embed_query(text))
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.provider.acall('embedding', self.model, text, lambda: self.inner.aembed_query(text))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # Ghi theo từng text để replay khớp dù lô được chia khác đi
+        if self.provider.mode == "replay":
+            return [self.embed_query(t) for t in texts]
+        vectors = self.inner.embed_documents(texts)
+        for text, vector in zip(texts, vectors):
+            key = self.provider.store.make_key('embedding', self.model, text)
+            self.provider.store.put(key, 'embedding', self.model, list(vector), 0.0)
+        return vectors
+
+
+class RecordReplayProvider:
+    """
+    mode="record": chuyển request cho provider thật (OpenAI) và ghi response + thời gian xuống đĩa.
+    mode="replay": trả lại response đã ghi (ReplayMissError nếu chưa có), có thể giữ đúng độ trễ đã ghi.
+    """
+    requires_api_key = False
+
+    def __init__(self, mode: str, directory: str = RECORD_DIR, inner=None, replay_latency: bool = REPLAY_LATENCY == "on"):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"mode phải là 'record' hoặc 'replay': {mode}")
+        self.mode = mode
+        self.name = mode
+        self.store = RecordStore(directory)
+        self.inner = inner if inner is not None or mode == "replay" else OpenAIProvider()
+        self.requires_api_key = mode == "record"
+        self.replay_latency = replay_latency
+
+    def embeddings(self, model: str, **options):
+        inner = self.inner.embeddings(model, **options) if self.inner is not None else None
+        return RecordReplayEmbeddings(self, model, inner)
+
+    @staticmethod
+    def _chat_payload(messages, max_tokens, temperature):
+        return {'messages': messages, 'max_tokens': int(max_tokens), 'temperature': float(temperature)}
+
+    def _replayed(self, kind: str, model: str, payload):
+        record = self.store.get(self.store.make_key(kind, model, payload))
+        if record is None:
+            raise ReplayMissError(f"Chưa ghi response cho request {kind} ({model})")
+        return record
+
+    def call(self, kind: str, model: str, payload, compute):
+        if self.mode == "replay":
+            record = self._replayed(kind, model, payload)
+            if self.replay_latency:
+                time.sleep(record['seconds'])
+            return record['response']
+        started = time.perf_counter()
+        response = compute()
+        self.store.put(self.store.make_key(kind, model, payload), kind, model, response, time.perf_counter() - started)
+        return response
+
+    async def acall(self, kind: str, model: str, payload, compute):
+        if self.mode == "replay":
+            record = self._replayed(kind, model, payload)
+            if self.replay_latency:
+                await asyncio.sleep(record['seconds'])
+            return record['response']
+        started = time.perf_counter()
+        response = await compute()
+        self.store.put(self.store.make_key(kind, model, payload), kind, model, response, time.perf_counter() - started)
+        return response
+
+    def chat(self, model: str, messages: List[dict], max_tokens: int, temperature: float) -> str:
+        payload = self._chat_payload(messages, max_tokens, temperature)
+        return self.call('chat', model, payload,
+                         lambda: self.inner.chat(model, messages, max_tokens, temperature))
+
+    async def achat(self, model: str, messages: List[dict], max_tokens: int, temperature: float) -> str:
+        payload = self._chat_payload(messages, max_tokens, temperature)
+        return await self.acall('chat', model, payload,
+                                lambda: self.inner.achat(model, messages, max_tokens, temperature))
+
+    def stream_chat(self, model: str, messages: List[dict], max_tokens: int, temperature: float):
+        payload = self._chat_payload(messages, max_tokens, temperature)
+        if self.mode == "replay":
+            record = self._replayed('stream', model, payload)
+            deltas = record['response']
+            for delta in deltas:
+                if self.replay_latency:
+                    time.sleep(record['seconds'] / max(len(deltas), 1))
+                yield delta
+            return
+        started = time.perf_counter()
+        deltas = []
+        stream = self.inner.stream_chat(model, messages, max_tokens, temperature)
+        try:
+            for delta in stream:
+                deltas.append(delta)
+                yield delta
+        finally:
+            stream.close()
+        # Chỉ ghi stream đã hoàn tất (stream bị ngắt giữa chừng không đi tới đây)
+        self.store.put(self.store.make_key('stream', model, payload), 'stream', model, deltas,
+                       time.perf_counter() - started)
+
+    async def astream_chat(self, model: str, messages: List[dict], max_tokens: int, temperature: float):
+        payload = self._chat_payload(messages, max_tokens, temperature)
+        if self.mode == "replay":
+            record = self._replayed('stream', model, payload)
+            deltas = record['response']
+            for delta in deltas:
+                if self.replay_latency:
+                    await asyncio.sleep(record['seconds'] / max(len(deltas), 1))
+                yield delta
+            return
+        started = time.perf_counter()
+        deltas = []
+        stream = self.inner.astream_chat(model, messages, max_tokens, temperature)
+        try:
+            async for delta in stream:
+                deltas.append(delta)
+                yield delta
+        finally:
+            await stream.aclose()
+        self.store.put(self.store.make_key('stream', model, payload), 'stream', model, deltas,
+                       time.perf_counter() - started)
+
+
+def build_provider(name: str = None, **options):
+    name = name or MODEL_PROVIDER
+    if name == "openai":
+        return OpenAIProvider(**options)
+    if name == "local":
+        return LocalProvider(**options)
+    if name in ("record", "replay"):
+        return RecordReplayProvider(name, **options)
+    raise ValueError(f"Provider không được hỗ trợ: {name} (chọn một trong {SUPPORTED_PROVIDERS})")
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(name: str = None):
+    """Provider dùng chung trong process (theo RAG_MODEL_PROVIDER nếu không chỉ định)"""
+    name = name or MODEL_PROVIDER
+    provider = _providers.get(name)
+    if provider is None:
+        with _providers_lock:
+            provider = _providers.get(name)
+            if provider is None:
+                provider = build_provider(name)
+                _providers[name] = provider
+    return provider
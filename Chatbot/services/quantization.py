@@ -0,0 +1,292 @@
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+from . import retrieval
+
+# Số ứng viên (theo điểm gần đúng trên mã nén) được chấm lại bằng vector đầy đủ
+RESCORE_CANDIDATES = int(os.getenv("RAG_RESCORE_CANDIDATES", "200"))
+# Số phần tử mã giải nén / tra bảng mỗi lượt: khối tạm ~4 MB nằm gọn trong cache CPU
+# (khối lớn hơn làm việc chuyển int8 -> float32 chậm đi rõ rệt)
+CODE_BLOCK_ELEMENTS = 1 << 20
+SUPPORTED_QUANTIZATIONS = ("int8", "pq", "prefix")
+# Số chiều đầu giữ lại cho tiền lọc kiểu Matryoshka (text-embedding-3 hỗ trợ rút gọn chiều)
+DEFAULT_PREFIX_DIMS = 256
+
+
+class Quantizer:
+    """
+    Nén vector đã chuẩn hóa thành mã nhỏ gọn để chấm điểm gần đúng toàn corpus,
+    sau đó chấm lại top ứng viên bằng vector đầy đủ (đọc qua mmap).
+    """
+    type = None
+
+    def encode(self, vectors) -> np.ndarray:
+        raise NotImplementedError
+
+    def score(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    @property
+    def code_bytes(self) -> int:
+        """Số byte mã nén cho mỗi vector"""
+        raise NotImplementedError
+
+    def search(self, codes: np.ndarray, matrix: np.ndarray, query, top_k: int,
+               rescore: int = RESCORE_CANDIDATES, threshold: Optional[float] = None,
+               mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Hai giai đoạn: top `rescore` theo mã nén, rồi điểm chính xác trên các dòng đó"""
+        if codes is None or len(codes) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = retrieval.normalize_vector(query)
+        kept, approx = retrieval.masked_score(self.score, codes, query, mask)
+        shortlist = retrieval.top_k_indices(approx, max(rescore, top_k))
+        # Đọc theo thứ tự tăng dần để truy cập mmap tuần tự hơn
+        rows = np.sort(kept[shortlist] if kept is not None else shortlist)
+        scores = np.asarray(matrix[rows], dtype=np.float32) @ query
+        best = retrieval.top_k_indices(scores, top_k)
+        indices, selected = rows[best], scores[best]
+        if threshold is not None:
+            keep = selected >= threshold
+            indices, selected = indices[keep], selected[keep]
+        return indices, selected
+
+    def _block_rows(self) -> int:
+        return max(1, CODE_BLOCK_ELEMENTS // self.code_bytes)
+
+    def _encode_blocks(self, vectors, code_shape, code_dtype, encode_block) -> np.ndarray:
+        codes = np.empty((len(vectors),) + code_shape, dtype=code_dtype)
+        rows = self._block_rows()
+        for start in range(0, len(vectors), rows):
+            block = np.asarray(vectors[start:start + rows], dtype=np.float32)
+            codes[start:start + len(block)] = encode_block(block)
+        return codes
+
+
+class ScalarQuantizer(Quantizer):
+    """
+    int8 theo từng chiều: x ≈ low + (code + 128) * step.
+    Điểm gần đúng = (code + 128) · (q * step) + q · low, giải nén từng khối sang float32.
+    """
+    type = "int8"
+
+    def __init__(self, low: np.ndarray, step: np.ndarray):
+        self.low = low
+        self.step = step
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.low.nbytes + self.step.nbytes)
+
+    @property
+    def code_bytes(self) -> int:
+        return int(self.low.shape[0])
+
+    @classmethod
+    def fit(cls, vectors) -> 'ScalarQuantizer':
+        dim = vectors.shape[1]
+        low = np.full(dim, np.inf, dtype=np.float32)
+        high = np.full(dim, -np.inf, dtype=np.float32)
+        rows = max(1, CODE_BLOCK_ELEMENTS // dim)
+        for start in range(0, len(vectors), rows):
+            block = np.asarray(vectors[start:start + rows], dtype=np.float32)
+            low = np.minimum(low, block.min(axis=0))
+            high = np.maximum(high, block.max(axis=0))
+        step = (high - low) / 255.0
+        step[step == 0] = 1.0
+        return cls(low, step.astype(np.float32))
+
+    def encode(self, vectors) -> np.ndarray:
+        def encode_block(block):
+            levels = np.rint((block - self.low) / self.step)
+            return (np.clip(levels, 0, 255) - 128).astype(np.int8)
+        return self._encode_blocks(vectors, (self.code_bytes,), np.int8, encode_block)
+
+    def score(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        weights = query * self.step
+        bias = float(query @ self.low + 128.0 * weights.sum())
+        scores = np.empty(codes.shape[0], dtype=np.float32)
+        rows = self._block_rows()
+        for start in range(0, codes.shape[0], rows):
+            block = np.asarray(codes[start:start + rows], dtype=np.float32)
+            scores[start:start + len(block)] = block @ weights
+        return scores + bias
+
+    def save(self, path: str, version: str, codes: np.ndarray) -> dict:
+        files = {
+            'codes': f"int8_codes-{version}.npy",
+            'low': f"int8_low-{version}.npy",
+            'step': f"int8_step-{version}.npy",
+        }
+        np.save(os.path.join(path, files['codes']), codes)
+        np.save(os.path.join(path, files['low']), self.low)
+        np.save(os.path.join(path, files['step']), self.step)
+        return {'type': self.type, 'files': files}
+
+    @classmethod
+    def load(cls, path: str, info: dict) -> 'ScalarQuantizer':
+        files = info['files']
+        return cls(np.load(os.path.join(path, files['low'])), np.load(os.path.join(path, files['step'])))
+
+
+class ProductQuantizer(Quantizer):
+    """
+    Product quantization: chia vector thành m đoạn con, mỗi đoạn thay bằng chỉ số (uint8)
+    của centroid gần nhất trong codebook 256 phần tử. Điểm gần đúng = tổng tra bảng
+    (asymmetric distance computation) nên mỗi vector chỉ tốn m byte.
+    """
+    type = "pq"
+
+    def __init__(self, codebooks: np.ndarray):
+        self.codebooks = codebooks  # (m, ksub, dsub)
+
+    @property
+    def m(self) -> int:
+        return int(self.codebooks.shape[0])
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.codebooks.nbytes)
+
+    @property
+    def code_bytes(self) -> int:
+        return self.m
+
+    @staticmethod
+    def default_subspaces(dim: int) -> int:
+        """Ước số lớn nhất của dim không vượt quá dim/16 (1536 -> 96 byte mỗi vector)"""
+        for m in range(max(1, dim // 16), 0, -1):
+            if dim % m == 0:
+                return m
+        return 1
+
+    @classmethod
+    def fit(cls, vectors, m: int = None, ksub: int = 256, iterations: int = 8,
+            sample_size: int = None, seed: int = 0) -> 'ProductQuantizer':
+        count, dim = vectors.shape
+        m = m or cls.default_subspaces(dim)
+        if dim % m != 0:
+            raise ValueError(f"Số chiều {dim} không chia hết cho số đoạn con {m}")
+        dsub = dim // m
+        rng = np.random.RandomState(seed)
+        ksub = min(ksub, count)
+        sample_size = min(count, sample_size or ksub * 64)
+        sample = np.asarray(vectors[np.sort(rng.choice(count, sample_size, replace=False))], dtype=np.float32)
+
+        codebooks = np.empty((m, ksub, dsub), dtype=np.float32)
+        for j in range(m):
+            sub = sample[:, j * dsub:(j + 1) * dsub]
+            centroids = sub[rng.choice(sample_size, ksub, replace=False)].copy()
+            for _ in range(iterations):
+                assignment = _nearest(sub, centroids)
+                counts = np.bincount(assignment, minlength=ksub)
+                sums = np.stack([np.bincount(assignment, weights=sub[:, d], minlength=ksub)
+                                 for d in range(dsub)], axis=1)
+                empty = counts == 0
+                centroids = sums / np.maximum(counts, 1)[:, None]
+                # Centroid rỗng: khởi tạo lại bằng một điểm ngẫu nhiên
+                centroids[empty] = sub[rng.choice(sample_size, int(empty.sum()))]
+            codebooks[j] = centroids
+        return cls(codebooks)
+
+    def encode(self, vectors) -> np.ndarray:
+        dsub = self.codebooks.shape[2]
+
+        def encode_block(block):
+            return np.stack([
+                _nearest(block[:, j * dsub:(j + 1) * dsub], self.codebooks[j]) for j in range(self.m)
+            ], axis=1).astype(np.uint8)
+        return self._encode_blocks(vectors, (self.m,), np.uint8, encode_block)
+
+    def score(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        ksub, dsub = self.codebooks.shape[1], self.codebooks.shape[2]
+        # Bảng tích vô hướng (m, ksub) giữa từng đoạn của query và từng centroid
+        table = np.einsum('mkd,md->mk', self.codebooks, query.reshape(self.m, dsub)).ravel()
+        offsets = (np.arange(self.m) * ksub).astype(np.int64)
+        scores = np.empty(codes.shape[0], dtype=np.float32)
+        rows = self._block_rows()
+        for start in range(0, codes.shape[0], rows):
+            block = np.asarray(codes[start:start + rows])
+            scores[start:start + len(block)] = table[block + offsets].sum(axis=1)
+        return scores
+
+    def save(self, path: str, version: str, codes: np.ndarray) -> dict:
+        files = {
+            'codes': f"pq_codes-{version}.npy",
+            'codebooks': f"pq_codebooks-{version}.npy",
+        }
+        np.save(os.path.join(path, files['codes']), codes)
+        np.save(os.path.join(path, files['codebooks']), self.codebooks)
+        return {'type': self.type, 'm': self.m, 'files': files}
+
+    @classmethod
+    def load(cls, path: str, info: dict) -> 'ProductQuantizer':
+        return cls(np.load(os.path.join(path, info['files']['codebooks'])))
+
+
+class PrefixQuantizer(Quantizer):
+    """
+    Matryoshka: text-embedding-3 dồn phần lớn thông tin vào các chiều đầu, nên `dims` chiều đầu
+    (chuẩn hóa lại) đủ để lọc ứng viên. Chấm toàn corpus trên tiền tố (256 / 1536 chiều: đọc ít hơn ~6 lần
+    bộ nhớ mỗi câu hỏi), rồi chấm lại shortlist bằng vector đầy đủ.
+    """
+    type = "prefix"
+
+    def __init__(self, dims: int):
+        self.dims = dims
+
+    @property
+    def nbytes(self) -> int:
+        return 0
+
+    @property
+    def code_bytes(self) -> int:
+        return self.dims * 4
+
+    @classmethod
+    def fit(cls, vectors, dims: int = None) -> 'PrefixQuantizer':
+        dims = dims or DEFAULT_PREFIX_DIMS
+        if not 0 < dims <= vectors.shape[1]:
+            raise ValueError(f"Số chiều tiền tố {dims} phải nằm trong (0, {vectors.shape[1]}]")
+        return cls(dims)
+
+    def encode(self, vectors) -> np.ndarray:
+        def encode_block(block):
+            return retrieval.normalize_rows(block[:, :self.dims])
+        return self._encode_blocks(vectors, (self.dims,), np.float32, encode_block)
+
+    def score(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        return retrieval.score(codes, retrieval.normalize_vector(query[:self.dims]))
+
+    def save(self, path: str, version: str, codes: np.ndarray) -> dict:
+        files = {'codes': f"prefix_codes-{version}.npy"}
+        np.save(os.path.join(path, files['codes']), codes)
+        return {'type': self.type, 'dims': self.dims, 'files': files}
+
+    @classmethod
+    def load(cls, path: str, info: dict) -> 'PrefixQuantizer':
+        return cls(int(info['dims']))
+
+
+def _nearest(points: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Chỉ số centroid gần nhất (khoảng cách Euclid) cho từng điểm"""
+    distances = (centroids ** 2).sum(axis=1) - 2.0 * (points @ centroids.T)
+    return np.argmin(distances, axis=1)
+
+
+_QUANTIZERS = {ScalarQuantizer.type: ScalarQuantizer, ProductQuantizer.type: ProductQuantizer,
+               PrefixQuantizer.type: PrefixQuantizer}
+
+
+def build_quantizer(kind: str, vectors, **options) -> Quantizer:
+    if kind not in _QUANTIZERS:
+        raise ValueError(f"Kiểu nén không được hỗ trợ: {kind}")
+    return _QUANTIZERS[kind].fit(vectors, **options)
+
+
+def load_quantizer(path: str, info: dict) -> Tuple[Quantizer, np.ndarray]:
+    """(quantizer, mã nén memory-mapped) từ thông tin trong manifest"""
+    quantizer = _QUANTIZERS[info['type']].load(path, info)
+    codes = np.load(os.path.join(path, info['files']['codes']), mmap_mode='r')
+    return quantizer, codes
@@ -0,0 +1,208 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from . import tracing
+
+load_dotenv()
+
+# Số embedding câu hỏi giữ trong RAM mỗi process
+QUERY_CACHE_SIZE = int(os.getenv("RAG_QUERY_CACHE_SIZE", "2048"))
+# File SQLite dùng chung giữa các worker / qua các lần restart (để trống = tắt)
+QUERY_CACHE_DB = os.getenv("RAG_QUERY_CACHE_DB", "")
+
+
+def normalize_query(text: str) -> str:
+    """Chuẩn hóa câu hỏi làm khóa cache: Unicode NFC, chữ thường, gộp khoảng trắng"""
+    text = unicodedata.normalize('NFC', text or '')
+    return ' '.join(text.lower().split())
+
+
+def model_name_of(embeddings_model) -> str:
+    return getattr(embeddings_model, 'model', None) or type(embeddings_model).__name__
+
+
+class QueryEmbeddingCache:
+    """
+    Cache embedding câu hỏi dùng chung cho truy hồi global và cá nhân.
+    Tầng 1: LRU trong process. Tầng 2 (tùy chọn): SQLite trên đĩa.
+    """
+
+    def __init__(self, max_entries: int = QUERY_CACHE_SIZE, db_path: str = QUERY_CACHE_DB):
+        self.max_entries = max_entries
+        self.db_path = db_path or None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        if self.db_path:
+            self._init_db()
+
+    # -------- SQLite tier --------
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        try:
+            conn = self._connection()
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS query_embeddings ('
+                'key TEXT PRIMARY KEY, model TEXT NOT NULL, dim INTEGER NOT NULL, '
+                'vector BLOB NOT NULL, created_at REAL NOT NULL)'
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Không mở được query cache SQLite {self.db_path}: {e}")
+            self.db_path = None
+
+    def _db_get(self, key: str) -> Optional[np.ndarray]:
+        if not self.db_path:
+            return None
+        try:
+            row = self._connection().execute(
+                'SELECT vector FROM query_embeddings WHERE key = ?', (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Lỗi khi đọc query cache SQLite: {e}")
+            return None
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def _db_put(self, key: str, model: str, vector: np.ndarray):
+        if not self.db_path:
+            return
+        try:
+            conn = self._connection()
+            conn.execute(
+                'INSERT OR REPLACE INTO query_embeddings (key, model, dim, vector, created_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, model, int(vector.shape[0]), vector.tobytes(), time.time())
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Lỗi khi ghi query cache SQLite: {e}")
+
+    # -------- LRU tier --------
+    @staticmethod
+    def make_key(text: str, model: str) -> str:
+        raw = f"{model}\0{normalize_query(text)}".encode('utf-8')
+        return hashlib.sha1(raw).hexdigest()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, text: str, model: str) -> Optional[np.ndarray]:
+        key = self.make_key(text, model)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                tracing.count("embedding_cache.hit")
+                return vector
+        vector = self._db_get(key)
+        if vector is not None:
+            vector.setflags(write=False)
+            self._remember(key, vector)
+            with self._lock:
+                self.persistent_hits += 1
+            tracing.count("embedding_cache.hit")
+            return vector
+        return None
+
+    def put(self, text: str, model: str, vector) -> np.ndarray:
+        key = self.make_key(text, model)
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        vector.setflags(write=False)
+        self._remember(key, vector)
+        self._db_put(key, model, vector)
+        return vector
+
+    def get_or_compute(self, text: str, model: str, compute: Callable[[str], list]) -> np.ndarray:
+        vector = self.get(text, model)
+        if vector is not None:
+            return vector
+        with self._lock:
+            self.misses += 1
+        tracing.count("embedding_cache.miss")
+        return self.put(text, model, compute(text))
+
+    def embed_query(self, embeddings_model, text: str) -> np.ndarray:
+        """embed_query qua cache: trả về vector float32 chỉ đọc"""
+        return self.get_or_compute(text, model_name_of(embeddings_model), embeddings_model.embed_query)
+
+    async def aembed_query(self, embeddings_model, text: str) -> np.ndarray:
+        """Bản async của embed_query: khi cache miss gọi aembed_query, không chiếm thread của event loop"""
+        model = model_name_of(embeddings_model)
+        vector = self.get(text, model)
+        if vector is not None:
+            return vector
+        with self._lock:
+            self.misses += 1
+        tracing.count("embedding_cache.miss")
+        return self.put(text, model, await embeddings_model.aembed_query(text))
+
+    def embed_many(self, embeddings_model, texts: List[str]) -> np.ndarray:
+        """
+        Embedding cho nhiều câu hỏi: lấy từ cache những câu đã có, các câu còn thiếu
+        (bỏ trùng sau chuẩn hóa) được embed trong một lần gọi embed_documents.
+        Returns: ma trận float32 (len(texts), dim) theo đúng thứ tự đầu vào.
+        """
+        model = model_name_of(embeddings_model)
+        vectors = [self.get(text, model) for text in texts]
+        missing = {}
+        for position, (text, vector) in enumerate(zip(texts, vectors)):
+            if vector is None:
+                missing.setdefault(normalize_query(text), []).append(position)
+        if missing:
+            with self._lock:
+                self.misses += len(missing)
+            pending = [texts[positions[0]] for positions in missing.values()]
+            for text, raw, positions in zip(pending, embeddings_model.embed_documents(pending), missing.values()):
+                vector = self.put(text, model, raw)
+                for position in positions:
+                    vectors[position] = vector
+        if not vectors:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.vstack(vectors)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.persistent_hits = self.misses = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.persistent_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'persistent_hits': self.persistent_hits,
+            'misses': self.misses,
+            'hit_rate': round((self.hits + self.persistent_hits) / lookups, 4) if lookups else 0.0,
+            'persistent': bool(self.db_path),
+        }
+
+
+# Cache mặc định của process, dùng chung cho mọi service
+query_embedding_cache = QueryEmbeddingCache()
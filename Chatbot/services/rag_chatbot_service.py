@@ -1,250 +1,823 @@
 import asyncio
-import os
 import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from typing import List, Tuple, Optional
-from sklearn.metrics.pairwise import cosine_similarity
-from langchain_openai import OpenAIEmbeddings
+from typing import List
 from dotenv import load_dotenv
-import openai
+from .providers import get_provider
 from .user_embedding_service import UserEmbeddingService
+from .vector_store import is_vector_store
+from .corpus_registry import corpus_registry
+from .query_embedding_cache import query_embedding_cache
+from .quantization import RESCORE_CANDIDATES
+from .answer_cache import answer_cache
+from .semantic_cache import semantic_cache
+from .fallback_stats import fallback_stats
+from .lexical_index import reciprocal_rank_fusion
+from .chunk_table import make_chunk_id, count_tokens
+from .context_assembler import ContextAssembler, ContextCandidate, context_stats
+from . import retrieval
+from . import tracing
 
 load_dotenv()
 
 # Thiết lập tham số truy hồi mặc định từ .env
 SIM_THRESHOLD = float(os.getenv("RAG_SIM_THRESHOLD", "0.5"))
 DEFAULT_TOP_K = int(os.getenv("RAG_TOP_K", "5"))
+# Kho vector nhị phân (train_rag_chatbot ghi ra) và file JSON cũ để tương thích
+DEFAULT_INDEX_DIR = os.getenv("RAG_INDEX_DIR", "stem_index")
+LEGACY_EMBEDDINGS_FILE = "stem_embeddings.json"
+# Chỉ mục ANN: "auto" = dùng nếu index có, "off" = luôn tìm chính xác
+ANN_MODE = os.getenv("RAG_ANN_MODE", "auto")
+ANN_NPROBE = int(os.getenv("RAG_ANN_NPROBE", "8"))
+# Mã nén int8/PQ: "auto" = chấm gần đúng trên mã nén rồi chấm lại bằng vector đầy đủ, "off" = bỏ qua
+QUANT_MODE = os.getenv("RAG_QUANT_MODE", "auto")
+# Truy hồi corpus chung: "dense" (embedding), "hybrid" (embedding + BM25, trộn bằng RRF) hoặc "lexical"
+# (chỉ BM25, không gọi API embedding). Corpus có BM25 luôn dùng BM25 khi không embed được câu hỏi.
+RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "dense")
+# Số ứng viên mỗi nguồn đưa vào bước trộn hybrid (tính theo bội số của top_k)
+HYBRID_CANDIDATES_FACTOR = int(os.getenv("RAG_HYBRID_CANDIDATES_FACTOR", "4"))
+# Timeout (giây) khi embed câu hỏi; để trống = mặc định của thư viện. API chậm -> chuyển sang BM25
+EMBED_TIMEOUT = os.getenv("RAG_EMBED_TIMEOUT", "")
+# "on" = sinh song song câu trả lời theo ngữ liệu và câu trả lời tổng quát dự phòng, hủy bản dự phòng
+# khi bản theo ngữ liệu hợp lệ (giảm độ trễ xấu nhất, đổi lại tốn thêm token cho bản bị hủy)
+SPECULATIVE_FALLBACK = os.getenv("RAG_SPECULATIVE_FALLBACK", "off")
+SPECULATIVE_WORKERS = int(os.getenv("RAG_SPECULATIVE_WORKERS", "8"))
+# Tăng mỗi khi sửa system prompt / _build_prompt để cache câu trả lời cũ không còn được dùng
+PROMPT_TEMPLATE_VERSION = 2
+ERROR_ANSWER_PREFIX = "Xin lỗi, có lỗi xảy ra khi xử lý"
+# Câu trả lời chứa các cụm này bị coi là không dùng ngữ liệu, sinh lại câu trả lời tổng quát
+BAD_PHRASES = [
+    "tôi không tìm thấy",
+    "không có thông tin",
+    "không đủ dữ liệu",
+    "tài liệu không đề cập"
+]
 
-class UserEmbeddingService:
-    def __init__(self):
-        self._ensure_event_loop()
-        self.embeddings_model = OpenAIEmbeddings(model="text-embedding-3-small")
-
-    def _ensure_event_loop(self):
-        try:
-            asyncio.get_running_loop()
-        except RuntimeError:
-            asyncio.set_event_loop(asyncio.new_event_loop())
-
-    def load_user_embeddings(self, user_id: str) -> Tuple[List[str], np.ndarray]:
-        filename = f"user_{user_id}_embeddings.json"
-        if not os.path.exists(filename):
-            print(f"File {filename} không tồn tại")
-            return [], np.array([])
-        try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                chunks = data.get('chunks', [])
-                embeddings = np.array(data.get('embeddings', []))
-                print(f"Đã load {len(chunks)} chunks cho user {user_id}")
-                return chunks, embeddings
-        except Exception as e:
-            print(f"Lỗi khi load embeddings cho user {user_id}: {e}")
-            return [], np.array([])
-
-    def get_user_context(self, user_id: str, query: str, top_k: int = 3) -> List[str]:
-        self._ensure_event_loop()
-        chunks, embeddings = self.load_user_embeddings(user_id)
-        if len(chunks) == 0 or len(embeddings) == 0:
-            return []
-        try:
-            query_embedding = self.embeddings_model.embed_query(query)
-            query_embedding = np.array(query_embedding).reshape(1, -1)
-            similarities = cosine_similarity(query_embedding, embeddings)[0]
-            top_indices = np.argsort(similarities)[-top_k:][::-1]
-            relevant_chunks = [chunks[i] for i in top_indices if similarities[i] >= SIM_THRESHOLD]
-            return relevant_chunks
-        except Exception as e:
-            print(f"Lỗi khi tìm context cho user {user_id}: {e}")
-            return []
-
-    def get_user_profile(self, user_id: str) -> Optional[dict]:
-        filename = f"user_{user_id}_embeddings.json"
-        if not os.path.exists(filename):
-            return None
-        try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return {
-                    'user_id': data.get('user_id'),
-                    'total_chunks': data.get('total_chunks', 0),
-                    'created_at': data.get('created_at'),
-                    'has_data': len(data.get('chunks', [])) > 0
-                }
-        except Exception as e:
-            print(f"Lỗi khi load profile cho user {user_id}: {e}")
-            return None
 
-    def list_all_users(self) -> List[str]:
-        users = []
-        for filename in os.listdir('.'):
-            if filename.startswith('user_') and filename.endswith('_embeddings.json'):
-                user_id = filename.replace('user_', '').replace('_embeddings.json', '')
-                users.append(user_id)
-        return users
+def resolve_embeddings_path(embeddings_file: str = None) -> str:
+    """Chọn nguồn embeddings: đường dẫn chỉ định, kho nhị phân mặc định, rồi mới tới JSON cũ"""
+    if embeddings_file:
+        return embeddings_file
+    if is_vector_store(DEFAULT_INDEX_DIR):
+        return DEFAULT_INDEX_DIR
+    return LEGACY_EMBEDDINGS_FILE
 
 
 class RAGChatbotService:
-    def __init__(self, embeddings_file='stem_embeddings.json'):
+    # Chọn ngữ liệu cho prompt theo ngân sách token (không giữ trạng thái, dùng chung được)
+    context_assembler = ContextAssembler()
+
+    def __init__(self, embeddings_file=None):
+        # Embedding và chat completion qua provider (RAG_MODEL_PROVIDER): OpenAI, local hoặc record/replay
+        self.provider = get_provider()
         self.api_key = os.getenv("OPENAI_API_KEY")
-        if not self.api_key:
+        if self.provider.requires_api_key and not self.api_key:
             raise ValueError("OPENAI_API_KEY not found in environment variables")
 
-        openai.api_key = self.api_key
         # Runtime generation settings
         self.max_tokens = int(os.getenv("OPENAI_MAX_TOKENS", "2048"))
         self.temperature = float(os.getenv("OPENAI_TEMPERATURE", "0.7"))
         self.chat_model = os.getenv("OPENAI_CHAT_MODEL", "gpt-4.1-mini")
         self.top_k = DEFAULT_TOP_K
-        self.embeddings_file = embeddings_file
-        self.chunks = []
-        self.embeddings = []
-        self.user_embedding_service = UserEmbeddingService()
-        self.embeddings_model = OpenAIEmbeddings(model="text-embedding-3-small")
+        self.ann_mode = ANN_MODE
+        self.ann_nprobe = ANN_NPROBE
+        self.quant_mode = QUANT_MODE
+        self.rescore_candidates = RESCORE_CANDIDATES
+        self.speculative_fallback = SPECULATIVE_FALLBACK == "on"
+        self.retrieval_mode = RETRIEVAL_MODE
+        self._embeddings_file = embeddings_file
+        self.user_embedding_service = UserEmbeddingService(sim_threshold=SIM_THRESHOLD)
+        embedding_options = {'request_timeout': float(EMBED_TIMEOUT)} if EMBED_TIMEOUT else {}
+        self.embeddings_model = self.provider.embeddings("text-embedding-3-small", **embedding_options)
         self.load_embeddings()
 
+    @property
+    def embeddings_file(self):
+        # Resolve lại mỗi lần để nhận stem_index/ được tạo sau khi worker đã khởi động
+        return resolve_embeddings_path(self._embeddings_file)
+
     def load_embeddings(self):
-        if os.path.exists(self.embeddings_file):
-            try:
-                with open(self.embeddings_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.chunks = data.get('chunks', [])
-                    self.embeddings = np.array(data.get('embeddings', []))
-                print(f"Đã load {len(self.chunks)} chunks từ {self.embeddings_file}")
-            except Exception as e:
-                print(f"Lỗi khi load embeddings: {e}")
-                self.chunks = []
-                self.embeddings = []
-        else:
+        # Corpus được load một lần mỗi process qua registry, các instance dùng chung
+        store = corpus_registry.get(self.embeddings_file)
+        if store is None:
             print(f"File embeddings không tồn tại: {self.embeddings_file}")
+        return store
+
+    @property
+    def corpus(self):
+        """Corpus hiện tại (tự cập nhật khi file index thay đổi)"""
+        return corpus_registry.get(self.embeddings_file)
+
+    @property
+    def chunks(self):
+        store = self.corpus
+        return store.chunks if store is not None else []
+
+    @property
+    def embeddings(self):
+        store = self.corpus
+        return store.vectors if store is not None else []
+
+    @property
+    def index_version(self):
+        store = self.corpus
+        return store.index_version if store is not None else None
+
+    def corpus_stats(self) -> dict:
+        return corpus_registry.stats().get(self.embeddings_file, {})
+
+    def query_cache_stats(self) -> dict:
+        return query_embedding_cache.stats()
 
     def get_openai_embedding(self, text):
         try:
-            return self.embeddings_model.embed_query(text)
+            # Dùng chung cache với UserEmbeddingService: mỗi câu hỏi chỉ embed một lần
+            with tracing.span("rag.embed"):
+                return query_embedding_cache.embed_query(self.embeddings_model, text)
         except Exception as e:
             print(f"Lỗi khi tạo embedding OpenAI: {e}")
             return None
 
+    def _chat_messages(self, prompt: str):
+        """System prompt chặt chẽ để giảm ảo giác, dùng chung cho chế độ thường và streaming"""
+        return [
+            {
+                "role": "system",
+                "content": (
+                    "Bạn là trợ lý RAG tiếng Việt cho lĩnh vực STEM. \n"
+                    "QUY ĐỊNH: \n"
+                    "- ƯU TIÊN dùng đúng nội dung từ 'Ngữ liệu' được cung cấp (nếu có). \n"
+                    "- Nếu ngữ liệu không đủ, nói rõ 'Chưa đủ ngữ liệu' và chỉ trả lời kiến thức nền ở mức tổng quát, tránh bịa đặt. \n"
+                    "- Trình bày súc tích, có cấu trúc, dùng tiêu đề/ngắt đoạn, bullet khi phù hợp. \n"
+                    "- Nêu rõ giả định (nếu có). \n"
+                    "- Trả lời hoàn toàn bằng tiếng Việt."
+                ),
+            },
+            {"role": "user", "content": prompt}
+        ]
+
     def _generate_with_openai(self, prompt: str):
-        """Sinh câu trả lời bằng OpenAI với system prompt chặt chẽ để giảm ảo giác"""
+        """Sinh câu trả lời qua provider (mặc định OpenAI) với system prompt chặt chẽ để giảm ảo giác"""
         try:
-            response = openai.chat.completions.create(
-                model=self.chat_model,  # hoặc model bạn có quyền dùng
-                messages=[
-                    {
-                        "role": "system",
-                        "content": (
-                            "Bạn là trợ lý RAG tiếng Việt cho lĩnh vực STEM. \n"
-                            "QUY ĐỊNH: \n"
-                            "- ƯU TIÊN dùng đúng nội dung từ 'Ngữ liệu' được cung cấp (nếu có). \n"
-                            "- Nếu ngữ liệu không đủ, nói rõ 'Chưa đủ ngữ liệu' và chỉ trả lời kiến thức nền ở mức tổng quát, tránh bịa đặt. \n"
-                            "- Trình bày súc tích, có cấu trúc, dùng tiêu đề/ngắt đoạn, bullet khi phù hợp. \n"
-                            "- Nêu rõ giả định (nếu có). \n"
-                            "- Trả lời hoàn toàn bằng tiếng Việt."
-                        ),
-                    },
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=self.max_tokens,
-                temperature=self.temperature
-                # Nếu model không hỗ trợ temperature/max_tokens, thư viện sẽ xử lý ngoại lệ
-            )
-            return response.choices[0].message.content.strip()
+            with tracing.span("llm.completion", model=self.chat_model) as attrs:
+                answer = self.provider.chat(self.chat_model, self._chat_messages(prompt), self.max_tokens,
+                                            self.temperature)
+                attrs['completion_tokens'] = self._count_completion_tokens(answer)
+            return answer
         except Exception as e:
-            return f"Xin lỗi, có lỗi xảy ra khi xử lý: {str(e)}"
+            return f"{ERROR_ANSWER_PREFIX}: {str(e)}"
 
-    def answer_question_with_user_context(self, query: str, user_id: str, top_k: int = None):
+    def _stream_with_openai(self, prompt: str):
+        """Như _generate_with_openai nhưng trả về từng đoạn text ngay khi model sinh ra"""
+        stream = None
+        started, parts = time.perf_counter(), []
+        try:
+            stream = self.provider.stream_chat(self.chat_model, self._chat_messages(prompt),
+                                               self.max_tokens, self.temperature)
+            for delta in stream:
+                if not parts:
+                    tracing.record("llm.first_token", time.perf_counter() - started, model=self.chat_model)
+                parts.append(delta)
+                yield delta
+        except Exception as e:
+            yield f"{ERROR_ANSWER_PREFIX}: {str(e)}"
+        finally:
+            # Người nhận dừng sớm (client ngắt, bản dự phòng bị hủy): đóng kết nối để OpenAI ngừng sinh
+            if stream is not None:
+                stream.close()
+            tracing.record("llm.stream", time.perf_counter() - started, model=self.chat_model,
+                           completion_tokens=self._count_completion_tokens(''.join(parts)))
+
+    def _generate_cancellable(self, prompt: str, cancel: threading.Event):
+        """Sinh qua streaming để có thể dừng giữa chừng; trả về (câu trả lời hoặc None nếu bị hủy, số giây)"""
+        started = time.perf_counter()
+        if cancel.is_set():
+            return None, 0.0
+        parts = []
+        stream = self._stream_with_openai(prompt)
+        try:
+            for delta in stream:
+                if cancel.is_set():
+                    return None, time.perf_counter() - started
+                parts.append(delta)
+        finally:
+            stream.close()
+        return ''.join(parts).strip(), time.perf_counter() - started
+
+    def stream_answer(self, query: str, user_id: str = None, top_k: int = None):
+        """
+        Phiên bản streaming của answer_question / answer_question_with_user_context.
+        Truy hồi context như bình thường rồi yield từng đoạn câu trả lời. Không có bước
+        sinh lại khi câu trả lời quá ngắn / thiếu ngữ liệu vì phần đã gửi không thu hồi được.
+        """
         if top_k is None:
             top_k = self.top_k
+        cache_key, corpus, semantic_namespace = None, None, None
         try:
-            user_chunks = self.user_embedding_service.get_user_context(user_id, query, top_k)
-            global_chunks = self.get_global_context(query, top_k)
-            all_chunks = user_chunks + global_chunks
+            user_chunks = self.user_embedding_service.get_user_candidates(user_id, query, top_k) if user_id else []
+            corpus = self.corpus
+            global_chunks = []
+            query_embedding = self._retrieval_embedding(query)
+            if query_embedding is not None and not user_chunks and semantic_cache.allows("stream_answer"):
+                semantic_namespace = self._semantic_namespace(corpus)
+                cached = semantic_cache.get(query_embedding, semantic_namespace)
+                if cached is not None:
+                    yield cached
+                    return
+            if query_embedding is not None or self._has_lexical(corpus):
+                top_indices = self._search_global(corpus, query_embedding, top_k, query)
+                global_chunks = self._global_candidates(corpus, query_embedding, top_indices)
+                if user_chunks:
+                    answer_cache.record_bypass()
+                else:
+                    cache_key = self._answer_cache_key(query, corpus, top_indices)
+            chunks = user_chunks + global_chunks
+        except Exception as e:
+            print(f"Lỗi khi lấy context cho streaming: {e}")
+            chunks = []
 
-            if not all_chunks:
-                print("⚠️ Không có dữ liệu user hoặc global. Trả lời tổng quát kèm lưu ý thiếu ngữ liệu.")
-                return self._generate_with_openai(self._build_prompt(query, []))
+        if cache_key is not None:
+            cached = answer_cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+        if not chunks:
+            print("⚠️ Không có ngữ liệu phù hợp. Trả lời tổng quát kèm lưu ý thiếu ngữ liệu.")
 
-            prompt = self._build_prompt(query, all_chunks)
-            answer = self._generate_with_openai(prompt)
+        parts = []
+        for delta in self._stream_with_openai(self._build_prompt(query, chunks)):
+            parts.append(delta)
+            yield delta
+        answer = ''.join(parts)
+        # Chỉ lưu câu trả lời mà bản không streaming cũng sẽ chấp nhận
+        if cache_key is not None and (not chunks or self._is_valid_answer(answer)):
+            self._remember_answer(cache_key, corpus, answer)
+            if semantic_namespace is not None:
+                self._remember_semantic(query_embedding, query, answer, semantic_namespace)
 
-            if not answer or len(answer.strip()) < 50:
-                print("⚠️ Trả lời không hợp lệ. Sinh lại trả lời tổng quát.")
-                return self._generate_with_openai(self._build_prompt(query, []))
-            
-            BAD_PHRASES = [
-                "tôi không tìm thấy", 
-                "không có thông tin",
-                "không đủ dữ liệu", 
-                "tài liệu không đề cập"
-            ]
-            if any(phrase in answer.lower() for phrase in BAD_PHRASES):
-                print("⚠️ Trả lời không hợp lệ. Sinh lại trả lời tổng quát.")
-                return self._generate_with_openai(self._build_prompt(query, []))
-            
-            return answer
+    def answer_question_with_user_context(self, query: str, user_id: str, top_k: int = None):
+        if top_k is None:
+            top_k = self.top_k
+        try:
+            user_chunks = self.user_embedding_service.get_user_candidates(user_id, query, top_k)
+            if not user_chunks:
+                # Không có context cá nhân: câu trả lời chỉ phụ thuộc corpus chung, dùng được cache
+                return self.answer_question(query, top_k, cache_endpoint="answer_question_with_user_context")
+
+            # Context cá nhân: không tra / lưu cache câu trả lời
+            answer_cache.record_bypass()
+            corpus = self.corpus
+            query_embedding = self._retrieval_embedding(query)
+            top_indices = self._search_global(corpus, query_embedding, top_k, query)
+            global_chunks = self._global_candidates(corpus, query_embedding, top_indices)
+            return self._answer_from_context(query, user_chunks + global_chunks)
         except Exception as e:
             print(f"Lỗi trong RAG với user context: {e}")
             return self._generate_with_openai(self._build_prompt(query, []))
 
-    def answer_question(self, query, top_k: int = None):
+    def answer_question(self, query, top_k: int = None, cache_endpoint: str = "answer_question",
+                        filters: dict = None):
+        """
+        cache_endpoint: tên endpoint để bật / tắt cache ngữ nghĩa (RAG_SEMANTIC_CACHE_ENDPOINTS).
+        filters: bộ lọc metadata của chunk, ví dụ {'source_type': 'file', 'category_ids': [3], 'status__not': 1}.
+        """
         if top_k is None:
             top_k = self.top_k
         try:
-            query_embedding = self.get_openai_embedding(query)
-            if not query_embedding:
+            query_embedding = self._retrieval_embedding(query)
+            # Giữ một snapshot corpus cho cả truy vấn (tránh lệch khi đang hot-reload)
+            corpus = self.corpus
+            if query_embedding is None and not self._has_lexical(corpus):
                 return self._generate_with_openai(self._build_prompt(query, []))
 
-            query_embedding = np.array(query_embedding).reshape(1, -1)
-            similarities = cosine_similarity(query_embedding, self.embeddings)[0]
-            top_indices = np.argsort(similarities)[-top_k:][::-1]
-            relevant_chunks = [self.chunks[i] for i in top_indices if similarities[i] >= SIM_THRESHOLD]
+            semantic_namespace = None
+            if query_embedding is not None and semantic_cache.allows(cache_endpoint):
+                # Câu hỏi gần nghĩa với câu đã trả lời: bỏ qua cả truy hồi lẫn chat completion
+                semantic_namespace = self._semantic_namespace(corpus, filters)
+                cached = semantic_cache.get(query_embedding, semantic_namespace)
+                if cached is not None:
+                    return cached
+
+            top_indices = self._search_global(corpus, query_embedding, top_k, query, filters)
+            relevant_chunks = self._global_candidates(corpus, query_embedding, top_indices)
+
+            cache_key = self._answer_cache_key(query, corpus, top_indices)
+            cached = answer_cache.get(cache_key)
+            if cached is not None:
+                return cached
 
             if not relevant_chunks:
                 print("⚠️ Không tìm được chunk phù hợp. Trả lời tổng quát.")
-                return self._generate_with_openai(self._build_prompt(query, []))
+                answer = self._generate_with_openai(self._build_prompt(query, []))
+            else:
+                answer = self._answer_from_context(query, relevant_chunks)
+            self._remember_answer(cache_key, corpus, answer)
+            if semantic_namespace is not None:
+                self._remember_semantic(query_embedding, query, answer, semantic_namespace)
+            return answer
+        except Exception as e:
+            print(f"Lỗi trong RAG: {e}")
+            return self._generate_with_openai(self._build_prompt(query, []))
 
-            prompt = self._build_prompt(query, relevant_chunks)
-            answer = self._generate_with_openai(prompt)
+    def _answer_from_context(self, query: str, chunks: list) -> str:
+        """
+        Sinh câu trả lời dựa trên ngữ liệu; câu trả lời không hợp lệ thì sinh lại bản tổng quát.
+        chunks: text hoặc ContextCandidate (kèm điểm / vector để xếp thứ tự khi ghép prompt).
+        """
+        if not chunks:
+            print("⚠️ Không có dữ liệu user hoặc global. Trả lời tổng quát kèm lưu ý thiếu ngữ liệu.")
+            return self._generate_with_openai(self._build_prompt(query, []))
 
-            if not answer or len(answer.strip()) < 50:
-                print("⚠️ Trả lời không hợp lệ. Trả lời tổng quát.")
-                return self._generate_with_openai(self._build_prompt(query, []))
-            
-            BAD_PHRASES = [
-                "tôi không tìm thấy", 
-                "không có thông tin",
-                "không đủ dữ liệu", 
-                "tài liệu không đề cập"
-            ]
-            if any(phrase in answer.lower() for phrase in BAD_PHRASES):
-                return self._generate_with_openai(self._build_prompt(query, []))
-            
+        if self.speculative_fallback:
+            return self._answer_speculatively(query, chunks)
+
+        started = time.perf_counter()
+        answer = self._generate_with_openai(self._build_prompt(query, chunks))
+        grounded_seconds = time.perf_counter() - started
+        if not self._is_valid_answer(answer):
+            print("⚠️ Trả lời không hợp lệ. Sinh lại trả lời tổng quát.")
+            answer = self._generate_with_openai(self._build_prompt(query, []))
+            elapsed = time.perf_counter() - started
+            fallback_stats.record(True, False, grounded_seconds, elapsed - grounded_seconds, elapsed)
+            return answer
+        fallback_stats.record(False, False, grounded_seconds, wall_seconds=grounded_seconds)
+        return answer
+
+    def _answer_speculatively(self, query: str, chunks: list) -> str:
+        """Chạy bản tổng quát dự phòng song song với bản theo ngữ liệu thay vì đợi bản đầu bị loại"""
+        started = time.perf_counter()
+        cancel = threading.Event()
+        future = _fallback_executor().submit(self._generate_cancellable, self._build_prompt(query, []), cancel)
+        answer = self._generate_with_openai(self._build_prompt(query, chunks))
+        grounded_seconds = time.perf_counter() - started
+        if self._is_valid_answer(answer):
+            # Bản theo ngữ liệu dùng được: hủy bản dự phòng (chưa chạy thì bỏ hẳn, đang chạy thì ngắt stream)
+            cancel.set()
+            future.cancel()
+            fallback_stats.record(False, True, grounded_seconds, wall_seconds=grounded_seconds, cancelled=True)
+            return answer
+
+        print("⚠️ Trả lời không hợp lệ. Dùng trả lời tổng quát sinh song song.")
+        try:
+            fallback, fallback_seconds = future.result()
+        except Exception as e:
+            print(f"Lỗi khi sinh trả lời dự phòng: {e}")
+            fallback, fallback_seconds = None, 0.0
+        if not fallback:
+            fallback = self._generate_with_openai(self._build_prompt(query, []))
+            fallback_seconds = time.perf_counter() - started - grounded_seconds
+        fallback_stats.record(True, True, grounded_seconds, fallback_seconds, time.perf_counter() - started)
+        return fallback
+
+    # -------- Async (ASGI): không chiếm thread trong lúc chờ OpenAI --------
+    async def aget_openai_embedding(self, text):
+        try:
+            with tracing.span("rag.embed"):
+                return await query_embedding_cache.aembed_query(self.embeddings_model, text)
+        except Exception as e:
+            print(f"Lỗi khi tạo embedding OpenAI: {e}")
+            return None
+
+    async def _agenerate_with_openai(self, prompt: str):
+        try:
+            with tracing.span("llm.completion", model=self.chat_model) as attrs:
+                answer = await self.provider.achat(self.chat_model, self._chat_messages(prompt),
+                                                   self.max_tokens, self.temperature)
+                attrs['completion_tokens'] = self._count_completion_tokens(answer)
             return answer
+        except Exception as e:
+            return f"{ERROR_ANSWER_PREFIX}: {str(e)}"
+
+    async def _agenerate_timed(self, prompt: str):
+        started = time.perf_counter()
+        answer = await self._agenerate_with_openai(prompt)
+        return answer, time.perf_counter() - started
+
+    async def _astream_with_openai(self, prompt: str):
+        stream = None
+        started, parts = time.perf_counter(), []
+        try:
+            stream = self.provider.astream_chat(self.chat_model, self._chat_messages(prompt),
+                                                self.max_tokens, self.temperature)
+            async for delta in stream:
+                if not parts:
+                    tracing.record("llm.first_token", time.perf_counter() - started, model=self.chat_model)
+                parts.append(delta)
+                yield delta
+        except Exception as e:
+            yield f"{ERROR_ANSWER_PREFIX}: {str(e)}"
+        finally:
+            if stream is not None:
+                await stream.aclose()
+            tracing.record("llm.stream", time.perf_counter() - started, model=self.chat_model,
+                           completion_tokens=self._count_completion_tokens(''.join(parts)))
+
+    async def _acorpus(self):
+        # Lần đầu (hoặc khi index đổi) registry mở lại kho vector: không làm trên event loop
+        return await asyncio.to_thread(lambda: self.corpus)
+
+    async def _aretrieve(self, query: str, query_embedding, user_id: str, top_k: int):
+        """
+        Truy hồi cá nhân và global đồng thời trên cùng một embedding câu hỏi:
+        (corpus, user_chunks (ContextCandidate), top_indices)
+        """
+        corpus = await self._acorpus()
+        searches = [asyncio.to_thread(self._search_global, corpus, query_embedding, top_k, query)]
+        user_id = user_id if query_embedding is not None else None
+        if user_id:
+            searches.append(asyncio.to_thread(
+                self.user_embedding_service.search_user_candidates, str(user_id), query_embedding, top_k))
+        results = await asyncio.gather(*searches)
+        user_chunks = results[1] if user_id else []
+        return corpus, user_chunks, results[0]
+
+    async def aget_global_context(self, query: str, top_k: int = None, filters: dict = None):
+        if top_k is None:
+            top_k = self.top_k
+        try:
+            query_embedding = await self._aretrieval_embedding(query)
+            corpus = await self._acorpus()
+            top_indices = await asyncio.to_thread(self._search_global, corpus, query_embedding, top_k, query, filters)
+            return [corpus.chunks[i] for i in top_indices]
+        except Exception as e:
+            print(f"Lỗi khi lấy global context: {e}")
+            return []
+
+    async def aanswer_question(self, query, top_k: int = None, cache_endpoint: str = "answer_question",
+                               filters: dict = None):
+        if top_k is None:
+            top_k = self.top_k
+        try:
+            query_embedding = await self._aretrieval_embedding(query)
+            corpus = await self._acorpus()
+            if query_embedding is None and not self._has_lexical(corpus):
+                return await self._agenerate_with_openai(self._build_prompt(query, []))
+            return await self._aanswer_global(query, query_embedding, corpus, top_k, cache_endpoint,
+                                              filters=filters)
         except Exception as e:
             print(f"Lỗi trong RAG: {e}")
-            return self._generate_with_openai(self._build_prompt(query, []))
+            return await self._agenerate_with_openai(self._build_prompt(query, []))
+
+    async def aanswer_question_with_user_context(self, query: str, user_id: str, top_k: int = None):
+        if top_k is None:
+            top_k = self.top_k
+        try:
+            # Truy hồi cá nhân luôn cần embedding (kể cả khi corpus chung ở chế độ lexical)
+            query_embedding = await self.aget_openai_embedding(query)
+            corpus, user_chunks, top_indices = await self._aretrieve(query, query_embedding, user_id, top_k)
+            if query_embedding is None and not self._has_lexical(corpus):
+                return await self._agenerate_with_openai(self._build_prompt(query, []))
+            if not user_chunks:
+                return await self._aanswer_global(query, query_embedding, corpus, top_k,
+                                                  "answer_question_with_user_context", top_indices)
+
+            answer_cache.record_bypass()
+            global_chunks = self._global_candidates(corpus, query_embedding, top_indices)
+            return await self._aanswer_from_context(query, user_chunks + global_chunks)
+        except Exception as e:
+            print(f"Lỗi trong RAG với user context: {e}")
+            return await self._agenerate_with_openai(self._build_prompt(query, []))
+
+    async def _aanswer_global(self, query: str, query_embedding, corpus, top_k: int, cache_endpoint: str,
+                              top_indices=None, filters: dict = None):
+        """Như phần thân của answer_question: cache ngữ nghĩa, truy hồi (nếu chưa có), cache câu trả lời, sinh"""
+        semantic_namespace = None
+        if query_embedding is not None and semantic_cache.allows(cache_endpoint):
+            semantic_namespace = self._semantic_namespace(corpus, filters)
+            cached = semantic_cache.get(query_embedding, semantic_namespace)
+            if cached is not None:
+                return cached
+        if top_indices is None:
+            top_indices = await asyncio.to_thread(self._search_global, corpus, query_embedding, top_k, query, filters)
+
+        cache_key = self._answer_cache_key(query, corpus, top_indices)
+        cached = answer_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        answer = await self._aanswer_from_context(query, self._global_candidates(corpus, query_embedding, top_indices))
+        self._remember_answer(cache_key, corpus, answer)
+        if semantic_namespace is not None:
+            self._remember_semantic(query_embedding, query, answer, semantic_namespace)
+        return answer
+
+    async def _aanswer_from_context(self, query: str, chunks: list) -> str:
+        """Bản async của _answer_from_context; chế độ speculative dùng task asyncio (hủy được ngay)"""
+        if not chunks:
+            print("⚠️ Không có dữ liệu user hoặc global. Trả lời tổng quát kèm lưu ý thiếu ngữ liệu.")
+            return await self._agenerate_with_openai(self._build_prompt(query, []))
+
+        started = time.perf_counter()
+        fallback_task = None
+        if self.speculative_fallback:
+            fallback_task = asyncio.create_task(self._agenerate_timed(self._build_prompt(query, [])))
+        try:
+            answer = await self._agenerate_with_openai(self._build_prompt(query, chunks))
+        except BaseException:
+            if fallback_task is not None:
+                fallback_task.cancel()
+            raise
+        grounded_seconds = time.perf_counter() - started
+        speculative = fallback_task is not None
+        if self._is_valid_answer(answer):
+            if speculative:
+                fallback_task.cancel()
+            fallback_stats.record(False, speculative, grounded_seconds, wall_seconds=grounded_seconds,
+                                  cancelled=speculative)
+            return answer
 
-    def get_global_context(self, query: str, top_k: int = None):
+        print("⚠️ Trả lời không hợp lệ. Sinh lại trả lời tổng quát.")
+        if speculative:
+            fallback, fallback_seconds = await fallback_task
+        else:
+            fallback, fallback_seconds = await self._agenerate_timed(self._build_prompt(query, []))
+        fallback_stats.record(True, speculative, grounded_seconds, fallback_seconds,
+                              time.perf_counter() - started)
+        return fallback
+
+    async def astream_answer(self, query: str, user_id: str = None, top_k: int = None):
+        """Bản async của stream_answer (async generator), truy hồi cá nhân và global đồng thời"""
+        if top_k is None:
+            top_k = self.top_k
+        cache_key, corpus, semantic_namespace, query_embedding = None, None, None, None
+        chunks = []
+        try:
+            if user_id:
+                query_embedding = await self.aget_openai_embedding(query)
+            else:
+                query_embedding = await self._aretrieval_embedding(query)
+            corpus, user_chunks, top_indices = await self._aretrieve(query, query_embedding, user_id, top_k)
+            if query_embedding is not None or self._has_lexical(corpus):
+                if user_chunks:
+                    answer_cache.record_bypass()
+                else:
+                    if query_embedding is not None and semantic_cache.allows("stream_answer"):
+                        semantic_namespace = self._semantic_namespace(corpus)
+                        cached = semantic_cache.get(query_embedding, semantic_namespace)
+                        if cached is not None:
+                            yield cached
+                            return
+                    cache_key = self._answer_cache_key(query, corpus, top_indices)
+                chunks = user_chunks + self._global_candidates(corpus, query_embedding, top_indices)
+        except Exception as e:
+            print(f"Lỗi khi lấy context cho streaming: {e}")
+            chunks = []
+
+        if cache_key is not None:
+            cached = answer_cache.get(cache_key)
+            if cached is not None:
+                yield cached
+                return
+        if not chunks:
+            print("⚠️ Không có ngữ liệu phù hợp. Trả lời tổng quát kèm lưu ý thiếu ngữ liệu.")
+
+        parts = []
+        async for delta in self._astream_with_openai(self._build_prompt(query, chunks)):
+            parts.append(delta)
+            yield delta
+        answer = ''.join(parts)
+        if cache_key is not None and (not chunks or self._is_valid_answer(answer)):
+            self._remember_answer(cache_key, corpus, answer)
+            if semantic_namespace is not None:
+                self._remember_semantic(query_embedding, query, answer, semantic_namespace)
+
+    @staticmethod
+    def _is_valid_answer(answer: str) -> bool:
+        if not answer or len(answer.strip()) < 50:
+            return False
+        return not any(phrase in answer.lower() for phrase in BAD_PHRASES)
+
+    def _answer_cache_key(self, query: str, corpus, top_indices) -> str:
+        index_version = corpus.index_version if corpus is not None else None
+        answer_cache.sync_index_version(index_version)
+        chunk_ids = corpus.chunk_ids(top_indices) if corpus is not None else []
+        return answer_cache.make_key(
+            query, chunk_ids, index_version, self.chat_model,
+            self.temperature, self.max_tokens, PROMPT_TEMPLATE_VERSION
+        )
+
+    def _remember_answer(self, cache_key: str, corpus, answer: str):
+        # Không cache thông báo lỗi (lỗi mạng / quota chỉ là tạm thời)
+        if answer and not answer.startswith(ERROR_ANSWER_PREFIX):
+            answer_cache.put(cache_key, answer, corpus.index_version if corpus is not None else None)
+
+    def answer_cache_stats(self) -> dict:
+        return answer_cache.stats()
+
+    def _semantic_namespace(self, corpus, filters: dict = None) -> str:
+        """Câu trả lời chỉ được dùng lại với cùng model, tham số sinh, prompt, phiên bản index và bộ lọc"""
+        index_version = corpus.index_version if corpus is not None else None
+        namespace = f"{self.chat_model}|{self.temperature}|{self.max_tokens}|{PROMPT_TEMPLATE_VERSION}|{index_version}"
+        if filters:
+            namespace += "|" + json.dumps(filters, sort_keys=True, default=str)
+        return namespace
+
+    @staticmethod
+    def _remember_semantic(query_embedding, query: str, answer: str, namespace: str):
+        if answer and not answer.startswith(ERROR_ANSWER_PREFIX):
+            semantic_cache.put(query_embedding, query, answer, namespace)
+
+    def semantic_cache_stats(self) -> dict:
+        return semantic_cache.stats()
+
+    def generation_fallback_stats(self) -> dict:
+        return fallback_stats.stats()
+
+    def prompt_context_stats(self) -> dict:
+        return context_stats.stats()
+
+    def get_global_context(self, query: str, top_k: int = None, filters: dict = None):
+        """Top-k chunk của corpus chung; filters lọc theo metadata chunk (xem answer_question)"""
         if top_k is None:
             top_k = self.top_k
-        if not self.chunks or len(self.embeddings) == 0:
+        corpus = self.corpus
+        if corpus is None or len(corpus) == 0:
             return []
         try:
-            query_embedding = self.get_openai_embedding(query)
-            if not query_embedding:
-                return []
-            query_embedding = np.array(query_embedding).reshape(1, -1)
-            similarities = cosine_similarity(query_embedding, self.embeddings)[0]
-            top_indices = np.argsort(similarities)[-top_k:][::-1]
-            return [self.chunks[i] for i in top_indices if similarities[i] >= SIM_THRESHOLD]
+            query_embedding = self._retrieval_embedding(query)
+            top_indices = self._search_global(corpus, query_embedding, top_k, query, filters)
+            return [corpus.chunks[i] for i in top_indices]
         except Exception as e:
             print(f"Lỗi khi lấy global context: {e}")
             return []
 
-    def _build_prompt(self, query: str, context_chunks: List[str]) -> str:
-        """Xây prompt rõ ràng, giảm ảo giác và tăng cấu trúc câu trả lời."""
-        context_block = "\n".join([f"- {c}" for c in context_chunks]) if context_chunks else "(Không có ngữ liệu phù hợp)"
+    def search_chunks(self, query: str, top_k: int = None, filters: dict = None) -> List[dict]:
+        """
+        Như get_global_context nhưng trả về bản ghi chunk: {'id', 'text', 'source_model', 'source_id', 'offset',
+        'tokens', 'index_version'}; id ổn định giữa các lần build lại (dùng cho trích dẫn, cache, lọc).
+        """
+        if top_k is None:
+            top_k = self.top_k
+        corpus = self.corpus
+        if corpus is None or len(corpus) == 0:
+            return []
+        try:
+            query_embedding = self._retrieval_embedding(query)
+            top_indices = self._search_global(corpus, query_embedding, top_k, query, filters)
+            return [corpus.chunk_record(int(i)) for i in top_indices]
+        except Exception as e:
+            print(f"Lỗi khi truy hồi chunk: {e}")
+            return []
+
+    def search_many(self, queries: List[str], top_k: int = None, scope: str = "global", user_id: str = None,
+                    filters: dict = None):
+        """
+        Truy hồi cho nhiều câu hỏi một lượt (agent, đánh giá offline, tính trước nội dung liên quan).
+        scope: "global" (corpus chung), "user" (embeddings của user_id) hoặc "all" (gộp cả hai theo điểm).
+        Returns: với mỗi câu hỏi, danh sách {'chunk_id', 'row', 'score', 'text', 'source'} giảm dần theo điểm;
+        chunk_id là id ổn định của chunk (bảng chunk của corpus; hash nội dung với dữ liệu user),
+        row là số dòng trong corpus (global) hoặc trong dữ liệu của user (user).
+        filters: bộ lọc metadata, chỉ áp dụng cho corpus chung.
+        """
+        if scope not in ("global", "user", "all"):
+            raise ValueError(f"scope không hợp lệ: {scope}")
+        if scope != "global" and user_id is None:
+            raise ValueError("Cần user_id cho scope 'user'/'all'")
+        if top_k is None:
+            top_k = self.top_k
+        results = [[] for _ in queries]
+        if not queries:
+            return results
+
+        try:
+            # Một lần gọi API cho các câu hỏi chưa có trong cache
+            query_matrix = query_embedding_cache.embed_many(self.embeddings_model, list(queries))
+        except Exception as e:
+            print(f"Lỗi khi tạo embedding cho {len(queries)} câu hỏi: {e}")
+            return results
+
+        if scope in ("global", "all"):
+            corpus = self.corpus
+            if corpus is not None and len(corpus) > 0:
+                mask = self._filter_mask(corpus, filters)
+                if self._uses_index(corpus) or mask is not None:
+                    # IVF / mã nén / bộ lọc: chấm từng câu hỏi trên ứng viên riêng
+                    hits = [self._search_corpus(corpus, q, top_k, mask) for q in query_matrix]
+                else:
+                    hits = retrieval.search_many(corpus.vectors, query_matrix, top_k, SIM_THRESHOLD)
+                self._collect_hits(results, hits, corpus.chunks, "global", corpus.chunk_id)
+
+        if scope in ("user", "all"):
+            chunks, vectors = self.user_embedding_service.load_user_embeddings(user_id)
+            if len(chunks) > 0:
+                hits = retrieval.search_many(vectors, query_matrix, top_k,
+                                             self.user_embedding_service.sim_threshold)
+                self._collect_hits(results, hits, chunks, "user")
+
+        if scope == "all":
+            results = [sorted(r, key=lambda hit: hit['score'], reverse=True)[:top_k] for r in results]
+        return results
+
+    @staticmethod
+    def _collect_hits(results, hits, chunks, source: str, chunk_id=None):
+        for result, (indices, scores) in zip(results, hits):
+            for i, s in zip(indices, scores):
+                text = chunks[i]
+                result.append({
+                    'chunk_id': chunk_id(int(i)) if chunk_id is not None else make_chunk_id(text),
+                    'row': int(i), 'score': float(s), 'text': text, 'source': source,
+                })
+
+    def _search_global(self, corpus, query_embedding, top_k: int, query: str = None, filters: dict = None):
+        """
+        Chỉ số các chunk global phù hợp (rỗng nếu chưa có corpus).
+        Theo retrieval_mode: dense, hybrid (trộn với BM25) hoặc lexical; không có embedding thì dùng BM25.
+        filters: bộ lọc metadata, áp dụng trước khi chấm điểm ở mọi chế độ.
+        """
+        if corpus is None or len(corpus) == 0:
+            return []
+        with tracing.span("rag.search", mode=self.retrieval_mode, filtered=bool(filters)) as attrs:
+            top_indices = self._search_global_indices(corpus, query_embedding, top_k, query, filters)
+            attrs['hits'] = len(top_indices)
+        return top_indices
+
+    def _search_global_indices(self, corpus, query_embedding, top_k: int, query: str = None, filters: dict = None):
+        mask = self._filter_mask(corpus, filters)
+        lexical = corpus.lexical if query and self._has_lexical(corpus) else None
+        if lexical is not None and (query_embedding is None or self.retrieval_mode == "lexical"):
+            top_indices, _ = lexical.search(query, top_k, mask)
+            return top_indices
+        if query_embedding is None:
+            return []
+        if lexical is not None and self.retrieval_mode == "hybrid":
+            candidates = top_k * HYBRID_CANDIDATES_FACTOR
+            dense_indices, _ = self._search_corpus(corpus, query_embedding, candidates, mask)
+            lexical_indices, _ = lexical.search(query, candidates, mask)
+            return reciprocal_rank_fusion([dense_indices, lexical_indices], top_k)
+        top_indices, _ = self._search_corpus(corpus, query_embedding, top_k, mask)
+        return top_indices
+
+    @staticmethod
+    def _global_candidates(corpus, query_embedding, top_indices) -> List[ContextCandidate]:
+        """Chunk global kèm cosine với câu hỏi và vector (chỉ đọc top_k dòng của ma trận)"""
+        indices = np.asarray(top_indices, dtype=np.int64)
+        if corpus is None or len(indices) == 0:
+            return []
+        vectors = np.asarray(corpus.vectors[indices], dtype=np.float32)
+        # Chuẩn hóa câu hỏi như retrieval.top_k để điểm cùng thang với chunk của user
+        scores = vectors @ retrieval.normalize_vector(query_embedding) if query_embedding is not None else None
+        return [
+            ContextCandidate(corpus.chunks[int(i)], float(scores[k]) if scores is not None else None, vectors[k])
+            for k, i in enumerate(indices)
+        ]
+
+    @staticmethod
+    def _filter_mask(corpus, filters: dict = None):
+        """Mảng bool các chunk thỏa bộ lọc và chưa bị xóa bởi build tăng dần (None = không lọc)"""
+        live_mask = getattr(corpus, 'live_mask', None)
+        if not filters:
+            return live_mask
+        metadata_index = getattr(corpus, 'metadata_index', None)
+        if metadata_index is None:
+            # Không kiểm tra được bộ lọc (index cũ chưa có metadata): không trả chunk nào thay vì bỏ qua bộ lọc
+            print("⚠️ Corpus chưa có metadata chunk, cần train lại index để dùng bộ lọc")
+            return np.zeros(len(corpus), dtype=bool)
+        mask = metadata_index.mask(filters)
+        return mask if live_mask is None else mask & live_mask
+
+    @staticmethod
+    def _has_lexical(corpus) -> bool:
+        return corpus is not None and corpus.lexical is not None
+
+    def _retrieval_embedding(self, query: str):
+        """Embedding câu hỏi cho truy hồi corpus chung; chế độ lexical không gọi API embedding"""
+        if self.retrieval_mode == "lexical" and self._has_lexical(self.corpus):
+            return None
+        return self.get_openai_embedding(query)
+
+    async def _aretrieval_embedding(self, query: str):
+        if self.retrieval_mode == "lexical" and self._has_lexical(await self._acorpus()):
+            return None
+        return await self.aget_openai_embedding(query)
+
+    def _search_corpus(self, corpus, query_embedding, top_k: int, mask=None):
+        """
+        Top-k trên corpus: qua chỉ mục ANN hoặc mã nén nếu có và được bật, ngược lại tìm chính xác.
+        mask: chunk được phép (bộ lọc metadata), loại trước khi chấm điểm.
+        """
+        if corpus.ann is not None and self.ann_mode != "off":
+            return corpus.ann.search(corpus.vectors, query_embedding, top_k, self.ann_nprobe, SIM_THRESHOLD, mask)
+        if corpus.quantizer is not None and self.quant_mode != "off":
+            return corpus.quantizer.search(corpus.codes, corpus.vectors, query_embedding, top_k,
+                                           self.rescore_candidates, SIM_THRESHOLD, mask)
+        return retrieval.search(corpus.vectors, query_embedding, top_k, SIM_THRESHOLD, mask)
+
+    def _uses_index(self, corpus) -> bool:
+        return ((corpus.ann is not None and self.ann_mode != "off")
+                or (corpus.quantizer is not None and self.quant_mode != "off"))
+
+    def _build_prompt(self, query: str, context_chunks: list) -> str:
+        """
+        Xây prompt rõ ràng, giảm ảo giác và tăng cấu trúc câu trả lời.
+        Ngữ liệu đi qua ContextAssembler: bỏ chunk trùng, xếp theo điểm (MMR nếu bật), giới hạn theo ngân sách token.
+        """
+        with tracing.span("rag.assemble"):
+            context = self.context_assembler.assemble(context_chunks) if context_chunks else None
+        context_block = "\n".join([f"- {c}" for c in context.chunks]) if context and context.chunks else "(Không có ngữ liệu phù hợp)"
         guidance = (
             "YÊU CẦU TRẢ LỜI:\n"
             "1) Trả lời ngắn gọn, có cấu trúc (tiêu đề, mục, bullet khi cần).\n"
@@ -258,10 +831,50 @@ class RAGChatbotService:
             f"{guidance}\n\n"
             f"HÃY TRẢ LỜI:"
         )
+        prompt_tokens = count_tokens(prompt)
+        tracing.count("prompt_tokens", prompt_tokens)
+        if context is not None:
+            tracing.count("context_tokens", context.metrics['context_tokens'])
+            context_stats.record(context.metrics, prompt_tokens)
         return prompt
 
+    @staticmethod
+    def _count_completion_tokens(answer: str) -> int:
+        tokens = count_tokens(answer or '')
+        tracing.count("completion_tokens", tokens)
+        return tokens
+
     def get_user_profile(self, user_id: str):
         return self.user_embedding_service.get_user_profile(user_id)
 
     def list_users_with_embeddings(self) -> List[str]:
         return self.user_embedding_service.list_all_users()
+
+
+_fallback_pool = None
+_fallback_pool_lock = threading.Lock()
+
+
+def _fallback_executor() -> ThreadPoolExecutor:
+    """Thread pool chạy các bản trả lời dự phòng (dùng chung cả process)"""
+    global _fallback_pool
+    if _fallback_pool is None:
+        with _fallback_pool_lock:
+            if _fallback_pool is None:
+                _fallback_pool = ThreadPoolExecutor(max_workers=SPECULATIVE_WORKERS,
+                                                    thread_name_prefix="rag-fallback")
+    return _fallback_pool
+
+
+_shared_service = None
+_shared_service_lock = threading.Lock()
+
+
+def get_rag_service() -> RAGChatbotService:
+    """RAGChatbotService dùng chung cho cả worker process (khởi tạo lazy, thread-safe)"""
+    global _shared_service
+    if _shared_service is None:
+        with _shared_service_lock:
+            if _shared_service is None:
+                _shared_service = RAGChatbotService()
+    return _shared_service
@@ -0,0 +1,133 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+# Số dòng xử lý mỗi lượt khi ma trận không phải float32 (ví dụ float16 trên mmap),
+# để không phải chuyển cả ma trận sang float32 trong một lần
+SCORE_BLOCK_ROWS = 65536
+# Bộ lọc giữ ít hơn tỉ lệ này số dòng: chỉ chấm các dòng được giữ (gather), ngược lại chấm cả ma trận
+# (đọc tuần tự) rồi loại các dòng bị lọc
+MASK_GATHER_FRACTION = 0.5
+# Giới hạn số phần tử của khối điểm (dòng x câu hỏi) khi chấm nhiều câu hỏi cùng lúc (~64 MB float32)
+SCORE_BLOCK_ELEMENTS = 16 * 1024 * 1024
+
+
+def normalize_rows(matrix) -> np.ndarray:
+    """Chuẩn hóa từng dòng về độ dài 1 (float32). Dòng toàn 0 được giữ nguyên."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.size == 0:
+        return matrix.reshape(0, matrix.shape[1] if matrix.ndim == 2 else 0)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def normalize_vector(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def score(matrix: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Cosine similarity của query (đã chuẩn hóa) với ma trận đã chuẩn hóa: một phép nhân ma trận-vector"""
+    if matrix.dtype == np.float32:
+        return matrix @ query
+    scores = np.empty(matrix.shape[0], dtype=np.float32)
+    for start in range(0, matrix.shape[0], SCORE_BLOCK_ROWS):
+        block = np.asarray(matrix[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+        scores[start:start + len(block)] = block @ query
+    return scores
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Chỉ số của top_k điểm cao nhất (giảm dần), dùng argpartition thay vì sort toàn bộ"""
+    n = scores.shape[0]
+    if top_k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k < n:
+        candidates = np.argpartition(scores, n - top_k)[n - top_k:]
+    else:
+        candidates = np.arange(n)
+    return candidates[np.argsort(scores[candidates])[::-1]]
+
+
+def masked_score(score_fn, data, query: np.ndarray, mask: Optional[np.ndarray]):
+    """
+    Điểm của các dòng được bộ lọc giữ lại: (rows, scores), rows=None nghĩa là mọi dòng.
+    Bộ lọc chọn lọc mạnh chỉ chấm các dòng được giữ thay vì chấm hết rồi mới lọc.
+    """
+    if mask is None:
+        return None, score_fn(data, query)
+    rows = np.flatnonzero(mask)
+    if len(rows) < MASK_GATHER_FRACTION * len(mask):
+        return rows, score_fn(data[rows], query)
+    scores = score_fn(data, query)
+    return rows, scores[rows]
+
+
+def search(matrix: np.ndarray, query, top_k: int,
+           threshold: Optional[float] = None, mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Tìm top_k dòng gần query nhất trong ma trận đã chuẩn hóa.
+    mask: mảng bool theo dòng (bộ lọc metadata), chỉ các dòng True được xét.
+    Returns: (indices, scores) đã sắp xếp giảm dần, lọc theo threshold nếu có.
+    """
+    if matrix is None or len(matrix) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    rows, scores = masked_score(score, matrix, normalize_vector(query), mask)
+    indices = top_k_indices(scores, top_k)
+    selected = scores[indices]
+    if rows is not None:
+        indices = rows[indices]
+    if threshold is not None:
+        keep = selected >= threshold
+        indices, selected = indices[keep], selected[keep]
+    return indices, selected
+
+
+def search_many(matrix: np.ndarray, queries, top_k: int, threshold: Optional[float] = None,
+                block_elements: int = SCORE_BLOCK_ELEMENTS) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Top_k cho nhiều câu hỏi một lượt: mỗi khối dòng của ma trận nhân với cả ma trận câu hỏi
+    (matrix-matrix), giữ top_k tạm thời của từng câu hỏi qua các khối để bộ nhớ bị chặn.
+    Returns: danh sách (indices, scores) theo thứ tự câu hỏi, giống search().
+    """
+    queries = normalize_rows(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+    n_queries = queries.shape[0]
+    empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+    if matrix is None or len(matrix) == 0 or n_queries == 0 or top_k <= 0:
+        return [empty for _ in range(n_queries)]
+
+    n = matrix.shape[0]
+    block_rows = max(1, min(n, block_elements // n_queries))
+    best_indices = np.empty((0, n_queries), dtype=np.int64)
+    best_scores = np.empty((0, n_queries), dtype=np.float32)
+    for start in range(0, n, block_rows):
+        block = np.asarray(matrix[start:start + block_rows], dtype=np.float32)
+        scores = block @ queries.T  # (dòng, câu hỏi)
+        k = min(top_k, len(block))
+        if k < len(block):
+            rows = np.argpartition(scores, len(block) - k, axis=0)[len(block) - k:]
+            scores = np.take_along_axis(scores, rows, axis=0)
+        else:
+            rows = np.broadcast_to(np.arange(len(block))[:, None], scores.shape)
+        # Gộp với top_k hiện có rồi cắt lại còn top_k
+        best_indices = np.concatenate([best_indices, rows + start])
+        best_scores = np.concatenate([best_scores, scores])
+        if len(best_scores) > top_k:
+            keep = np.argpartition(best_scores, len(best_scores) - top_k, axis=0)[len(best_scores) - top_k:]
+            best_indices = np.take_along_axis(best_indices, keep, axis=0)
+            best_scores = np.take_along_axis(best_scores, keep, axis=0)
+
+    order = np.argsort(-best_scores, axis=0, kind='stable')
+    best_indices = np.take_along_axis(best_indices, order, axis=0)
+    best_scores = np.take_along_axis(best_scores, order, axis=0)
+
+    results = []
+    for column in range(n_queries):
+        indices, selected = best_indices[:, column], best_scores[:, column]
+        if threshold is not None:
+            keep = selected >= threshold
+            indices, selected = indices[keep], selected[keep]
+        results.append((indices, selected))
+    return results
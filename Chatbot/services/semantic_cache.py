@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from . import retrieval
+from . import tracing
+
+load_dotenv()
+
+# "off" để tắt; ngưỡng cosine giữa hai câu hỏi để dùng lại câu trả lời
+SEMANTIC_CACHE_MODE = os.getenv("RAG_SEMANTIC_CACHE", "on")
+SEMANTIC_CACHE_SIZE = int(os.getenv("RAG_SEMANTIC_CACHE_SIZE", "2048"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("RAG_SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL = float(os.getenv("RAG_SEMANTIC_CACHE_TTL", "3600"))
+# Các endpoint của RAGChatbotService được phép dùng cache ngữ nghĩa
+SEMANTIC_CACHE_ENDPOINTS = os.getenv("RAG_SEMANTIC_CACHE_ENDPOINTS", "answer_question,stream_answer")
+
+# Số ứng viên gần nhất được xét (bỏ qua entry hết hạn / khác namespace)
+LOOKUP_CANDIDATES = 8
+
+
+class SemanticCache:
+    """
+    Cache câu trả lời theo độ gần nghĩa của câu hỏi: embedding các câu hỏi đã trả lời nằm trong
+    một ma trận float32 cấp phát sẵn (max_entries x dim, bộ nhớ cố định), tra bằng cùng kernel
+    với truy hồi (retrieval.search). Mỗi entry thuộc một namespace (model, tham số sinh, phiên bản
+    prompt và index) và chỉ được dùng lại trong đúng namespace đó.
+    """
+
+    def __init__(self, max_entries: int = SEMANTIC_CACHE_SIZE, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 ttl: float = SEMANTIC_CACHE_TTL, enabled: bool = SEMANTIC_CACHE_MODE != "off",
+                 endpoints: str = SEMANTIC_CACHE_ENDPOINTS, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.enabled = enabled and max_entries > 0
+        self.endpoints = {e.strip() for e in endpoints.split(',') if e.strip()}
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._vectors = None  # cấp phát khi biết số chiều của embedding
+        self._size = 0
+        self._answers = [None] * max_entries
+        self._queries = [None] * max_entries
+        self._namespaces = [None] * max_entries
+        self._expires = np.zeros(max_entries, dtype=np.float64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def allows(self, endpoint: str) -> bool:
+        return self.enabled and endpoint in self.endpoints
+
+    @property
+    def nbytes(self) -> int:
+        return int(self._vectors.nbytes) if self._vectors is not None else 0
+
+    def get(self, query_embedding, namespace: str) -> Optional[str]:
+        """Câu trả lời của câu hỏi gần nhất (>= ngưỡng, cùng namespace, chưa hết hạn), hoặc None"""
+        if not self.enabled:
+            return None
+        query = retrieval.normalize_vector(query_embedding)
+        with self._lock:
+            if self._size == 0 or self._vectors.shape[1] != query.shape[0]:
+                self.misses += 1
+                tracing.count("semantic_cache.miss")
+                return None
+            now = self._clock()
+            indices, _ = retrieval.search(self._vectors[:self._size], query, LOOKUP_CANDIDATES, self.threshold)
+            for i in indices:
+                if self._namespaces[i] != namespace:
+                    continue
+                if self._expires[i] <= now:
+                    # Hết hạn: đánh dấu để bị thay thế đầu tiên khi cache đầy
+                    self.expired += 1
+                    self._namespaces[i] = None
+                    self._last_used[i] = -np.inf
+                    continue
+                self._last_used[i] = now
+                self.hits += 1
+                tracing.count("semantic_cache.hit")
+                return self._answers[i]
+            self.misses += 1
+            tracing.count("semantic_cache.miss")
+            return None
+
+    def put(self, query_embedding, query: str, answer: str, namespace: str):
+        if not self.enabled:
+            return
+        vector = retrieval.normalize_vector(query_embedding)
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != vector.shape[0]:
+                # Lần đầu (hoặc đổi model embedding): cấp phát lại toàn bộ
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+                self._size = 0
+            now = self._clock()
+            if self._size < self.max_entries:
+                slot = self._size
+                self._size += 1
+            else:
+                # Đầy: thay entry lâu không dùng nhất
+                slot = int(np.argmin(self._last_used[:self._size]))
+                self.evictions += 1
+            self._vectors[slot] = vector
+            self._answers[slot] = answer
+            self._queries[slot] = query
+            self._namespaces[slot] = namespace
+            self._expires[slot] = now + self.ttl
+            self._last_used[slot] = now
+
+    def clear(self):
+        with self._lock:
+            self._size = 0
+            self._answers = [None] * self.max_entries
+            self._queries = [None] * self.max_entries
+            self._namespaces = [None] * self.max_entries
+            self.hits = self.misses = self.expired = self.evictions = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'endpoints': sorted(self.endpoints),
+            'entries': self._size,
+            'max_entries': self.max_entries,
+            'threshold': self.threshold,
+            'ttl': self.ttl,
+            'nbytes': self.nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# Cache mặc định của process
+semantic_cache = SemanticCache()
@@ -0,0 +1,232 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "off" để tắt đo span, log trace và header Server-Timing
+TRACING_MODE = os.getenv("RAG_TRACING", "on")
+# Biên trên (ms) các bucket của histogram độ trễ mỗi span
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+logger = logging.getLogger("chatbot.trace")
+_current_trace = contextvars.ContextVar("chatbot_trace", default=None)
+
+
+class Trace:
+    """
+    Các span (tên, thời gian, thuộc tính) và bộ đếm (token, cache hit) của một request.
+    Span từ thread khác (asyncio.to_thread, sync_to_async mang theo context) ghi vào cùng trace.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.spans = []
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, seconds: float, attrs: dict):
+        with self._lock:
+            self.spans.append((name, seconds, attrs))
+
+    def count(self, name: str, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @property
+    def duration_ms(self) -> float:
+        seconds = self.seconds if self.seconds is not None else time.perf_counter() - self.started
+        return seconds * 1000
+
+    def timings(self) -> dict:
+        """Tổng thời gian (ms) theo tên span, theo thứ tự xuất hiện đầu tiên"""
+        totals = {}
+        with self._lock:
+            for name, seconds, _ in self.spans:
+                totals[name] = totals.get(name, 0.0) + seconds * 1000
+        return totals
+
+    def server_timing(self) -> str:
+        """Giá trị header Server-Timing (DevTools hiển thị trong tab Timing)"""
+        parts = [f"{name};dur={ms:.1f}" for name, ms in self.timings().items()]
+        parts.append(f"total;dur={self.duration_ms:.1f}")
+        return ", ".join(parts)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = [dict(attrs, name=name, ms=round(seconds * 1000, 2)) for name, seconds, attrs in self.spans]
+            counters = dict(self.counters)
+        return {
+            'trace': self.name,
+            'trace_id': self.trace_id,
+            'ms': round(self.duration_ms, 2),
+            'spans': spans,
+            'counters': counters,
+        }
+
+
+class LatencyHistograms:
+    """Histogram độ trễ (bucket cố định) theo tên span và tổng các bộ đếm trong process"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.clear()
+
+    def record(self, name: str, seconds: float):
+        ms = seconds * 1000
+        with self._lock:
+            entry = self._spans.get(name)
+            if entry is None:
+                entry = self._spans[name] = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                                             'buckets': [0] * (len(self.buckets) + 1)}
+            entry['count'] += 1
+            entry['sum'] += ms
+            entry['max'] = max(entry['max'], ms)
+            entry['buckets'][self._bucket(ms)] += 1
+
+    def count(self, name: str, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def _bucket(self, ms: float) -> int:
+        for i, bound in enumerate(self.buckets):
+            if ms <= bound:
+                return i
+        return len(self.buckets)
+
+    def _percentile(self, entry: dict, q: float) -> float:
+        """Ước lượng phân vị bằng biên trên của bucket chứa nó (bucket cuối: max)"""
+        rank = q * entry['count']
+        seen = 0
+        for i, n in enumerate(entry['buckets']):
+            seen += n
+            if n and seen >= rank:
+                return float(self.buckets[i]) if i < len(self.buckets) else round(entry['max'], 1)
+        return round(entry['max'], 1)
+
+    def clear(self):
+        with self._lock:
+            self._spans = {}
+            self._counters = {}
+
+    def stats(self) -> dict:
+        with self._lock:
+            spans = {}
+            for name, entry in self._spans.items():
+                labels = [f"<={b}" for b in self.buckets] + [f">{self.buckets[-1]}"]
+                spans[name] = {
+                    'count': entry['count'],
+                    'mean_ms': round(entry['sum'] / entry['count'], 2),
+                    'max_ms': round(entry['max'], 2),
+                    'p50_ms': self._percentile(entry, 0.5),
+                    'p95_ms': self._percentile(entry, 0.95),
+                    'p99_ms': self._percentile(entry, 0.99),
+                    'buckets': {label: n for label, n in zip(labels, entry['buckets']) if n},
+                }
+            return {'spans': spans, 'counters': dict(self._counters)}
+
+
+# Histogram mặc định của process
+latency_histograms = LatencyHistograms()
+
+
+def enabled() -> bool:
+    return TRACING_MODE != "off"
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Đo một bước của pipeline. Yields dict thuộc tính để ghi thêm (số token, số chunk...).
+    Luôn cộng vào histogram của process; thuộc về trace của request hiện tại nếu có.
+    """
+    if not enabled():
+        yield attrs
+        return
+    started = time.perf_counter()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs['error'] = type(e).__name__
+        raise
+    finally:
+        record(name, time.perf_counter() - started, **attrs)
+
+
+def record(name: str, seconds: float, **attrs):
+    """Ghi một span đã đo sẵn (ví dụ thời gian tới token đầu tiên của stream)"""
+    if not enabled():
+        return
+    latency_histograms.record(name, seconds)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, seconds, attrs)
+
+
+def count(name: str, value=1):
+    """Cộng bộ đếm (token, cache hit / miss) cho trace hiện tại và cho cả process"""
+    if not enabled():
+        return
+    latency_histograms.count(name, value)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.count(name, value)
+
+
+@contextmanager
+def activate(trace: Trace):
+    """Gắn trace vào context hiện tại (dùng trong generator của response streaming)"""
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # Generator bị đóng từ context khác (client ngắt kết nối): chỉ gỡ trace khỏi context hiện tại
+            _current_trace.set(None)
+
+
+def finish(trace: Trace):
+    """Kết thúc trace: ghi tổng thời gian vào histogram và xuất một dòng log JSON"""
+    if trace.seconds is not None:
+        return
+    trace.seconds = time.perf_counter() - trace.started
+    if not enabled():
+        return
+    latency_histograms.record(trace.name, trace.seconds)
+    logger.info(json.dumps(trace.to_dict(), ensure_ascii=False, default=str))
+
+
+@contextmanager
+def trace(name: str):
+    """
+    Trace của một request. Nếu đã có trace đang chạy (view gọi lồng nhau) thì chỉ là một span của trace đó.
+    """
+    parent = _current_trace.get()
+    if parent is not None:
+        with span(name):
+            yield parent
+        return
+    request_trace = Trace(name)
+    try:
+        with activate(request_trace):
+            yield request_trace
+    finally:
+        finish(request_trace)
@@ -1,100 +1,304 @@
+import asyncio
 import os
-import json
+import threading
+from collections import OrderedDict
 import numpy as np
 from typing import List, Tuple, Optional
-from sklearn.metrics.pairwise import cosine_similarity
-from langchain_openai import OpenAIEmbeddings
 from dotenv import load_dotenv
+from .vector_store import load_vector_store, read_manifest, is_vector_store, store_fingerprint
+from .user_vector_store import UserVectorStore, UserSlice, get_user_vector_store
+from .query_embedding_cache import query_embedding_cache
+from .providers import get_provider
+from .context_assembler import ContextCandidate
+from . import retrieval
+from . import tracing
 
 load_dotenv()
 
+# Thư mục chứa file embeddings cá nhân kiểu cũ (mỗi user một file, trước khi gộp vào
+# user_vector_store). Chỉ còn dùng để đọc dự phòng cho user chưa migrate.
+USER_EMBEDDINGS_DIR = os.getenv("USER_EMBEDDINGS_DIR", ".")
+# Ngân sách bộ nhớ (bytes) cho cache ma trận embeddings của user trong mỗi process
+USER_CACHE_BYTES = int(os.getenv("USER_EMBEDDINGS_CACHE_BYTES", str(256 * 1024 * 1024)))
+
+
+def user_store_path(user_id: str, base_dir: str = None) -> str:
+    """Đường dẫn kho vector nhị phân riêng của user (định dạng cũ)"""
+    return os.path.join(base_dir or USER_EMBEDDINGS_DIR, f"user_{user_id}_embeddings")
+
+
+def user_json_path(user_id: str, base_dir: str = None) -> str:
+    """Đường dẫn file JSON cũ của user"""
+    return os.path.join(base_dir or USER_EMBEDDINGS_DIR, f"user_{user_id}_embeddings.json")
+
+
+class UserMatrixCache:
+    """
+    Cache LRU các kho embeddings của user, giới hạn theo tổng số bytes (không theo số entry).
+    Entry bị bỏ khi file trên đĩa đổi mtime/phiên bản; user ít dùng bị đẩy ra trước.
+    """
+
+    def __init__(self, max_bytes: int = USER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (fingerprint, store, nbytes)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _drop(self, key: str):
+        _, _, nbytes = self._entries.pop(key)
+        self.current_bytes -= nbytes
+
+    def get(self, key: str, fingerprint=None, loader=None):
+        """
+        Lấy entry theo key. Mặc định key là đường dẫn kho vector (fingerprint từ file);
+        có thể truyền fingerprint + loader riêng (ví dụ slice của user trong kho gộp).
+        """
+        if loader is None:
+            fingerprint = store_fingerprint(key)
+            loader = lambda: load_vector_store(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] == fingerprint:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                # Dữ liệu đã thay đổi: bỏ bản cũ
+                self._drop(key)
+            self.misses += 1
+
+        if fingerprint is None:
+            return None
+        store = loader()
+        if store is None:
+            return None
+        nbytes = store.nbytes
+        if nbytes > self.max_bytes:
+            # Lớn hơn cả ngân sách: phục vụ nhưng không giữ trong cache
+            return store
+
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (fingerprint, store, nbytes)
+            self.current_bytes += nbytes
+            while self.current_bytes > self.max_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+        return store
+
+    def invalidate(self, key: str = None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self.current_bytes = 0
+            elif key in self._entries:
+                self._drop(key)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# Cache mặc định của process
+user_matrix_cache = UserMatrixCache()
+
+
 class UserEmbeddingService:
-    def __init__(self):
-        # Sử dụng OpenAI embeddings
-        self.embeddings_model = OpenAIEmbeddings(model="text-embedding-3-small")  
+    def __init__(self, sim_threshold: float = 0.3, base_dir: str = None, cache: UserMatrixCache = None,
+                 store: UserVectorStore = None):
+        # Embeddings qua provider (RAG_MODEL_PROVIDER, mặc định OpenAI)
+        self.embeddings_model = get_provider().embeddings("text-embedding-3-small")
         # Hoặc "text-embedding-3-large" nếu cần độ chính xác cao hơn
-    
+        self.sim_threshold = sim_threshold
+        self.base_dir = base_dir or USER_EMBEDDINGS_DIR
+        self.cache = cache or user_matrix_cache
+        self.store = store or get_user_vector_store()
+
+    def _resolve_user_path(self, user_id: str) -> Optional[str]:
+        """File riêng kiểu cũ của user chưa migrate: kho nhị phân, rồi tới file JSON"""
+        store_path = user_store_path(user_id, self.base_dir)
+        if is_vector_store(store_path):
+            return store_path
+        json_path = user_json_path(user_id, self.base_dir)
+        if os.path.exists(json_path):
+            return json_path
+        return None
+
+    def _load_user_slice(self, user_id: str) -> Optional[UserSlice]:
+        """
+        Copy slice của user từ kho gộp (mmap) vào RAM để cache.
+        Shard có mã nén: chỉ copy mã, vector đầy đủ giữ view mmap để chấm lại top ứng viên.
+        """
+        user_slice = self.store.get_user(user_id)
+        if user_slice is None:
+            return None
+        if user_slice.codes is not None:
+            return UserSlice(user_slice.user_id, list(user_slice.chunks), user_slice.vectors, user_slice.info,
+                             quantizer=user_slice.quantizer, codes=np.array(user_slice.codes))
+        return UserSlice(user_slice.user_id, list(user_slice.chunks),
+                         np.array(user_slice.vectors, dtype=np.float32), user_slice.info)
+
+    def _load_user_data(self, user_id: str):
+        """UserSlice (kho gộp) hoặc VectorStore (file riêng kiểu cũ) của user, qua cache LRU"""
+        user_id = str(user_id)
+        entry, shard_fingerprint = self.store.user_entry(user_id)
+        if entry is not None:
+            user_slice = self.cache.get(
+                f"user:{user_id}",
+                fingerprint=(shard_fingerprint, entry.get('version')),
+                loader=lambda: self._load_user_slice(user_id),
+            )
+            if user_slice is not None:
+                return user_slice
+
+        path = self._resolve_user_path(user_id)
+        if path is None:
+            print(f"Embeddings của user {user_id} không tồn tại")
+            return None
+        return self.cache.get(path)
+
     def load_user_embeddings(self, user_id: str) -> Tuple[List[str], np.ndarray]:
         """
-        Load embeddings của user cụ thể từ file JSON
+        Load embeddings của user cụ thể qua cache LRU: kho gộp trước, file riêng kiểu cũ sau
         Returns: (chunks, embeddings)
         """
-        filename = f"user_{user_id}_embeddings.json"
-        
-        if not os.path.exists(filename):
-            print(f"File {filename} không tồn tại")
-            return [], np.array([])
-        
         try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                chunks = data.get('chunks', [])
-                embeddings = np.array(data.get('embeddings', []))
-                print(f"Đã load {len(chunks)} chunks cho user {user_id}")
-                return chunks, embeddings
+            data = self._load_user_data(user_id)
+            if data is None:
+                return [], np.array([])
+            return data.chunks, data.vectors
         except Exception as e:
             print(f"Lỗi khi load embeddings cho user {user_id}: {e}")
             return [], np.array([])
-    
+
     def get_user_context(self, user_id: str, query: str, top_k: int = 3) -> List[str]:
         """
         Lấy context liên quan từ dữ liệu của user
         """
-        chunks, embeddings = self.load_user_embeddings(user_id)
-        
-        if len(chunks) == 0 or len(embeddings) == 0:
+        return [c.text for c in self.get_user_candidates(user_id, query, top_k)]
+
+    def get_user_candidates(self, user_id: str, query: str, top_k: int = 3) -> List[ContextCandidate]:
+        """Như get_user_context nhưng kèm điểm và vector của từng chunk (cho bước ghép ngữ liệu vào prompt)"""
+        if not self._has_user_data(user_id):
+            return []
+        try:
+            # Tạo embedding cho câu hỏi (qua cache dùng chung với truy hồi global)
+            with tracing.span("user.embed"):
+                query_embedding = query_embedding_cache.embed_query(self.embeddings_model, query)
+        except Exception as e:
+            print(f"Lỗi khi tìm context cho user {user_id}: {e}")
+            return []
+        return self.search_user_candidates(user_id, query_embedding, top_k)
+
+    async def aget_user_context(self, user_id: str, query: str, top_k: int = 3) -> List[str]:
+        """Bản async của get_user_context: embedding qua AsyncOpenAI, tìm kiếm numpy chạy trong thread"""
+        if not await asyncio.to_thread(self._has_user_data, user_id):
             return []
-        
         try:
-            # Tạo embedding cho câu hỏi
-            query_embedding = self.embeddings_model.embed_query(query)
-            query_embedding = np.array(query_embedding).reshape(1, -1)
-            
-            # Tính similarity
-            similarities = cosine_similarity(query_embedding, embeddings)[0]
-            top_indices = np.argsort(similarities)[-top_k:][::-1]
-            
-            # Lấy các chunk có similarity > 0.3
-            relevant_chunks = []
-            for i in top_indices:
-                if similarities[i] > 0.3:
-                    relevant_chunks.append(chunks[i])
-            
-            return relevant_chunks
-            
+            with tracing.span("user.embed"):
+                query_embedding = await query_embedding_cache.aembed_query(self.embeddings_model, query)
         except Exception as e:
             print(f"Lỗi khi tìm context cho user {user_id}: {e}")
             return []
-    
+        return await asyncio.to_thread(self.search_user_context, user_id, query_embedding, top_k)
+
+    def _has_user_data(self, user_id: str) -> bool:
+        """Kiểm tra nhanh (index của kho gộp / file cũ) để không embed câu hỏi khi user chưa có dữ liệu"""
+        try:
+            return self.store.has_user(str(user_id)) or self._resolve_user_path(str(user_id)) is not None
+        except Exception as e:
+            print(f"Lỗi khi load embeddings cho user {user_id}: {e}")
+            return False
+
+    def search_user_context(self, user_id: str, query_embedding, top_k: int = 3) -> List[str]:
+        """Top-k chunk của user cho một embedding câu hỏi đã có (dùng chung cho bản sync và async)"""
+        return [c.text for c in self.search_user_candidates(user_id, query_embedding, top_k)]
+
+    def search_user_candidates(self, user_id: str, query_embedding, top_k: int = 3) -> List[ContextCandidate]:
+        try:
+            with tracing.span("user.load"):
+                data = self._load_user_data(user_id)
+        except Exception as e:
+            print(f"Lỗi khi load embeddings cho user {user_id}: {e}")
+            return []
+        if data is None or len(data.chunks) == 0 or len(data.vectors) == 0:
+            return []
+
+        try:
+            with tracing.span("user.search", chunks=len(data.chunks)):
+                return self._search_user_data(data, query_embedding, top_k)
+        except Exception as e:
+            print(f"Lỗi khi tìm context cho user {user_id}: {e}")
+            return []
+
+    def _search_user_data(self, data, query_embedding, top_k: int) -> List[ContextCandidate]:
+        # Top-k theo cosine similarity, chỉ lấy các chunk có similarity >= ngưỡng
+        if data.quantizer is not None:
+            top_indices, scores = data.quantizer.search(data.codes, data.vectors, query_embedding, top_k,
+                                                        threshold=self.sim_threshold)
+        else:
+            top_indices, scores = retrieval.search(data.vectors, query_embedding, top_k, self.sim_threshold)
+        return [
+            ContextCandidate(data.chunks[i], float(score), np.asarray(data.vectors[i], dtype=np.float32), 'user')
+            for i, score in zip(top_indices, scores)
+        ]
+
     def get_user_profile(self, user_id: str) -> Optional[dict]:
         """
-        Lấy thông tin profile của user từ file JSON
+        Lấy thông tin profile của user từ kho embeddings
         """
-        filename = f"user_{user_id}_embeddings.json"
-        
-        if not os.path.exists(filename):
-            return None
-        
+        user_id = str(user_id)
         try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            entry, _ = self.store.user_entry(user_id)
+            if entry is not None:
+                # Chỉ đọc index của shard, không cần mở ma trận
                 return {
-                    'user_id': data.get('user_id'),
-                    'total_chunks': data.get('total_chunks', 0),
-                    'created_at': data.get('created_at'),
-                    'has_data': len(data.get('chunks', [])) > 0
+                    'user_id': user_id,
+                    'total_chunks': entry['end'] - entry['start'],
+                    'created_at': entry.get('created_at'),
+                    'has_data': entry['end'] > entry['start']
                 }
+
+            path = self._resolve_user_path(user_id)
+            if path is None:
+                return None
+            if is_vector_store(path):
+                # Chỉ đọc manifest, không cần mở ma trận
+                manifest = read_manifest(path)
+                metadata = manifest.get('metadata', {})
+                return {
+                    'user_id': metadata.get('user_id', user_id),
+                    'total_chunks': manifest.get('count', 0),
+                    'created_at': manifest.get('created_at'),
+                    'has_data': manifest.get('count', 0) > 0
+                }
+            store = load_vector_store(path)
+            metadata = store.manifest.get('metadata', {})
+            return {
+                'user_id': metadata.get('user_id'),
+                'total_chunks': metadata.get('total_chunks', 0),
+                'created_at': metadata.get('created_at'),
+                'has_data': len(store) > 0
+            }
         except Exception as e:
             print(f"Lỗi khi load profile cho user {user_id}: {e}")
             return None
-    
+
     def list_all_users(self) -> List[str]:
         """
-        Liệt kê tất cả users có file embeddings
+        Liệt kê tất cả users có embeddings (theo index của kho gộp, không quét thư mục).
+        User còn file riêng kiểu cũ cần chạy `migrate_user_embeddings` để xuất hiện ở đây.
         """
-        users = []
-        for filename in os.listdir('.'):
-            if filename.startswith('user_') and filename.endswith('_embeddings.json'):
-                user_id = filename.replace('user_', '').replace('_embeddings.json', '')
-                users.append(user_id)
-        return users
+        return self.store.list_users()
@@ -0,0 +1,267 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+from .vector_store import VectorStore, new_index_version, write_vector_store, store_fingerprint
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ khóa trong process
+    fcntl = None
+
+load_dotenv()
+
+# Thư mục gốc tuyệt đối (không phụ thuộc CWD của worker)
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
+USER_INDEX_DIR = os.getenv("USER_INDEX_DIR", str(BASE_DIR / "user_index"))
+USER_INDEX_SHARDS = int(os.getenv("USER_INDEX_SHARDS", "32"))
+# Nén mã cho ma trận của shard: "" (không), "int8" hoặc "pq"
+USER_INDEX_QUANTIZATION = os.getenv("USER_INDEX_QUANTIZATION", "")
+
+LAYOUT_FILE = "layout.json"
+SHARD_INDEX_FILE = "index.json"
+
+
+class UserSlice:
+    """Dữ liệu embeddings của một user: các dòng [start, end) trong ma trận của shard"""
+
+    def __init__(self, user_id: str, chunks, vectors: np.ndarray, info: dict, quantizer=None, codes=None):
+        self.user_id = user_id
+        self.chunks = chunks
+        self.vectors = vectors
+        self.info = info
+        self.quantizer = quantizer
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.chunks)
+
+    @property
+    def version(self) -> str:
+        return self.info.get('version', '')
+
+    @property
+    def nbytes(self) -> int:
+        chunk_bytes = sum(len(c) for c in self.chunks)
+        if self.codes is not None:
+            # Có mã nén: chỉ mã nằm trong RAM, vector đầy đủ vẫn đọc qua mmap khi chấm lại
+            return int(self.codes.nbytes) + chunk_bytes
+        return int(self.vectors.nbytes) + chunk_bytes
+
+
+class _Shard:
+    def __init__(self, fingerprint, index: dict, store: Optional[VectorStore]):
+        self.fingerprint = fingerprint
+        self.index = index
+        self.store = store
+
+
+class UserVectorStore:
+    """
+    Kho vector cá nhân gộp, chia shard theo hash(user_id):
+        <root>/layout.json                  - số shard
+        <root>/shard_XX/index.json          - user_id -> khoảng dòng [start, end) + metadata
+        <root>/shard_XX/gen-<ver>/          - kho vector nhị phân (vector_store) của shard
+    Thay dữ liệu một user = ghi thế hệ mới của shard rồi os.replace index.json (nguyên tử).
+    """
+
+    def __init__(self, root: str = USER_INDEX_DIR, shards: int = USER_INDEX_SHARDS,
+                 quantization: str = USER_INDEX_QUANTIZATION):
+        self.root = os.path.abspath(root)
+        self.shards = self._read_layout() or shards
+        self.quantization = quantization or None
+        self._shards: Dict[int, _Shard] = {}
+        # RLock: khi ghi shard, luồng giữ khóa vẫn cần đọc lại trạng thái shard
+        self._lock = threading.RLock()
+
+    # -------- Layout --------
+    def _read_layout(self) -> Optional[int]:
+        try:
+            with open(os.path.join(self.root, LAYOUT_FILE), 'r', encoding='utf-8') as f:
+                return int(json.load(f)['shards'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _ensure_layout(self):
+        os.makedirs(self.root, exist_ok=True)
+        if self._read_layout() is None:
+            _atomic_write_json(os.path.join(self.root, LAYOUT_FILE), {'shards': self.shards})
+
+    def shard_of(self, user_id) -> int:
+        digest = hashlib.sha1(str(user_id).encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'big') % self.shards
+
+    def _shard_dir(self, shard: int) -> str:
+        return os.path.join(self.root, f"shard_{shard:02d}")
+
+    # -------- Đọc --------
+    def _load_shard(self, shard: int) -> _Shard:
+        index_path = os.path.join(self._shard_dir(shard), SHARD_INDEX_FILE)
+        fingerprint = store_fingerprint(index_path)
+        state = self._shards.get(shard)
+        if state is not None and state.fingerprint == fingerprint:
+            return state
+
+        index, store = {'users': {}}, None
+        if fingerprint is not None:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('generation'):
+                store = VectorStore.open(os.path.join(self._shard_dir(shard), index['generation']))
+        state = _Shard(fingerprint, index, store)
+        with self._lock:
+            self._shards[shard] = state
+        return state
+
+    def user_entry(self, user_id) -> Tuple[Optional[dict], object]:
+        """(entry trong index, fingerprint của shard) - tra cứu O(1), không đọc ma trận"""
+        state = self._load_shard(self.shard_of(user_id))
+        return state.index['users'].get(str(user_id)), state.fingerprint
+
+    def get_user(self, user_id) -> Optional[UserSlice]:
+        state = self._load_shard(self.shard_of(user_id))
+        entry = state.index['users'].get(str(user_id))
+        if entry is None or state.store is None:
+            return None
+        start, end = entry['start'], entry['end']
+        store = state.store
+        # View trên mmap, không copy
+        codes = store.codes[start:end] if store.codes is not None else None
+        return UserSlice(str(user_id), store.chunks[start:end], store.vectors[start:end], entry,
+                         quantizer=store.quantizer, codes=codes)
+
+    def list_users(self) -> List[str]:
+        users = []
+        for shard in range(self.shards):
+            users.extend(self._load_shard(shard).index['users'].keys())
+        return sorted(users)
+
+    def has_user(self, user_id) -> bool:
+        return self.user_entry(user_id)[0] is not None
+
+    # -------- Ghi --------
+    @contextmanager
+    def _shard_lock(self, shard: int):
+        shard_dir = self._shard_dir(shard)
+        os.makedirs(shard_dir, exist_ok=True)
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(shard_dir, '.lock'), 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def replace_user(self, user_id, chunks: List[str], embeddings, metadata: Optional[dict] = None):
+        """Thay toàn bộ dữ liệu của một user (nguyên tử với reader)"""
+        self.replace_users({str(user_id): (chunks, embeddings, metadata or {})})
+
+    def delete_user(self, user_id):
+        self.replace_users({str(user_id): None})
+
+    def replace_users(self, items: Dict[str, Optional[tuple]]):
+        """
+        Thay dữ liệu nhiều user một lượt, gom theo shard để mỗi shard chỉ ghi lại một lần.
+        items: user_id -> (chunks, embeddings, metadata) hoặc None để xóa.
+        """
+        self._ensure_layout()
+        by_shard: Dict[int, dict] = {}
+        for user_id, value in items.items():
+            by_shard.setdefault(self.shard_of(user_id), {})[str(user_id)] = value
+
+        for shard, updates in by_shard.items():
+            with self._shard_lock(shard):
+                self._rewrite_shard(shard, updates)
+
+    def _rewrite_shard(self, shard: int, updates: dict):
+        # Đọc trạng thái mới nhất từ đĩa (process khác có thể vừa ghi)
+        self._shards.pop(shard, None)
+        state = self._load_shard(shard)
+        old_users = state.index['users']
+
+        chunks: List[str] = []
+        vector_parts = []
+        users = {}
+        now = str(datetime.now())
+
+        def append(user_id, user_chunks, user_vectors, info):
+            start = len(chunks)
+            chunks.extend(user_chunks)
+            vector_parts.append(np.asarray(user_vectors, dtype=np.float32).reshape(len(user_chunks), -1))
+            users[user_id] = dict(info, start=start, end=len(chunks))
+
+        for user_id, entry in old_users.items():
+            if user_id in updates:
+                continue
+            start, end = entry['start'], entry['end']
+            append(user_id, state.store.chunks[start:end], state.store.vectors[start:end], entry)
+
+        for user_id, value in updates.items():
+            if value is None:
+                continue
+            user_chunks, user_embeddings, metadata = value
+            if len(user_chunks) == 0:
+                continue
+            append(user_id, list(user_chunks), user_embeddings,
+                   {'version': new_index_version(), 'created_at': now, 'metadata': metadata or {}})
+
+        shard_dir = self._shard_dir(shard)
+        generation = None
+        if chunks:
+            dims = {p.shape[1] for p in vector_parts}
+            if len(dims) > 1:
+                raise ValueError(f"Kích thước embedding không đồng nhất trong shard {shard}: {sorted(dims)}")
+            generation = f"gen-{new_index_version()}"
+            write_vector_store(os.path.join(shard_dir, generation), chunks, np.concatenate(vector_parts),
+                               metadata={'shard': shard}, quantization=self.quantization)
+
+        previous = state.index.get('generation')
+        _atomic_write_json(os.path.join(shard_dir, SHARD_INDEX_FILE), {
+            'shard': shard,
+            'generation': generation,
+            'previous_generation': previous,
+            'updated_at': now,
+            'users': users,
+        })
+        self._shards.pop(shard, None)
+
+        # Giữ thế hệ hiện tại và liền trước (reader khác có thể vẫn đang mmap)
+        keep = {generation, previous}
+        for name in os.listdir(shard_dir):
+            if name.startswith('gen-') and name not in keep:
+                shutil.rmtree(os.path.join(shard_dir, name), ignore_errors=True)
+
+
+def _atomic_write_json(path: str, data: dict):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_user_vector_store() -> UserVectorStore:
+    """Kho vector cá nhân mặc định của process"""
+    global _default_store
+    if _default_store is None:
+        with _default_store_lock:
+            if _default_store is None:
+                _default_store = UserVectorStore()
+    return _default_store
@@ -0,0 +1,551 @@
+import os
+import json
+import mmap
+import shutil
+import uuid
+from datetime import datetime
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from .retrieval import normalize_rows
+from .ann_index import IVFIndex
+from .quantization import SUPPORTED_QUANTIZATIONS, build_quantizer, load_quantizer
+from .lexical_index import BM25Index
+from .metadata_index import MetadataIndex
+from .chunk_table import ChunkTable, content_hash, count_tokens, format_chunk_id
+
+# Định dạng lưu trữ vector nhị phân (thay cho stem_embeddings.json):
+#   <dir>/manifest.json          - metadata + tên file của phiên bản hiện tại
+#   <dir>/vectors-<ver>.npy      - ma trận (count, dim) float32/float16 đã chuẩn hóa, mở bằng mmap
+#   <dir>/chunks-<ver>.bin       - text các chunk (utf-8) nối liền nhau
+#   <dir>/offsets-<ver>.npy      - int64 (count + 1), chunk i = chunks[offsets[i]:offsets[i+1]]
+#   <dir>/ivf_*-<ver>.npy        - (tùy chọn) chỉ mục ANN IVF, xem ann_index.py
+#   <dir>/int8_*|pq_*-<ver>.npy  - (tùy chọn) mã nén int8 / PQ để chấm điểm gần đúng, xem quantization.py
+#   <dir>/prefix_codes-<ver>.npy - (tùy chọn) tiền tố Matryoshka đã chuẩn hóa lại, xem quantization.py
+#   <dir>/bm25_*-<ver>.*         - (tùy chọn) chỉ mục BM25 trên text chunk, xem lexical_index.py
+#   <dir>/meta_*-<ver>.*         - (tùy chọn) bitmap metadata để lọc, xem metadata_index.py
+#   <dir>/chunk_table-<ver>.npy  - id ổn định, nguồn, vị trí, số token của từng chunk, xem chunk_table.py
+#   <dir>/tombstones-<ver>.npy   - (tùy chọn) bitmap các dòng đã xóa (build tăng dần), loại khi truy hồi
+#   <dir>/sources-<ver>.json     - (tùy chọn) hash nội dung của từng nguồn "<model>:<pk>", xem incremental_index.py
+# Manifest được ghi sau cùng bằng os.replace nên reader luôn thấy một phiên bản đầy đủ.
+FORMAT_NAME = "stemind-vector-store"
+FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+SUPPORTED_DTYPES = ("float32", "float16")
+# Số dòng chuẩn hóa mỗi lần khi ghi ma trận vector
+WRITE_BLOCK_ROWS = 65536
+
+
+def new_index_version() -> str:
+    return f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+class ChunkTexts(Sequence):
+    """Danh sách text chunk đọc lazy từ file chunks + bảng offsets"""
+
+    def __init__(self, buffer, offsets: np.ndarray):
+        self._buffer = buffer
+        self._offsets = offsets
+
+    def __len__(self):
+        return max(len(self._offsets) - 1, 0)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("chunk index out of range")
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        return bytes(self._buffer[start:end]).decode('utf-8')
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._buffer) + self._offsets.nbytes
+
+
+class VectorStore:
+    """Kho vector chỉ đọc: ma trận embeddings + text chunk tương ứng"""
+
+    def __init__(self, path: str, manifest: dict, vectors: np.ndarray, chunks: Sequence[str], ann=None,
+                 quantizer=None, codes: Optional[np.ndarray] = None, lexical: Optional[BM25Index] = None,
+                 metadata_index: Optional[MetadataIndex] = None, chunk_table: Optional[ChunkTable] = None,
+                 tombstones: Optional[np.ndarray] = None):
+        self.path = path
+        self.manifest = manifest
+        self.vectors = vectors
+        self.chunks = chunks
+        self.ann = ann
+        self.quantizer = quantizer
+        self.codes = codes
+        self.lexical = lexical
+        self.metadata_index = metadata_index
+        self.chunk_table = chunk_table
+        self.tombstones = tombstones
+        # Mảng bool các dòng còn hiệu lực (None = không có dòng nào bị xóa), tính một lần khi mở kho
+        self.live_mask = ~tombstones if tombstones is not None and tombstones.any() else None
+
+    def __len__(self):
+        return len(self.chunks)
+
+    @property
+    def deleted_count(self) -> int:
+        return int(self.tombstones.sum()) if self.live_mask is not None else 0
+
+    @property
+    def index_version(self) -> str:
+        return self.manifest.get('index_version', '')
+
+    @property
+    def dim(self) -> int:
+        return int(self.manifest.get('dim', 0))
+
+    @property
+    def nbytes(self) -> int:
+        chunk_bytes = getattr(self.chunks, 'nbytes', None)
+        if chunk_bytes is None:
+            # Danh sách chunk trong RAM (JSON cũ): ước lượng theo số ký tự
+            chunk_bytes = sum(len(c) for c in self.chunks)
+        ann_bytes = self.ann.nbytes if self.ann is not None else 0
+        if self.quantizer is not None:
+            ann_bytes += self.quantizer.nbytes + self.codes.nbytes
+        if self.lexical is not None:
+            ann_bytes += self.lexical.nbytes
+        if self.metadata_index is not None:
+            ann_bytes += self.metadata_index.nbytes
+        if self.chunk_table is not None:
+            ann_bytes += self.chunk_table.nbytes
+        if self.tombstones is not None:
+            ann_bytes += self.tombstones.nbytes
+        return int(self.vectors.nbytes) + int(chunk_bytes) + int(ann_bytes)
+
+    def chunk_id(self, index: int) -> str:
+        if self.chunk_table is not None:
+            return self.chunk_table.chunk_id(index)
+        # Kho cũ chưa có bảng chunk: id theo hash nội dung (không rõ nguồn)
+        return format_chunk_id(content_hash(self.chunks[index]))
+
+    def chunk_ids(self, indices) -> List[str]:
+        return [self.chunk_id(int(i)) for i in indices]
+
+    def chunk_record(self, index: int) -> dict:
+        """Id, nguồn (model + pk), vị trí, số token, phiên bản index và text của chunk"""
+        text = self.chunks[index]
+        if self.chunk_table is not None:
+            record = self.chunk_table.record(index)
+        else:
+            record = {'id': self.chunk_id(index), 'source_model': None, 'source_id': None, 'offset': 0,
+                      'tokens': count_tokens(text), 'index_version': self.index_version}
+        record['text'] = text
+        return record
+
+    def find_chunk(self, chunk_id: str) -> Optional[int]:
+        """Số dòng của chunk theo id (None nếu không có trong phiên bản này)"""
+        if self.chunk_table is not None:
+            return self.chunk_table.find(chunk_id)
+        for index in range(len(self)):
+            if self.chunk_id(index) == chunk_id:
+                return index
+        return None
+
+    @classmethod
+    def open(cls, path: str) -> 'VectorStore':
+        """Mở kho vector nhị phân (memory-mapped, gần như không tốn thời gian load)"""
+        manifest = read_manifest(path)
+        if manifest is None:
+            raise FileNotFoundError(f"Không tìm thấy {MANIFEST_FILE} trong {path}")
+        if manifest.get('format') != FORMAT_NAME or manifest.get('format_version', 0) > FORMAT_VERSION:
+            raise ValueError(f"Định dạng kho vector không được hỗ trợ: {manifest.get('format')} v{manifest.get('format_version')}")
+
+        files = manifest['files']
+        count = int(manifest.get('count', 0))
+        if count == 0:
+            vectors = np.zeros((0, int(manifest.get('dim', 0))), dtype=manifest.get('dtype', 'float32'))
+            return cls(path, manifest, vectors, [])
+
+        vectors = np.load(os.path.join(path, files['vectors']), mmap_mode='r')
+        if not manifest.get('normalized'):
+            # Kho cũ chưa chuẩn hóa: chuẩn hóa một lần trong RAM khi load
+            vectors = normalize_rows(vectors)
+        offsets = np.load(os.path.join(path, files['offsets']), mmap_mode='r')
+        with open(os.path.join(path, files['chunks']), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+        ann = None
+        ann_info = manifest.get('ann')
+        if ann_info and ann_info.get('type') == 'ivf':
+            ann = IVFIndex.load(path, ann_info)
+        quantizer, codes = None, None
+        if manifest.get('quantization'):
+            quantizer, codes = load_quantizer(path, manifest['quantization'])
+        lexical = None
+        lexical_info = manifest.get('lexical')
+        if lexical_info and lexical_info.get('type') == BM25Index.type:
+            lexical = BM25Index.load(path, lexical_info)
+        metadata_index = None
+        metadata_info = manifest.get('chunk_metadata')
+        if metadata_info and metadata_info.get('type') == MetadataIndex.type:
+            metadata_index = MetadataIndex.load(path, metadata_info)
+        chunk_table = None
+        table_info = manifest.get('chunk_table')
+        if table_info and table_info.get('type') == ChunkTable.type:
+            chunk_table = ChunkTable.load(path, table_info)
+        tombstones = None
+        tombstone_info = manifest.get('tombstones')
+        if tombstone_info:
+            packed = np.load(os.path.join(path, tombstone_info['files']['bitmap']))
+            tombstones = np.unpackbits(packed, count=count, bitorder='little').astype(bool)
+        return cls(path, manifest, vectors, ChunkTexts(buffer, offsets), ann=ann, quantizer=quantizer, codes=codes,
+                   lexical=lexical, metadata_index=metadata_index, chunk_table=chunk_table, tombstones=tombstones)
+
+    @classmethod
+    def from_json(cls, path: str) -> 'VectorStore':
+        """Import file JSON cũ ({'chunks': [...], 'embeddings': [[...]]}) vào bộ nhớ"""
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        chunks = data.get('chunks', [])
+        embeddings = data.get('embeddings', [])
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim != 2:
+            vectors = vectors.reshape(len(chunks), -1) if len(chunks) else np.zeros((0, 0), dtype=np.float32)
+        vectors = normalize_rows(vectors)
+        manifest = {
+            'format': 'legacy-json',
+            'index_version': f"json-{int(os.path.getmtime(path))}",
+            'count': len(chunks),
+            'dim': int(vectors.shape[1]) if vectors.size else 0,
+            'dtype': 'float32',
+            'normalized': True,
+            'created_at': data.get('created_at'),
+            'metadata': {k: v for k, v in data.items() if k not in ('chunks', 'embeddings')},
+        }
+        return cls(path, manifest, vectors, chunks)
+
+
+def read_manifest(path: str) -> Optional[dict]:
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def read_source_hashes(path: str, manifest: dict) -> Optional[dict]:
+    """Hash nội dung của từng nguồn "<model>:<pk>" lúc build (None nếu index không ghi)"""
+    info = (manifest or {}).get('sources')
+    if not info:
+        return None
+    with open(os.path.join(path, info['files']['hashes']), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def is_vector_store(path: str) -> bool:
+    return bool(path) and os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def store_fingerprint(path: str):
+    """
+    Dấu hiệu nhận biết phiên bản trên đĩa mà không cần đọc dữ liệu:
+    (mtime, inode, size) của manifest (mỗi phiên bản mới thay manifest bằng os.replace)
+    hoặc của file JSON cũ. None nếu không tồn tại.
+    """
+    target = os.path.join(path, MANIFEST_FILE) if is_vector_store(path) else path
+    try:
+        stat = os.stat(target)
+    except (OSError, TypeError):
+        return None
+    return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+
+def load_vector_store(path: str) -> Optional[VectorStore]:
+    """Mở kho vector từ thư mục nhị phân hoặc file JSON cũ. Trả về None nếu không tồn tại."""
+    if is_vector_store(path):
+        return VectorStore.open(path)
+    if path and os.path.isfile(path) and path.endswith('.json'):
+        return VectorStore.from_json(path)
+    return None
+
+
+def write_vector_store(path: str, chunks: List[str], embeddings, dtype: str = 'float32',
+                       metadata: Optional[dict] = None, ann: Optional[str] = None,
+                       ann_options: Optional[dict] = None, quantization: Optional[str] = None,
+                       quantization_options: Optional[dict] = None, lexical: Optional[str] = None,
+                       chunk_metadata: Optional[List[dict]] = None,
+                       chunk_sources: Optional[List[tuple]] = None,
+                       chunk_versions: Optional[List[Optional[str]]] = None,
+                       tombstones: Optional[np.ndarray] = None, sources: Optional[dict] = None,
+                       chunk_tokens: Optional[Sequence[int]] = None) -> dict:
+    """
+    Ghi kho vector nhị phân vào thư mục `path`.
+    Các file dữ liệu mang tên theo phiên bản, manifest được thay thế nguyên tử ở bước cuối.
+    ann='ivf' build thêm chỉ mục IVF (ann_options: n_lists, iterations, sample_size).
+    quantization='int8'|'pq'|'prefix' ghi thêm mã nén (quantization_options: m, iterations, sample_size cho PQ;
+    dims cho prefix).
+    lexical='bm25' ghi thêm chỉ mục BM25 trên text chunk (truy hồi hybrid / khi không embed được câu hỏi).
+    chunk_metadata: mỗi chunk một dict (source_type, source_id, category_ids, author_id, status),
+    ghi thành bitmap để lọc khi truy hồi.
+    chunk_sources: mỗi chunk một tuple (model, pk, offset) cho bảng chunk (id ổn định, trích dẫn nguồn);
+    bảng chunk luôn được ghi, không có chunk_sources thì id chỉ dựa trên nội dung.
+    chunk_versions: phiên bản đã thêm từng chunk (build tăng dần), None = phiên bản đang ghi.
+    chunk_tokens: số token đã đếm của từng chunk (ghi lại kho cũ), None = đếm lại.
+    tombstones: mảng bool các dòng đã xóa, giữ trong kho nhưng bị loại khi truy hồi (tới lần nén).
+    sources: {'hashes': {"<model>:<pk>": hash nội dung}, ...tham số build} để lần sau chỉ embed phần thay đổi.
+    """
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f"dtype phải là một trong {SUPPORTED_DTYPES}")
+    if ann not in (None, 'none', 'ivf'):
+        raise ValueError(f"Loại chỉ mục ANN không được hỗ trợ: {ann}")
+    if quantization not in (None, 'none') + SUPPORTED_QUANTIZATIONS:
+        raise ValueError(f"Kiểu nén không được hỗ trợ: {quantization}")
+    if lexical not in (None, 'none', BM25Index.type):
+        raise ValueError(f"Loại chỉ mục từ khóa không được hỗ trợ: {lexical}")
+    os.makedirs(path, exist_ok=True)
+
+    # Mảng numpy (kể cả mmap) giữ nguyên, không copy cả ma trận vào RAM
+    vectors = embeddings if isinstance(embeddings, np.ndarray) else np.asarray(embeddings, dtype=np.float32)
+    if vectors.ndim != 2:
+        vectors = vectors.reshape(len(chunks), -1) if len(chunks) else np.zeros((0, 0), dtype=np.float32)
+    if vectors.shape[0] != len(chunks):
+        raise ValueError(f"Số chunk ({len(chunks)}) khác số vector ({vectors.shape[0]})")
+    if chunk_metadata is not None and len(chunk_metadata) != len(chunks):
+        raise ValueError(f"Số chunk ({len(chunks)}) khác số metadata ({len(chunk_metadata)})")
+    if tombstones is not None and len(tombstones) != len(chunks):
+        raise ValueError(f"Số chunk ({len(chunks)}) khác số tombstone ({len(tombstones)})")
+
+    encoded = [c.encode('utf-8') for c in chunks]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    if encoded:
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+
+    previous = read_manifest(path)
+    version = new_index_version()
+    files = {
+        'vectors': f"vectors-{version}.npy",
+        'chunks': f"chunks-{version}.bin",
+        'offsets': f"offsets-{version}.npy",
+    }
+    # Lưu sẵn vector đơn vị để truy hồi chỉ còn là một phép nhân ma trận-vector
+    vectors = _save_normalized(os.path.join(path, files['vectors']), vectors, dtype)
+    np.save(os.path.join(path, files['offsets']), offsets)
+    with open(os.path.join(path, files['chunks']), 'wb') as f:
+        for b in encoded:
+            f.write(b)
+        f.flush()
+        os.fsync(f.fileno())
+
+    ann_info = None
+    if ann == 'ivf' and len(chunks) > 0:
+        ann_info = IVFIndex.build(vectors, **(ann_options or {})).save(path, version)
+
+    quantization_info = None
+    if quantization in SUPPORTED_QUANTIZATIONS and len(chunks) > 0:
+        quantizer = build_quantizer(quantization, vectors, **(quantization_options or {}))
+        quantization_info = quantizer.save(path, version, quantizer.encode(vectors))
+
+    lexical_info = None
+    if lexical == BM25Index.type and len(chunks) > 0:
+        lexical_info = BM25Index.build(chunks).save(path, version)
+
+    metadata_info = None
+    if chunk_metadata is not None and len(chunks) > 0:
+        metadata_info = MetadataIndex.build(chunk_metadata).save(path, version)
+
+    table_info = None
+    if len(chunks) > 0:
+        table_info = ChunkTable.build(chunks, version, chunk_sources, chunk_versions,
+                                      chunk_tokens).save(path, version)
+
+    manifest = {
+        'format': FORMAT_NAME,
+        'format_version': FORMAT_VERSION,
+        'index_version': version,
+        'previous_version': previous.get('index_version') if previous else None,
+        'count': len(chunks),
+        'dim': int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+        'dtype': dtype,
+        'normalized': True,
+        'created_at': str(datetime.now()),
+        'files': files,
+        'ann': ann_info,
+        'quantization': quantization_info,
+        'lexical': lexical_info,
+        'chunk_metadata': metadata_info,
+        'chunk_table': table_info,
+        'tombstones': _save_tombstones(path, version, tombstones),
+        'sources': _save_sources(path, version, sources),
+        'metadata': metadata or {},
+    }
+    _write_manifest(path, manifest)
+
+    _cleanup_old_versions(path, keep=(version, manifest['previous_version']))
+    return manifest
+
+
+def append_to_vector_store(path: str, store: 'VectorStore', chunks: List[str], embeddings,
+                           chunk_metadata: Optional[List[dict]] = None,
+                           chunk_sources: Optional[List[tuple]] = None,
+                           tombstones: Optional[np.ndarray] = None, sources: Optional[dict] = None,
+                           metadata: Optional[dict] = None) -> dict:
+    """
+    Phiên bản mới = kho `store` + các chunk mới nối vào cuối, giữ nguyên cấu hình (dtype, ANN, nén, BM25).
+    Dòng cũ được chép theo khối (vector, text) hoặc giữ nguyên (bảng chunk, số token, bitmap metadata);
+    chỉ chunk mới được chuẩn hóa, gán cụm IVF, mã hóa và tách từ. Centroid IVF, codebook nén và thống kê
+    BM25 của dòng cũ không huấn luyện lại (để dành cho lần nén / build lại toàn bộ).
+    tombstones: mảng bool cho cả dòng cũ lẫn dòng mới.
+    """
+    if store.chunk_table is None:
+        raise ValueError("Kho vector chưa có bảng chunk, không nối thêm được")
+    count = len(store)
+    new_vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(chunks), -1)
+    dim = store.dim or new_vectors.shape[1]
+    if new_vectors.shape[1] != dim:
+        raise ValueError(f"Số chiều vector mới ({new_vectors.shape[1]}) khác kho ({dim})")
+    if chunk_metadata is not None and len(chunk_metadata) != len(chunks):
+        raise ValueError(f"Số chunk ({len(chunks)}) khác số metadata ({len(chunk_metadata)})")
+    if tombstones is not None and len(tombstones) != count + len(chunks):
+        raise ValueError(f"Số dòng ({count + len(chunks)}) khác số tombstone ({len(tombstones)})")
+    new_vectors = normalize_rows(new_vectors)
+    manifest = store.manifest
+    dtype = manifest.get('dtype', 'float32')
+    version = new_index_version()
+    files = {
+        'vectors': f"vectors-{version}.npy",
+        'chunks': f"chunks-{version}.bin",
+        'offsets': f"offsets-{version}.npy",
+    }
+
+    out = np.lib.format.open_memmap(os.path.join(path, files['vectors']), mode='w+', dtype=dtype,
+                                    shape=(count + len(chunks), dim))
+    for start in range(0, count, WRITE_BLOCK_ROWS):
+        end = min(start + WRITE_BLOCK_ROWS, count)
+        out[start:end] = store.vectors[start:end]
+    out[count:] = new_vectors
+    out.flush()
+    del out
+
+    encoded = [c.encode('utf-8') for c in chunks]
+    old_offsets = np.zeros(1, dtype=np.int64)
+    if count:
+        old_offsets = np.load(os.path.join(path, manifest['files']['offsets'])).astype(np.int64)
+    offsets = np.concatenate([old_offsets, old_offsets[-1] + np.cumsum([len(b) for b in encoded], dtype=np.int64)])
+    np.save(os.path.join(path, files['offsets']), offsets)
+    with open(os.path.join(path, files['chunks']), 'wb') as f:
+        if count:
+            with open(os.path.join(path, manifest['files']['chunks']), 'rb') as old:
+                shutil.copyfileobj(old, f)
+        for b in encoded:
+            f.write(b)
+        f.flush()
+        os.fsync(f.fileno())
+
+    ann_info = None
+    if store.ann is not None:
+        ann_info = store.ann.extend(new_vectors, count).save(path, version)
+    quantization_info = None
+    if store.quantizer is not None:
+        codes = np.concatenate([np.asarray(store.codes), store.quantizer.encode(new_vectors)])
+        quantization_info = store.quantizer.save(path, version, codes)
+    lexical_info = None
+    if store.lexical is not None:
+        lexical_info = store.lexical.extend(chunks).save(path, version)
+    metadata_info = None
+    if store.metadata_index is not None and chunk_metadata is not None:
+        metadata_info = store.metadata_index.extend(chunk_metadata).save(path, version)
+    table_info = store.chunk_table.extend(chunks, version, chunk_sources).save(path, version)
+
+    manifest = dict(
+        manifest,
+        index_version=version,
+        previous_version=store.index_version,
+        count=count + len(chunks),
+        dim=int(dim),
+        normalized=True,
+        created_at=str(datetime.now()),
+        files=files,
+        ann=ann_info,
+        quantization=quantization_info,
+        lexical=lexical_info,
+        chunk_metadata=metadata_info,
+        chunk_table=table_info,
+        tombstones=_save_tombstones(path, version, tombstones),
+        sources=_save_sources(path, version, sources),
+        metadata=metadata or manifest.get('metadata') or {},
+    )
+    _write_manifest(path, manifest)
+
+    _cleanup_old_versions(path, keep=(version, manifest['previous_version']))
+    return manifest
+
+
+def _save_tombstones(path: str, version: str, tombstones: Optional[np.ndarray]) -> Optional[dict]:
+    if tombstones is None or not np.any(tombstones):
+        return None
+    info = {'count': int(np.count_nonzero(tombstones)), 'files': {'bitmap': f"tombstones-{version}.npy"}}
+    np.save(os.path.join(path, info['files']['bitmap']),
+            np.packbits(np.asarray(tombstones, dtype=bool), bitorder='little'))
+    return info
+
+
+def _save_sources(path: str, version: str, sources: Optional[dict]) -> Optional[dict]:
+    if sources is None:
+        return None
+    info = {k: v for k, v in sources.items() if k != 'hashes'}
+    info.update({'count': len(sources['hashes']), 'files': {'hashes': f"sources-{version}.json"}})
+    with open(os.path.join(path, info['files']['hashes']), 'w', encoding='utf-8') as f:
+        json.dump(sources['hashes'], f, ensure_ascii=False)
+    return info
+
+
+def _save_normalized(path: str, vectors: np.ndarray, dtype: str, block: int = WRITE_BLOCK_ROWS) -> np.ndarray:
+    """Chuẩn hóa và ghi ma trận theo từng khối dòng rồi mở lại bằng mmap (đầu vào có thể lớn hơn RAM)"""
+    if vectors.size == 0:
+        np.save(path, np.asarray(vectors, dtype=dtype))
+        return np.load(path)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=vectors.shape)
+    for start in range(0, len(vectors), block):
+        out[start:start + block] = normalize_rows(np.asarray(vectors[start:start + block], dtype=np.float32))
+    out.flush()
+    del out
+    return np.load(path, mmap_mode='r')
+
+
+def add_lexical_index(path: str) -> dict:
+    """
+    Build chỉ mục BM25 cho kho vector đã có (không cần embed lại): các file BM25 mang phiên bản
+    hiện tại, manifest được ghi lại với mục 'lexical'.
+    """
+    store = VectorStore.open(path)
+    manifest = dict(store.manifest)
+    manifest['lexical'] = BM25Index.build(store.chunks).save(path, store.index_version) if len(store) else None
+    _write_manifest(path, manifest)
+    return manifest
+
+
+def _write_manifest(path: str, manifest: dict):
+    tmp_manifest = os.path.join(path, f".{MANIFEST_FILE}.{manifest['index_version']}.tmp")
+    with open(tmp_manifest, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_manifest, os.path.join(path, MANIFEST_FILE))
+
+
+def _cleanup_old_versions(path: str, keep):
+    """Xóa file của các phiên bản cũ, giữ lại phiên bản hiện tại và phiên bản liền trước
+    (worker khác có thể vẫn đang mmap phiên bản trước)."""
+    keep = {v for v in keep if v}
+    for filename in os.listdir(path):
+        if filename == MANIFEST_FILE or filename.startswith('.'):
+            continue
+        stem = filename.rsplit('.', 1)[0]
+        if '-' not in stem:
+            continue
+        version = stem.split('-', 1)[1]
+        if version not in keep:
+            try:
+                os.remove(os.path.join(path, filename))
+            except OSError:
+                pass
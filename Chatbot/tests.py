@@ -1,9 +1,42 @@
-from django.test import TestCase, Client
+from django.test import TestCase, SimpleTestCase, Client
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from .models import ChatSession, ChatMessage, FileAttachment
+from .services.vector_store import VectorStore, write_vector_store, load_vector_store
+from .services.corpus_registry import CorpusRegistry
+from .services.query_embedding_cache import QueryEmbeddingCache
+from .services import retrieval
+from .services.ann_index import IVFIndex
+from .services.quantization import ScalarQuantizer, ProductQuantizer, PrefixQuantizer
+from .services.lexical_index import BM25Index, varint_encode, varint_decode, reciprocal_rank_fusion
+from .services.vector_store import add_lexical_index
+from .services.metadata_index import MetadataIndex
+from .services.chunk_table import make_chunk_id, count_tokens
+from .services.incremental_index import (
+    SourceDocument, compact_vector_store, diff_sources, incremental_unavailable_reason, previous_source_hashes,
+    update_vector_store,
+)
+from .services.vector_store import read_manifest
+from .services.context_assembler import ContextAssembler, ContextCandidate, context_stats
+from .services.embedding_batcher import EmbeddingBatcher, RateLimiter, TokenBucket, plan_batches
+from .services import tracing
+from .services.user_embedding_service import UserMatrixCache
+from .services.user_vector_store import UserVectorStore
+from .services.answer_cache import AnswerCache
+from .services.semantic_cache import SemanticCache
+from .services.fallback_stats import fallback_stats
+from .services.rag_chatbot_service import RAGChatbotService
+from .services.providers import LocalProvider, LocalEmbeddings, RecordReplayProvider, ReplayMissError
+from unittest import mock
+import numpy as np
+import asyncio
+import io
 import tempfile
+import threading
+import shutil
+import json
 import os
 
 User = get_user_model()
@@ -189,3 +222,1072 @@ class FileAttachmentDownloadTest(TestCase):
         if self.attachment.file:
             if os.path.exists(self.attachment.file.path):
                 os.remove(self.attachment.file.path)
+
+
+class VectorStoreTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.chunks = ['Định lý Pytago', 'Phương trình bậc hai', 'Định luật Newton']
+        self.embeddings = np.random.RandomState(0).rand(3, 8).tolist()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_write_and_open_memmap(self):
+        """Ghi kho nhị phân rồi mở lại bằng memmap"""
+        path = os.path.join(self.tmpdir, 'index')
+        manifest = write_vector_store(path, self.chunks, self.embeddings)
+
+        store = VectorStore.open(path)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store.index_version, manifest['index_version'])
+        self.assertEqual(store.vectors.dtype, np.float32)
+        self.assertIsInstance(store.vectors, np.memmap)
+        self.assertEqual(list(store.chunks), self.chunks)
+        np.testing.assert_allclose(np.linalg.norm(store.vectors, axis=1), 1.0, rtol=1e-5)
+
+    def test_rewrite_replaces_version(self):
+        """Ghi lại tạo phiên bản mới và dọn file cũ"""
+        path = os.path.join(self.tmpdir, 'index')
+        first = write_vector_store(path, self.chunks, self.embeddings)
+        second = write_vector_store(path, self.chunks[:2], self.embeddings[:2], dtype='float16')
+        third = write_vector_store(path, self.chunks[:1], self.embeddings[:1])
+
+        self.assertNotEqual(first['index_version'], third['index_version'])
+        self.assertEqual(len(VectorStore.open(path)), 1)
+        leftovers = [f for f in os.listdir(path) if first['index_version'] in f]
+        self.assertEqual(leftovers, [])
+        self.assertTrue(any(second['index_version'] in f for f in os.listdir(path)))
+
+    def test_legacy_json_import(self):
+        """File JSON cũ vẫn đọc được"""
+        json_path = os.path.join(self.tmpdir, 'stem_embeddings.json')
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump({'chunks': self.chunks, 'embeddings': self.embeddings}, f, ensure_ascii=False)
+
+        store = load_vector_store(json_path)
+        self.assertEqual(list(store.chunks), self.chunks)
+        self.assertEqual(store.vectors.shape, (3, 8))
+        self.assertIsNone(load_vector_store(os.path.join(self.tmpdir, 'missing')))
+
+
+class CorpusRegistryTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'index')
+        self.embeddings = np.random.RandomState(1).rand(2, 4)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_loads_once_and_reloads_on_new_version(self):
+        """Corpus chỉ load một lần và tự load lại khi index đổi phiên bản"""
+        write_vector_store(self.path, ['a', 'b'], self.embeddings)
+        registry = CorpusRegistry(check_interval=0)
+
+        first = registry.get(self.path)
+        self.assertIs(registry.get(self.path), first)
+
+        manifest = write_vector_store(self.path, ['c'], self.embeddings[:1])
+        second = registry.get(self.path)
+        self.assertIsNot(second, first)
+        self.assertEqual(list(second.chunks), ['c'])
+
+        stats = registry.stats()[self.path]
+        self.assertEqual(stats['index_version'], manifest['index_version'])
+        self.assertEqual(stats['reloads'], 1)
+        self.assertTrue(stats['memory_mapped'])
+
+    def test_missing_corpus(self):
+        registry = CorpusRegistry(check_interval=0)
+        self.assertIsNone(registry.get(os.path.join(self.tmpdir, 'missing.json')))
+
+
+class FakeEmbeddings:
+    """Embedding giả lập, đếm số lần gọi API"""
+    model = 'fake-embedding'
+
+    def __init__(self, dim=8):
+        self.dim = dim
+        self.calls = 0
+
+    def embed_query(self, text):
+        self.calls += 1
+        seed = sum(ord(c) for c in text)
+        return np.random.RandomState(seed).rand(self.dim).tolist()
+
+    def embed_documents(self, texts):
+        vectors = [self.embed_query(t) for t in texts]
+        self.calls -= len(texts) - 1  # một request cho cả lô
+        return vectors
+
+
+class QueryEmbeddingCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_normalized_lru_hits(self):
+        """Cùng câu hỏi (khác hoa thường/khoảng trắng) chỉ gọi API một lần"""
+        model = FakeEmbeddings()
+        cache = QueryEmbeddingCache(max_entries=2)
+
+        first = cache.embed_query(model, 'Định lý Pytago là gì')
+        second = cache.embed_query(model, '  định lý   pytago LÀ GÌ ')
+        self.assertIs(first, second)
+        self.assertEqual(model.calls, 1)
+
+        cache.embed_query(model, 'a')
+        cache.embed_query(model, 'b')
+        cache.embed_query(model, 'Định lý Pytago là gì')
+        self.assertEqual(model.calls, 4)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 4)
+
+    def test_persistent_tier_shared_across_instances(self):
+        """Tầng SQLite giữ embedding qua các process/lần restart"""
+        db_path = os.path.join(self.tmpdir, 'query_cache.sqlite3')
+        model = FakeEmbeddings()
+        QueryEmbeddingCache(db_path=db_path).embed_query(model, 'phương trình bậc hai')
+
+        other = QueryEmbeddingCache(db_path=db_path)
+        vector = other.embed_query(model, 'Phương trình bậc hai')
+        self.assertEqual(model.calls, 1)
+        self.assertEqual(vector.dtype, np.float32)
+        self.assertEqual(other.stats()['persistent_hits'], 1)
+        self.assertEqual(other.stats()['hit_rate'], 1.0)
+
+    def test_embed_many_batches_missing_queries(self):
+        model = FakeEmbeddings()
+        cache = QueryEmbeddingCache()
+        cached = cache.embed_query(model, 'lực hấp dẫn')
+
+        matrix = cache.embed_many(model, ['Lực hấp dẫn', 'gia tốc', 'GIA TỐC', 'động năng'])
+        self.assertEqual(matrix.shape, (4, 8))
+        self.assertEqual(model.calls, 2)  # 1 câu đơn lẻ + 1 lô cho 2 câu mới
+        np.testing.assert_array_equal(matrix[0], cached)
+        np.testing.assert_array_equal(matrix[1], matrix[2])
+
+
+class RetrievalKernelTest(SimpleTestCase):
+    def test_matches_cosine_argsort(self):
+        """Kết quả kernel trùng với cosine similarity + argsort toàn bộ"""
+        rng = np.random.RandomState(3)
+        raw = rng.standard_normal((200, 16))
+        query = rng.standard_normal(16)
+        matrix = retrieval.normalize_rows(raw)
+
+        indices, scores = retrieval.search(matrix, query, 5)
+
+        expected = raw @ query / (np.linalg.norm(raw, axis=1) * np.linalg.norm(query))
+        np.testing.assert_array_equal(indices, np.argsort(expected)[-5:][::-1])
+        np.testing.assert_allclose(scores, expected[indices], rtol=1e-5)
+
+    def test_search_many_matches_single_query_search(self):
+        rng = np.random.RandomState(4)
+        matrix = retrieval.normalize_rows(rng.standard_normal((300, 16))).astype(np.float16)
+        queries = rng.standard_normal((7, 16))
+
+        # Khối nhỏ để kiểm tra việc gộp top-k qua nhiều khối
+        batched = retrieval.search_many(matrix, queries, 5, threshold=0.1, block_elements=7 * 40)
+        for query, (indices, scores) in zip(queries, batched):
+            expected_indices, expected_scores = retrieval.search(matrix, query, 5, threshold=0.1)
+            np.testing.assert_array_equal(indices, expected_indices)
+            np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+
+    def test_threshold_and_small_corpus(self):
+        matrix = retrieval.normalize_rows(np.eye(3))
+        indices, scores = retrieval.search(matrix.astype(np.float16), [1, 0, 0], 10, threshold=0.5)
+        self.assertEqual(indices.tolist(), [0])
+        self.assertEqual(len(retrieval.search(np.zeros((0, 3)), [1, 0, 0], 3)[0]), 0)
+
+
+class IVFIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(5)
+        centers = rng.standard_normal((8, 16))
+        self.matrix = retrieval.normalize_rows(centers[rng.randint(8, size=400)] + 0.1 * rng.standard_normal((400, 16)))
+        self.queries = rng.standard_normal((10, 16))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_probing_all_lists_is_exact(self):
+        index = IVFIndex.build(self.matrix, n_lists=8)
+        self.assertEqual(int(index.offsets[-1]), 400)
+        for q in self.queries:
+            exact, _ = retrieval.search(self.matrix, q, 5)
+            approx, _ = index.search(self.matrix, q, 5, n_probe=index.n_lists)
+            np.testing.assert_array_equal(approx, exact)
+
+    def test_built_and_loaded_with_store(self):
+        """train_rag_chatbot --ann ivf: chỉ mục được ghi cạnh vector và load cùng kho"""
+        path = os.path.join(self.tmpdir, 'index')
+        chunks = [f'chunk {i}' for i in range(400)]
+        manifest = write_vector_store(path, chunks, self.matrix, ann='ivf', ann_options={'n_lists': 4})
+
+        store = VectorStore.open(path)
+        self.assertEqual(manifest['ann']['n_lists'], 4)
+        self.assertIsInstance(store.ann, IVFIndex)
+        indices, _ = store.ann.search(store.vectors, self.matrix[7], 1, n_probe=4)
+        self.assertEqual(indices.tolist(), [7])
+
+
+class QuantizationTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(6)
+        centers = rng.standard_normal((10, 32))
+        self.matrix = retrieval.normalize_rows(centers[rng.randint(10, size=500)] + 0.3 * rng.standard_normal((500, 32)))
+        self.queries = self.matrix[rng.choice(500, 20, replace=False)] + 0.05 * rng.standard_normal((20, 32))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _recall(self, quantizer, codes, rescore):
+        found = 0
+        for query in self.queries:
+            expected = set(retrieval.search(self.matrix, query, 5)[0].tolist())
+            found += len(expected & set(quantizer.search(codes, self.matrix, query, 5, rescore)[0].tolist()))
+        return found / (5 * len(self.queries))
+
+    def test_int8_scores_close_to_exact(self):
+        quantizer = ScalarQuantizer.fit(self.matrix)
+        codes = quantizer.encode(self.matrix)
+        self.assertEqual(codes.dtype, np.int8)
+        query = retrieval.normalize_vector(self.queries[0])
+        np.testing.assert_allclose(quantizer.score(codes, query), self.matrix @ query, atol=0.02)
+        self.assertEqual(self._recall(quantizer, codes, rescore=50), 1.0)
+
+    def test_pq_rescoring_restores_recall(self):
+        quantizer = ProductQuantizer.fit(self.matrix, m=8, ksub=32)
+        codes = quantizer.encode(self.matrix)
+        self.assertEqual(codes.shape, (500, 8))
+        self.assertGreaterEqual(self._recall(quantizer, codes, rescore=100), 0.95)
+
+    def test_matryoshka_prefix_two_stage(self):
+        quantizer = PrefixQuantizer.fit(self.matrix, dims=16)
+        codes = quantizer.encode(self.matrix)
+        self.assertEqual(codes.shape, (500, 16))
+        np.testing.assert_allclose(np.linalg.norm(codes, axis=1), 1.0, atol=1e-5)
+        self.assertEqual(self._recall(quantizer, codes, rescore=100), 1.0)
+        with self.assertRaises(ValueError):
+            PrefixQuantizer.fit(self.matrix, dims=64)
+
+    def test_store_roundtrip_with_codes(self):
+        path = os.path.join(self.tmpdir, 'index')
+        manifest = write_vector_store(path, [str(i) for i in range(500)], self.matrix, quantization='int8')
+        store = VectorStore.open(path)
+        self.assertEqual(manifest['quantization']['type'], 'int8')
+        self.assertIsInstance(store.quantizer, ScalarQuantizer)
+        indices, _ = store.quantizer.search(store.codes, store.vectors, self.matrix[42], 1)
+        self.assertEqual(indices.tolist(), [42])
+
+
+class BM25IndexTest(SimpleTestCase):
+    CHUNKS = [
+        'Định lý Pytago: bình phương cạnh huyền bằng tổng bình phương hai cạnh góc vuông.',
+        'Công thức hóa học của nước là H2O.',
+        'Định luật II Newton: F = ma.',
+        'Mà, má, mạ đều khác nghĩa với ma.',
+    ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_varint_roundtrip(self):
+        values = np.array([0, 1, 127, 128, 300, 16384, 2 ** 40], dtype=np.int64)
+        encoded = varint_encode(values)
+        self.assertEqual(len(encoded), 1 + 1 + 1 + 2 + 2 + 3 + 6)
+        np.testing.assert_array_equal(varint_decode(encoded), values)
+
+    def test_diacritic_folding_and_codes(self):
+        index = BM25Index.build(self.CHUNKS)
+        self.assertEqual(index.search('dinh ly pytago', 1)[0].tolist(), [0])
+        self.assertEqual(index.search('H2O', 3)[0].tolist(), [1])
+        # Có dấu: chỉ khớp đúng dạng có dấu; không dấu: khớp mọi biến thể
+        self.assertEqual(index.search('má', 4)[0].tolist(), [3])
+        self.assertEqual(set(index.search('ma', 4)[0].tolist()), {2, 3})
+        self.assertEqual(len(index.search('lượng tử', 4)[0]), 0)
+
+    def test_persisted_with_store_and_added_later(self):
+        path = os.path.join(self.tmpdir, 'index')
+        vectors = np.eye(4, dtype=np.float32)
+        write_vector_store(path, self.CHUNKS, vectors)
+        self.assertIsNone(VectorStore.open(path).lexical)
+        add_lexical_index(path)
+        store = VectorStore.open(path)
+        self.assertEqual(store.lexical.search('newton', 1)[0].tolist(), [2])
+
+        write_vector_store(path, self.CHUNKS, vectors, lexical='bm25')
+        self.assertEqual(VectorStore.open(path).lexical.search('nuoc', 1)[0].tolist(), [1])
+
+    def test_service_falls_back_to_bm25_without_embedding(self):
+        path = os.path.join(self.tmpdir, 'index')
+        write_vector_store(path, self.CHUNKS, np.eye(4, dtype=np.float32), lexical='bm25')
+        service = RAGChatbotService.__new__(RAGChatbotService)
+        service.retrieval_mode = 'dense'
+        corpus = VectorStore.open(path)
+        # API embedding lỗi / timeout: vẫn truy hồi được bằng BM25
+        self.assertEqual(service._search_global(corpus, None, 2, 'công thức nước'), [1])
+        service.retrieval_mode = 'hybrid'
+        self.assertEqual(set(service._search_global(corpus, np.eye(4)[0], 2, 'newton').tolist()), {0, 2})
+
+    def test_reciprocal_rank_fusion(self):
+        fused = reciprocal_rank_fusion([[1, 2, 3], [3, 1, 4]], 3)
+        self.assertEqual(fused.tolist(), [1, 3, 2])
+
+
+class MetadataFilterTest(SimpleTestCase):
+    METADATA = [
+        {'source_type': 'file', 'source_id': 1, 'category_ids': [3, 5], 'author_id': 7, 'status': 1},
+        {'source_type': 'file', 'source_id': 2, 'category_ids': [5], 'author_id': 8, 'status': 0},
+        {'source_type': 'post', 'source_id': 9, 'author_id': 7, 'status': 0},
+        {'source_type': 'comment', 'source_id': 4, 'author_id': 8, 'status': 0},
+    ]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_bitmap_masks_and_persistence(self):
+        path = os.path.join(self.tmpdir, 'index')
+        write_vector_store(path, ['a', 'b', 'c', 'd'], np.eye(4), chunk_metadata=self.METADATA)
+        index = VectorStore.open(path).metadata_index
+        self.assertEqual(index.mask({'source_type': 'file'}).tolist(), [True, True, False, False])
+        self.assertEqual(index.mask({'category_ids': '3'}).tolist(), [True, False, False, False])
+        self.assertEqual(index.mask({'status__not': 1, 'author_id': [7, 8]}).tolist(), [False, True, True, True])
+        self.assertEqual(index.mask({'source_type': 'file', 'author_id': 7}).tolist(), [True, False, False, False])
+        self.assertIsNone(index.mask({}))
+        self.assertEqual(index.chunk_metadata(0), self.METADATA[0])
+        with self.assertRaises(ValueError):
+            index.mask({'title': 'x'})
+
+    def test_filtered_search_masks_before_scoring(self):
+        rng = np.random.RandomState(0)
+        vectors = retrieval.normalize_rows(rng.standard_normal((400, 16)))
+        metadata = [{'source_type': 'file' if i % 10 == 0 else 'post', 'status': 0} for i in range(400)]
+        mask = MetadataIndex.build(metadata).mask({'source_type': 'file'})
+        allowed = set(np.flatnonzero(mask).tolist())
+        query = vectors[5]  # gần nhất là một chunk 'post' bị lọc
+        expected = [i for i in np.argsort(-(vectors @ query)) if i in allowed][:3]
+
+        self.assertEqual(retrieval.search(vectors, query, 3, mask=mask)[0].tolist(), expected)
+        quantizer = ScalarQuantizer.fit(vectors)
+        found = quantizer.search(quantizer.encode(vectors), vectors, query, 3, rescore=40, mask=mask)[0]
+        self.assertEqual(found.tolist(), expected)
+        ivf = IVFIndex.build(vectors, n_lists=8)
+        self.assertTrue(set(ivf.search(vectors, query, 3, n_probe=1, mask=mask)[0].tolist()) <= allowed)
+
+    def test_service_filters_and_refuses_unfiltered_legacy_corpus(self):
+        path = os.path.join(self.tmpdir, 'index')
+        write_vector_store(path, ['a', 'b', 'c', 'd'], np.eye(4), chunk_metadata=self.METADATA)
+        service = RAGChatbotService.__new__(RAGChatbotService)
+        service.retrieval_mode, service.ann_mode, service.quant_mode = 'dense', 'auto', 'auto'
+        corpus = VectorStore.open(path)
+        query = np.array([1.0, 0.9, 0.0, 0.0])
+        self.assertEqual(list(service._search_global(corpus, query, 2, filters={'status': 0})), [1])
+        self.assertEqual(list(service._search_global(corpus, query, 2)), [0, 1])
+
+        write_vector_store(path, ['a', 'b', 'c', 'd'], np.eye(4))
+        self.assertEqual(list(service._search_global(VectorStore.open(path), query, 2, filters={'status': 0})), [])
+
+
+class ChunkTableTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'index')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_ids_are_stable_across_rebuilds(self):
+        chunks = ['Định lý Pytago', 'Phương trình bậc hai', 'Định lý Pytago']
+        sources = [('file', 3, 0), ('post', 8, 500), ('comment', 4, 0)]
+        first = write_vector_store(self.path, chunks, np.eye(3), chunk_sources=sources)
+        store = VectorStore.open(self.path)
+        ids = store.chunk_ids(range(3))
+        self.assertEqual(ids[1], make_chunk_id('Phương trình bậc hai', 'post', 8))
+        # Cùng nội dung nhưng khác nguồn là hai chunk khác nhau
+        self.assertNotEqual(ids[0], ids[2])
+        record = store.chunk_record(1)
+        self.assertEqual((record['source_model'], record['source_id'], record['offset']), ('post', 8, 500))
+        self.assertEqual(record['index_version'], first['index_version'])
+        self.assertGreater(record['tokens'], 0)
+
+        # Build lại với thứ tự khác: id giữ nguyên, tra id ra số dòng mới
+        write_vector_store(self.path, chunks[::-1], np.eye(3), chunk_sources=sources[::-1])
+        rebuilt = VectorStore.open(self.path)
+        self.assertEqual(sorted(rebuilt.chunk_ids(range(3))), sorted(ids))
+        self.assertEqual(rebuilt.find_chunk(ids[0]), 2)
+        self.assertIsNone(rebuilt.find_chunk('file:3:0000000000000000'))
+
+    def test_search_results_carry_chunk_ids(self):
+        write_vector_store(self.path, ['a', 'b'], np.eye(2), chunk_sources=[('file', 1, 0), ('file', 2, 0)])
+        corpus = VectorStore.open(self.path)
+        service = RAGChatbotService.__new__(RAGChatbotService)
+        service.top_k, service.retrieval_mode, service.ann_mode, service.quant_mode = 1, 'dense', 'auto', 'auto'
+        with mock.patch.object(RAGChatbotService, 'corpus', new_callable=mock.PropertyMock, return_value=corpus), \
+                mock.patch.object(service, '_retrieval_embedding', return_value=np.array([0.0, 1.0])):
+            records = service.search_chunks('b')
+        self.assertEqual([(r['id'], r['text']) for r in records], [(make_chunk_id('b', 'file', 2), 'b')])
+
+        # Kho JSON cũ không có bảng chunk: id theo hash nội dung
+        legacy = os.path.join(self.tmpdir, 'legacy.json')
+        with open(legacy, 'w', encoding='utf-8') as f:
+            json.dump({'chunks': ['a'], 'embeddings': [[1.0, 0.0]]}, f)
+        self.assertEqual(VectorStore.from_json(legacy).chunk_record(0)['id'], make_chunk_id('a'))
+
+
+class IncrementalIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'index')
+        self.embeddings = LocalEmbeddings('test', dim=8)
+        # post:1 (2 chunk), post:2, comment:3
+        self.chunks = ['Định lý Pytago', 'cạnh huyền', 'Phương trình bậc hai', 'Bình luận cũ']
+        self.sources = [('post', 1, 0), ('post', 1, 500), ('post', 2, 0), ('comment', 3, 0)]
+        metadata = [{'source_type': model, 'source_id': pk, 'status': 0} for model, pk, _ in self.sources]
+        self.first = write_vector_store(
+            self.path, self.chunks, self.embeddings.embed_documents(self.chunks), chunk_metadata=metadata,
+            chunk_sources=self.sources, lexical='bm25',
+            sources={'hashes': {'post:1': 'a', 'post:2': 'b', 'comment:3': 'c'}, 'chunk_size': 500},
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def update(self, store, **options):
+        # post:1 sửa, comment:3 xóa, post:4 mới, post:2 không đổi
+        delta = diff_sources(previous_source_hashes(store), {'post:1': 'a2', 'post:2': 'b', 'post:4': 'd'})
+        self.assertEqual((delta.new, delta.changed, delta.deleted), ({'post:4'}, {'post:1'}, {'comment:3'}))
+        chunks = ['Định lý Pytago mới', 'Bài viết mới']
+        metadata = [{'source_type': 'post', 'source_id': pk, 'status': 1} for pk in (1, 4)]
+        return update_vector_store(
+            self.path, store, delta.unchanged, chunks, self.embeddings.embed_documents(chunks),
+            [('post', 1, 0), ('post', 4, 0)], metadata, {'post:1': 'a2', 'post:2': 'b', 'post:4': 'd'},
+            chunk_size=500, lexical='bm25', **options
+        )
+
+    def test_update_appends_and_tombstones_changed_rows(self):
+        with mock.patch('Chatbot.services.chunk_table.count_tokens', wraps=count_tokens) as counted:
+            manifest = self.update(VectorStore.open(self.path), compact_ratio=1.0)
+        # Chỉ chunk mới được đếm token; dòng cũ giữ số token trong bảng chunk
+        self.assertEqual(counted.call_count, 2)
+        store = VectorStore.open(self.path)
+        self.assertEqual((len(store), store.deleted_count), (6, 3))
+        self.assertEqual(list(store.live_mask), [False, False, True, False, True, True])
+        # Dòng không đổi giữ vector và phiên bản đã thêm nó
+        np.testing.assert_allclose(store.vectors[2], retrieval.normalize_rows(
+            np.array([self.embeddings.embed_query('Phương trình bậc hai')]))[0], rtol=1e-6)
+        self.assertEqual(store.chunk_record(2)['index_version'], self.first['index_version'])
+        self.assertEqual(store.chunk_record(4)['index_version'], manifest['index_version'])
+        self.assertEqual(previous_source_hashes(store), {'post:1': 'a2', 'post:2': 'b', 'post:4': 'd'})
+        self.assertIsNone(incremental_unavailable_reason(store, 500, None))
+
+        self.assertEqual(store.chunk_table.rows['tokens'][3], count_tokens('Bình luận cũ'))
+        # BM25 nối thêm cho cùng kết quả với build lại từ đầu
+        rebuilt = BM25Index.build(list(store.chunks))
+        self.assertEqual(store.lexical.vocabulary, rebuilt.vocabulary)
+        np.testing.assert_array_equal(np.asarray(store.lexical.postings), np.asarray(rebuilt.postings))
+
+        # Dòng đã xóa không được truy hồi; dòng không đổi giữ metadata cũ, chunk mới mang metadata mới
+        service = RAGChatbotService.__new__(RAGChatbotService)
+        service.retrieval_mode = 'lexical'
+        self.assertEqual(list(service._search_global_indices(store, None, 5, 'Bình luận cũ')), [])
+        self.assertEqual(list(np.flatnonzero(service._filter_mask(store, {'status': 1}))), [4, 5])
+        self.assertEqual(list(np.flatnonzero(service._filter_mask(store, {'status': 0}))), [2])
+
+    def test_compaction_drops_tombstoned_rows(self):
+        self.update(VectorStore.open(self.path), compact_ratio=1.0)
+        before = VectorStore.open(self.path)
+        live_ids = [before.chunk_id(int(i)) for i in np.flatnonzero(before.live_mask)]
+
+        manifest = compact_vector_store(self.path)
+        store = VectorStore.open(self.path)
+        self.assertEqual((len(store), store.deleted_count, manifest['tombstones']), (3, 0, None))
+        self.assertEqual(store.chunk_ids(range(3)), live_ids)
+        self.assertEqual([store.metadata_index.chunk_metadata(i)['status'] for i in range(3)], [0, 1, 1])
+        self.assertIsNotNone(store.lexical)
+        self.assertEqual(previous_source_hashes(store)['post:4'], 'd')
+
+        # Tỷ lệ tombstone vượt ngưỡng: cập nhật tự nén luôn
+        write_vector_store(self.path, self.chunks, self.embeddings.embed_documents(self.chunks),
+                           chunk_sources=self.sources,
+                           sources={'hashes': {'post:1': 'a', 'post:2': 'b', 'comment:3': 'c'}, 'chunk_size': 500})
+        self.update(VectorStore.open(self.path), compact_ratio=0.2)
+        self.assertEqual(VectorStore.open(self.path).deleted_count, 0)
+        self.assertEqual(len(VectorStore.open(self.path)), 3)
+
+    def test_command_update_keeps_index_options(self):
+        from .management.commands.train_rag_chatbot import Command
+        hashes = {'post:1': 'a', 'post:2': 'b', 'comment:3': 'c'}
+        write_vector_store(self.path, self.chunks, self.embeddings.embed_documents(self.chunks), dtype='float16',
+                           ann='ivf', ann_options={'n_lists': 2}, quantization='int8', chunk_sources=self.sources,
+                           chunk_metadata=[{'source_type': model, 'source_id': pk} for model, pk, _ in self.sources],
+                           metadata={'embedding_model': self.embeddings.model},
+                           sources={'hashes': hashes, 'chunk_size': 500})
+        before = VectorStore.open(self.path)
+        command = Command(stdout=io.StringIO())
+        command.index_dir, command.compact, command.compact_ratio = self.path, False, 1.0
+        # Lệnh chạy không kèm --dtype / --ann / --quantization / --lexical
+        command.write_overrides = {}
+        command.batcher = EmbeddingBatcher(self.embeddings, log=lambda message: None)
+        documents = [SourceDocument(key, key.split(':')[0], int(key.split(':')[1]), value, {}, [])
+                     for key, value in hashes.items() if key != 'comment:3']
+        documents.append(SourceDocument('post:4', 'post', 4, 'd', {'source_type': 'post'}, [('Bài viết mới', 0)]))
+        command.update_global_embeddings(VectorStore.open(self.path), documents, 500, self.embeddings.model)
+
+        manifest = read_manifest(self.path)
+        self.assertEqual((manifest['count'], manifest['tombstones']['count']), (5, 1))
+        self.assertEqual(manifest['ann']['type'], 'ivf')
+        self.assertEqual(manifest['quantization']['type'], 'int8')
+        self.assertEqual(manifest['dtype'], 'float16')
+        self.assertIsNone(manifest['lexical'])
+        # Nối thêm: centroid IVF và khoảng lượng tử int8 giữ nguyên, dòng mới được gán cụm / mã hóa
+        store = VectorStore.open(self.path)
+        np.testing.assert_array_equal(store.ann.centroids, before.ann.centroids)
+        np.testing.assert_array_equal(store.quantizer.low, before.quantizer.low)
+        np.testing.assert_array_equal(store.codes[:4], before.codes)
+        self.assertEqual(sorted(np.asarray(store.ann.order)), [0, 1, 2, 3, 4])
+        self.assertEqual(store.metadata_index.chunk_metadata(4)['source_type'], 'post')
+
+        # --embeddings-file sau build tăng dần: xuất từ kho mới, bỏ dòng tombstone
+        export_path = os.path.join(self.tmpdir, 'export.json')
+        command.export_embeddings_file(export_path)
+        with open(export_path, encoding='utf-8') as f:
+            exported = json.load(f)
+        self.assertEqual(exported['chunks'], ['Định lý Pytago', 'cạnh huyền', 'Phương trình bậc hai', 'Bài viết mới'])
+        self.assertEqual(np.asarray(exported['embeddings']).shape, (4, 8))
+
+    def test_old_hash_format_requires_full_build(self):
+        # Kho ghi hash nguồn không có hash_version (chỉ hash nội dung): build tăng dần sẽ coi mọi nguồn là đã sửa
+        reason = incremental_unavailable_reason(VectorStore.open(self.path), 500, None)
+        self.assertIn('định dạng cũ', reason)
+
+
+class ContextAssemblerTest(SimpleTestCase):
+    def test_dedupes_across_scopes_and_fills_budget_in_score_order(self):
+        long_chunk = ' '.join(['dài'] * 200)
+        candidates = [
+            ContextCandidate('Định lý  Pytago', 0.6, None, 'user'),
+            ContextCandidate('Phương trình bậc hai', 0.9),
+            ContextCandidate('Định lý Pytago', 0.8),
+            ContextCandidate(long_chunk, 0.7),
+        ]
+        context = ContextAssembler(budget=50).assemble(candidates)
+        self.assertEqual(context.chunks, ['Phương trình bậc hai', 'Định lý Pytago'])
+        self.assertEqual((context.metrics['duplicates'], context.metrics['dropped']), (1, 1))
+        self.assertLessEqual(context.metrics['context_tokens'], 50)
+
+        # Chunk đầu dài hơn ngân sách: cắt bớt thay vì bỏ trống ngữ liệu
+        truncated = ContextAssembler(budget=20).assemble([long_chunk])
+        self.assertEqual(truncated.metrics['truncated'], 1)
+        self.assertLessEqual(count_tokens(truncated.chunks[0]), 18)
+
+    def test_mmr_prefers_diverse_chunks(self):
+        vectors = retrieval.normalize_rows(np.array([[1.0, 0.0, 0.0], [0.99, 0.1, 0.0], [0.0, 0.0, 1.0]]))
+        candidates = [ContextCandidate(text, score, vector)
+                      for text, score, vector in zip(['a', 'a gần giống', 'b'], [0.9, 0.89, 0.5], vectors)]
+        self.assertEqual(ContextAssembler(budget=0, mmr_lambda=1.0).assemble(candidates).chunks,
+                         ['a', 'a gần giống', 'b'])
+        self.assertEqual(ContextAssembler(budget=0, mmr_lambda=0.5).assemble(candidates).chunks,
+                         ['a', 'b', 'a gần giống'])
+
+    def test_global_candidates_score_with_cosine(self):
+        corpus = VectorStore.__new__(VectorStore)
+        corpus.vectors = retrieval.normalize_rows(np.array([[3.0, 4.0], [1.0, 0.0]], dtype=np.float32))
+        corpus.chunks = ['a', 'b']
+        # Vector câu hỏi không có độ dài đơn vị (provider local)
+        candidates = RAGChatbotService._global_candidates(corpus, [10.0, 0.0], [0, 1])
+        self.assertAlmostEqual(candidates[0].score, 0.6, places=5)
+        self.assertAlmostEqual(candidates[1].score, 1.0, places=5)
+
+    def test_build_prompt_records_prompt_tokens(self):
+        context_stats.clear()
+        service = RAGChatbotService.__new__(RAGChatbotService)
+        prompt = service._build_prompt('Pytago là gì', ['Định lý Pytago', 'Định lý Pytago'])
+        self.assertEqual(prompt.count('Định lý Pytago'), 1)
+        stats = context_stats.stats()
+        self.assertEqual((stats['requests'], stats['duplicates']), (1, 1))
+        self.assertEqual(stats['last']['prompt_tokens'], count_tokens(prompt))
+
+
+class TracingTest(SimpleTestCase):
+    def setUp(self):
+        tracing.latency_histograms.clear()
+
+    def test_spans_and_counters_build_server_timing_and_histograms(self):
+        with tracing.trace('chatbot_api') as request_trace:
+            with tracing.span('rag.embed'):
+                pass
+            with tracing.span('rag.search') as attrs:
+                attrs['hits'] = 3
+            tracing.count('answer_cache.miss')
+            # View gọi lồng nhau: trace trong chỉ là một span của trace ngoài
+            with tracing.trace('chatbot_api_inner') as inner:
+                self.assertIs(inner, request_trace)
+        self.assertIsNone(tracing.current_trace())
+
+        header = request_trace.server_timing()
+        self.assertRegex(header, r'^rag\.embed;dur=[\d.]+, rag\.search;dur=[\d.]+, chatbot_api_inner;dur=[\d.]+, '
+                                 r'total;dur=[\d.]+$')
+        spans = request_trace.to_dict()['spans']
+        self.assertEqual(spans[1]['hits'], 3)
+
+        stats = tracing.latency_histograms.stats()
+        self.assertEqual(set(stats['spans']), {'rag.embed', 'rag.search', 'chatbot_api_inner', 'chatbot_api'})
+        self.assertEqual(stats['spans']['rag.search']['count'], 1)
+        self.assertEqual(stats['counters'], {'answer_cache.miss': 1})
+
+    def test_build_prompt_counts_prompt_tokens_in_current_trace(self):
+        service = RAGChatbotService.__new__(RAGChatbotService)
+        with tracing.trace('chatbot_api') as request_trace:
+            prompt = service._build_prompt('Pytago là gì', ['Định lý Pytago'])
+        self.assertEqual(request_trace.counters['prompt_tokens'], count_tokens(prompt))
+        self.assertIn('rag.assemble', request_trace.timings())
+
+
+class UserMatrixCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        for user_id in range(3):
+            path = os.path.join(self.tmpdir, f'user_{user_id}_embeddings')
+            write_vector_store(path, ['x'] * 4, np.ones((4, 8)))
+            self.paths.append(path)
+        self.entry_bytes = VectorStore.open(self.paths[0]).nbytes
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_evicts_least_recently_used_by_bytes(self):
+        cache = UserMatrixCache(max_bytes=self.entry_bytes * 2)
+        first = cache.get(self.paths[0])
+        cache.get(self.paths[1])
+        self.assertIs(cache.get(self.paths[0]), first)
+        cache.get(self.paths[2])  # đẩy user 1 (ít dùng nhất) ra
+
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertLessEqual(stats['bytes'], cache.max_bytes)
+        self.assertIs(cache.get(self.paths[0]), first)
+
+    def test_invalidated_when_file_changes(self):
+        cache = UserMatrixCache(max_bytes=self.entry_bytes * 10)
+        first = cache.get(self.paths[0])
+        write_vector_store(self.paths[0], ['y'], np.ones((1, 8)))
+        second = cache.get(self.paths[0])
+        self.assertIsNot(second, first)
+        self.assertEqual(list(second.chunks), ['y'])
+
+
+class UserVectorStoreTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # 2 shard để nhiều user dùng chung một shard
+        self.store = UserVectorStore(self.tmpdir, shards=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_replace_and_read_user_slice(self):
+        self.store.replace_user('1', ['a', 'b'], np.eye(2, 4))
+        user_slice = self.store.get_user('1')
+        self.assertEqual(user_slice.chunks, ['a', 'b'])
+        np.testing.assert_allclose(user_slice.vectors, np.eye(2, 4))
+        self.assertIsNone(self.store.get_user('2'))
+
+    def test_replacing_one_user_keeps_others(self):
+        users = {str(i): ([f'chunk {i}'], np.full((1, 4), i + 1.0), {}) for i in range(6)}
+        self.store.replace_users(users)
+        self.assertEqual(self.store.list_users(), sorted(users))
+
+        self.store.replace_user('3', ['mới', 'mới 2'], np.ones((2, 4)))
+        self.assertEqual(self.store.get_user('3').chunks, ['mới', 'mới 2'])
+        for user_id in ('0', '1', '2', '4', '5'):
+            self.assertEqual(self.store.get_user(user_id).chunks, [f'chunk {user_id}'])
+
+        # Reader mới (process khác) thấy cùng dữ liệu
+        reopened = UserVectorStore(self.tmpdir)
+        self.assertEqual(reopened.shards, 2)
+        self.assertEqual(len(reopened.get_user('3')), 2)
+
+    def test_delete_user(self):
+        self.store.replace_users({'1': (['a'], np.ones((1, 4)), {}), '2': (['b'], np.ones((1, 4)), {})})
+        self.store.delete_user('1')
+        self.assertFalse(self.store.has_user('1'))
+        self.assertEqual(self.store.list_users(), ['2'])
+
+    def test_training_all_users_writes_each_shard_once(self):
+        from types import SimpleNamespace
+        from .management.commands.train_rag_chatbot import Command
+        users = [SimpleNamespace(id=i, username=f'user{i}') for i in range(7)]
+        command = Command(stdout=io.StringIO())
+        command._embed_user = lambda user_id, chunk_size: ([f'chunk {user_id}'], np.ones((1, 4)), {})
+        user_model = mock.Mock()
+        user_model.objects.all.return_value = users
+        with mock.patch('django.contrib.auth.get_user_model', return_value=user_model), \
+                mock.patch('Chatbot.management.commands.train_rag_chatbot.get_user_vector_store',
+                           return_value=self.store), \
+                mock.patch.object(self.store, 'replace_users', wraps=self.store.replace_users) as replace_users:
+            command.create_embeddings_for_all_users(500)
+        self.assertEqual(replace_users.call_count, 2)
+        self.assertEqual(self.store.list_users(), sorted(str(user.id) for user in users))
+        self.assertEqual(self.store.get_user('5').chunks, ['chunk 5'])
+
+
+class RejectingEmbeddings(LocalEmbeddings):
+    """Từ chối lô quá max_items text hoặc có text chứa "lỗi", đếm số request"""
+
+    def __init__(self, max_items):
+        super().__init__('test', dim=8)
+        self.max_items = max_items
+        self.calls = []
+
+    def embed_documents(self, texts):
+        self.calls.append(len(texts))
+        if len(texts) > self.max_items or any('lỗi' in t for t in texts):
+            raise ValueError('batch rejected')
+        return super().embed_documents(texts)
+
+
+class RateLimitedError(Exception):
+    status_code = 429
+
+
+class FlakyEmbeddings(LocalEmbeddings):
+    """Lần gọi đầu của mỗi lô trả 429, lần sau mới trả vector"""
+
+    def __init__(self):
+        super().__init__('test', dim=8)
+        self.seen = set()
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            first_call = texts[0] not in self.seen
+            self.seen.add(texts[0])
+        if first_call:
+            raise RateLimitedError('rate limited')
+        return super().embed_documents(texts)
+
+
+class EmbeddingBatcherTest(SimpleTestCase):
+    def test_plan_respects_item_and_token_limits(self):
+        self.assertEqual(plan_batches([1, 1, 1, 1, 1], max_items=2, max_tokens=100), [[0, 1], [2, 3], [4]])
+        self.assertEqual(plan_batches([4, 4, 10, 1], max_items=10, max_tokens=8), [[0, 1], [2], [3]])
+
+    def test_rejected_batches_are_split_and_order_kept(self):
+        texts = [f'chunk số {i}' for i in range(8)] + ['chunk lỗi']
+        embeddings = RejectingEmbeddings(max_items=3)
+        batcher = EmbeddingBatcher(embeddings, max_items=5, max_tokens=1000, log=lambda message: None)
+        vectors = batcher.embed(texts)
+
+        expected = LocalEmbeddings('test', dim=8).embed_documents(texts[:-1])
+        self.assertEqual(vectors[:-1], expected)
+        self.assertIsNone(vectors[-1])
+        report = batcher.report()
+        self.assertEqual((report['chunks'], report['failed']), (8, 1))
+        self.assertEqual(report['requests'], len(embeddings.calls))
+        self.assertGreater(report['splits'], 0)
+        self.assertLess(report['requests'], len(texts))
+
+    def test_workers_retry_rate_limits_and_keep_order(self):
+        texts = [f'chunk số {i}' for i in range(40)]
+        delays = []
+        batcher = EmbeddingBatcher(FlakyEmbeddings(), max_items=3, max_tokens=1000, log=lambda message: None,
+                                   workers=4, rate_limiter=RateLimiter(0, 0), sleep=delays.append)
+        vectors = batcher.embed(texts)
+
+        self.assertEqual(vectors, LocalEmbeddings('test', dim=8).embed_documents(texts))
+        report = batcher.report()
+        self.assertEqual((report['chunks'], report['failed'], report['splits']), (40, 0, 0))
+        self.assertEqual(report['retries'], 14)
+        self.assertEqual(len(delays), 14)
+        self.assertTrue(all(0 <= d <= batcher.backoff_base for d in delays))
+
+    def test_token_bucket_waits_for_refill(self):
+        now = [0.0]
+        waits = []
+        bucket = TokenBucket(60, clock=lambda: now[0], sleep=waits.append)
+        self.assertEqual(bucket.acquire(50), 0.0)
+        # Còn 10 token, nạp 1 token / giây: thiếu 30 -> chờ 30 giây
+        self.assertAlmostEqual(bucket.acquire(40), 30.0)
+        now[0] = 100.0
+        self.assertEqual(bucket.acquire(60), 0.0)
+        self.assertEqual(waits, [30.0])
+
+
+class BenchmarkRagCommandTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def run_benchmark(self, output):
+        call_command('benchmark_rag', sizes='300,600', dim=16, queries=10, users=6, user_chunks=5, seed=3,
+                     output=output, stdout=io.StringIO())
+        with open(output, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def test_report_is_seeded_and_offline(self):
+        first = self.run_benchmark(os.path.join(self.tmpdir, 'a.json'))
+        second = self.run_benchmark(os.path.join(self.tmpdir, 'b.json'))
+
+        self.assertEqual([r['size'] for r in first['global']], [300, 600])
+        for result in first['global']:
+            self.assertEqual(result['latency_ms']['count'], 9)
+            self.assertLessEqual(result['latency_ms']['p50'], result['latency_ms']['p99'])
+        self.assertEqual(first['user']['users'], 6)
+        self.assertEqual(first['user']['cold_latency_ms']['count'], 6)
+        # Cùng seed -> cùng corpus, cùng kích thước
+        self.assertEqual([r['nbytes'] for r in first['global']], [r['nbytes'] for r in second['global']])
+
+
+class ModelProviderTest(SimpleTestCase):
+    MESSAGES = [{'role': 'system', 'content': 'hệ thống'}, {'role': 'user', 'content': 'Định lý Pytago là gì?'}]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_local_provider_is_deterministic(self):
+        embeddings = LocalProvider(dim=32).embeddings('text-embedding-3-small')
+        a = np.array(embeddings.embed_query('định lý pytago tam giác vuông'))
+        self.assertEqual(a.tolist(), embeddings.embed_query('định lý pytago tam giác vuông'))
+        near = retrieval.normalize_vector(embeddings.embed_query('định lý pytago'))
+        far = retrieval.normalize_vector(embeddings.embed_query('phản ứng oxi hóa khử'))
+        self.assertGreater(float(retrieval.normalize_vector(a) @ near), float(retrieval.normalize_vector(a) @ far))
+
+        provider = LocalProvider(dim=32)
+        answer = provider.chat('gpt-test', self.MESSAGES, 100, 0.7)
+        self.assertIn('Định lý Pytago là gì?', answer)
+        self.assertEqual(''.join(provider.stream_chat('gpt-test', self.MESSAGES, 100, 0.7)), answer)
+        self.assertEqual(asyncio.run(provider.achat('gpt-test', self.MESSAGES, 100, 0.7)), answer)
+
+    def test_record_then_replay_without_inner_provider(self):
+        recorder = RecordReplayProvider('record', self.tmpdir, inner=LocalProvider(dim=8))
+        answer = recorder.chat('gpt-test', self.MESSAGES, 100, 0.7)
+        streamed = list(recorder.stream_chat('gpt-test', self.MESSAGES, 100, 0.7))
+        vector = recorder.embeddings('text-embedding-3-small').embed_query('pytago')
+
+        replayer = RecordReplayProvider('replay', self.tmpdir)
+        self.assertEqual(replayer.chat('gpt-test', self.MESSAGES, 100, 0.7), answer)
+        self.assertEqual(list(replayer.stream_chat('gpt-test', self.MESSAGES, 100, 0.7)), streamed)
+        self.assertEqual(replayer.embeddings('text-embedding-3-small').embed_query('pytago'), vector)
+        with self.assertRaises(ReplayMissError):
+            replayer.chat('gpt-test', self.MESSAGES, 100, 0.2)
+
+    def test_service_answers_offline_with_local_provider(self):
+        provider = LocalProvider(dim=16)
+        chunks = ['định lý pytago cạnh huyền', 'công thức nước H2O', 'định luật newton F = ma']
+        embeddings = provider.embeddings('text-embedding-3-small')
+        path = os.path.join(self.tmpdir, 'index')
+        write_vector_store(path, chunks, embeddings.embed_documents(chunks))
+        with mock.patch('Chatbot.services.rag_chatbot_service.get_provider', return_value=provider), \
+                mock.patch('Chatbot.services.user_embedding_service.get_provider', return_value=provider), \
+                mock.patch.dict(os.environ, {'OPENAI_API_KEY': ''}):
+            service = RAGChatbotService(embeddings_file=path)
+            self.assertEqual(service.get_global_context('định lý pytago', 1), [chunks[0]])
+            answer = service.answer_question('offline: định lý pytago là gì', 1)
+        self.assertIn('local', answer)
+
+
+class AnswerCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.cache = AnswerCache(max_entries=2, ttl=60, enabled=True, clock=lambda: self.now)
+
+    def _key(self, query='Định lý Pytago là gì', chunk_ids=(1, 2), version='v1', temperature=0.7):
+        return AnswerCache.make_key(query, chunk_ids, version, 'gpt-4.1-mini', temperature, 2048, 1)
+
+    def test_key_covers_query_chunks_and_generation_settings(self):
+        self.assertEqual(self._key(), self._key(query='  định lý PYTAGO là gì'))
+        self.assertNotEqual(self._key(), self._key(chunk_ids=(2, 1)))
+        self.assertNotEqual(self._key(), self._key(version='v2'))
+        self.assertNotEqual(self._key(), self._key(temperature=0.2))
+
+    def test_ttl_and_size_eviction(self):
+        self.cache.put('a', 'answer a', 'v1')
+        self.cache.put('b', 'answer b', 'v1')
+        self.assertEqual(self.cache.get('a'), 'answer a')
+        self.cache.put('c', 'answer c', 'v1')  # đẩy 'b' (ít dùng nhất) ra
+        self.assertIsNone(self.cache.get('b'))
+
+        self.now = 61
+        self.assertIsNone(self.cache.get('a'))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['evictions'], stats['expired']), (1, 1, 1))
+
+    def test_index_version_change_drops_old_answers(self):
+        self.cache.sync_index_version('v1')
+        self.cache.put('a', 'answer a', 'v1')
+        self.cache.sync_index_version('v2')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+
+
+class SemanticCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.cache = SemanticCache(max_entries=2, threshold=0.9, ttl=60, enabled=True,
+                                   endpoints='answer_question', clock=lambda: self.now)
+
+    def test_paraphrase_above_threshold_reuses_answer_in_same_namespace(self):
+        self.cache.put([1.0, 0.0, 0.0], 'Pytago là gì', 'answer', 'ns1')
+        self.assertEqual(self.cache.get([0.98, 0.05, 0.0], 'ns1'), 'answer')
+        self.assertIsNone(self.cache.get([0.5, 0.5, 0.0], 'ns1'))
+        self.assertIsNone(self.cache.get([1.0, 0.0, 0.0], 'ns2'))
+        self.assertTrue(self.cache.allows('answer_question'))
+        self.assertFalse(self.cache.allows('answer_question_with_user_context'))
+
+    def test_ttl_and_bounded_size(self):
+        self.cache.put([1.0, 0.0, 0.0], 'a', 'answer a', 'ns')
+        self.now = 1
+        self.cache.put([0.0, 1.0, 0.0], 'b', 'answer b', 'ns')
+        self.now = 2
+        self.assertEqual(self.cache.get([1.0, 0.0, 0.0], 'ns'), 'answer a')
+        self.cache.put([0.0, 0.0, 1.0], 'c', 'answer c', 'ns')  # thay 'b' (lâu không dùng nhất)
+        self.assertIsNone(self.cache.get([0.0, 1.0, 0.0], 'ns'))
+        self.assertEqual(self.cache.stats()['entries'], 2)
+
+        self.now = 100
+        self.assertIsNone(self.cache.get([1.0, 0.0, 0.0], 'ns'))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['evictions'], stats['expired']), (1, 1, 1))
+
+
+class SpeculativeFallbackTest(SimpleTestCase):
+    GROUNDED = 'Theo ngữ liệu, định lý Pytago phát biểu rằng bình phương cạnh huyền bằng tổng bình phương hai cạnh góc vuông.'
+    GENERAL = 'Trả lời tổng quát'
+
+    def setUp(self):
+        # Không gọi __init__ (cần OPENAI_API_KEY và model embedding)
+        self.service = RAGChatbotService.__new__(RAGChatbotService)
+        self.service.speculative_fallback = True
+        self.general_tokens = []
+        fallback_stats.clear()
+
+    def _fake_stream(self, prompt):
+        for token in ['Trả lời ', 'tổng quát']:
+            self.general_tokens.append(token)
+            yield token
+
+    def _run(self, grounded_answer):
+        with mock.patch.object(self.service, '_generate_with_openai', return_value=grounded_answer), \
+                mock.patch.object(self.service, '_stream_with_openai', side_effect=self._fake_stream):
+            return self.service._answer_from_context('Pytago là gì', ['chunk'])
+
+    def test_valid_grounded_answer_wins(self):
+        self.assertEqual(self._run(self.GROUNDED), self.GROUNDED)
+        stats = fallback_stats.stats()
+        self.assertEqual((stats['answers'], stats['fallbacks'], stats['cancelled']), (1, 0, 1))
+
+    def test_invalid_grounded_answer_uses_parallel_fallback(self):
+        self.assertEqual(self._run('Tôi không tìm thấy.'), self.GENERAL)
+        stats = fallback_stats.stats()
+        self.assertEqual((stats['fallbacks'], stats['fallback_rate'], stats['speculative']), (1, 1.0, 1))
+
+    def test_cancelled_generation_stops_consuming_stream(self):
+        cancel = threading.Event()
+        cancel.set()
+        with mock.patch.object(self.service, '_stream_with_openai', side_effect=self._fake_stream):
+            self.assertEqual(self.service._generate_cancellable('prompt', cancel), (None, 0.0))
+        self.assertEqual(self.general_tokens, [])
+
+
+class AsyncSpeculativeFallbackTest(SimpleTestCase):
+    def test_valid_grounded_answer_cancels_pending_fallback(self):
+        service = RAGChatbotService.__new__(RAGChatbotService)
+        service.speculative_fallback = True
+        fallback_stats.clear()
+        grounded = SpeculativeFallbackTest.GROUNDED
+        fallback_cancelled = []
+
+        async def fake_generate(prompt):
+            if 'chunk' in prompt:
+                await asyncio.sleep(0.01)  # bản dự phòng đã bắt đầu chạy
+                return grounded
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                fallback_cancelled.append(True)
+                raise
+            return 'Trả lời tổng quát'
+
+        async def run():
+            answer = await service._aanswer_from_context('Pytago là gì', ['chunk'])
+            await asyncio.sleep(0)  # cho task dự phòng xử lý việc bị hủy
+            return answer
+
+        with mock.patch.object(service, '_agenerate_with_openai', side_effect=fake_generate):
+            self.assertEqual(asyncio.run(run()), grounded)
+        self.assertEqual(fallback_cancelled, [True])
+        self.assertEqual(fallback_stats.stats()['cancelled'], 1)
+
+
+class FakeStreamingRAGService:
+    def stream_answer(self, query, user_id=None, top_k=None):
+        yield 'Định lý '
+        yield 'Pytago\n'
+
+
+class FakeAsyncRAGService:
+    async def aanswer_question(self, query):
+        return 'Định lý Pytago'
+
+    async def aanswer_question_with_user_context(self, query, user_id):
+        return f'Định lý Pytago cho user {user_id}'
+
+
+class ChatbotStreamingTest(TestCase):
+    def _post(self, payload):
+        return self.client.post('/chatbot/api/', data=json.dumps(payload), content_type='application/json')
+
+    @mock.patch('Chatbot.views.get_rag_service', return_value=FakeStreamingRAGService())
+    def test_streams_tokens_and_persists_bot_message(self, _):
+        response = self._post({'message': 'Pytago là gì', 'stream': True})
+        self.assertEqual(response['Content-Type'], 'text/event-stream; charset=utf-8')
+        body = b''.join(response.streaming_content).decode('utf-8')
+
+        events = [block.split('\n') for block in body.strip().split('\n\n')]
+        names = [lines[0][len('event: '):] for lines in events]
+        self.assertEqual(names[0], 'meta')
+        self.assertEqual(names[-1], 'done')
+        self.assertEqual(names.count('token'), 3)
+
+        done = json.loads(events[-1][1][len('data: '):])
+        bot_msg = ChatMessage.objects.get(id=done['bot_message_id'])
+        self.assertEqual(bot_msg.message_type, 'bot')
+        self.assertEqual(bot_msg.content, '[🔍 RAG Chatbot]\n\nĐịnh lý Pytago\n')
+        self.assertEqual(done['text'], bot_msg.content)
+
+    @mock.patch('Chatbot.views.get_rag_service')
+    def test_json_response_without_stream_flag(self, get_service):
+        get_service.return_value.answer_question.return_value = 'Câu trả lời'
+        response = self._post({'message': 'Pytago là gì'})
+        self.assertEqual(response.json()['response']['text'], '[🔍 RAG Chatbot]\n\nCâu trả lời')
+        self.assertIn('db.write;dur=', response['Server-Timing'])
+        self.assertIn('total;dur=', response['Server-Timing'])
+
+    @mock.patch('Chatbot.views.get_rag_service', return_value=FakeAsyncRAGService())
+    def test_async_endpoint_answers_and_persists(self, _):
+        user = get_user_model().objects.create_user(username='hoc_sinh', password='x')
+        response = self.client.post('/chatbot/api/async/', data=json.dumps({'message': 'Pytago là gì', 'user_id': user.id}),
+                                    content_type='application/json')
+        data = response.json()
+        self.assertEqual(data['response']['text'], f'[🔍 RAG Chatbot]\n\nĐịnh lý Pytago cho user {user.id}')
+        self.assertTrue(ChatMessage.objects.filter(message_type='bot', content=data['response']['text']).exists())
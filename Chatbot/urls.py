@@ -6,9 +6,12 @@ app_name = 'chatbot'
 urlpatterns = [
     path('', views.chatbot_view, name='chatbot'),
     path('api/', views.chatbot_api, name='chatbot_api'),
+    path('api/async/', views.chatbot_api_async, name='chatbot_api_async'),
     path('upload/', views.upload_file, name='upload_file'),
     path('user-profile/', views.user_profile_view, name='user_profile'),
     path('list-users/', views.list_users_view, name='list_users'),
+    path('corpus-stats/', views.corpus_stats_view, name='corpus_stats'),
+    path('trace-stats/', views.trace_stats_view, name='trace_stats'),
     path('page/', views.chatbot_page, name='chatbot_page'),
     path('download-file/<int:file_id>/', views.download_chat_file, name='download_chat_file'),
     path('preview-html/<int:file_id>/', views.preview_html_file, name='preview_html_file'),
@@ -1,10 +1,12 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
+from django.core.serializers.json import DjangoJSONEncoder
+from asgiref.sync import sync_to_async
 import json
 import os
 import mimetypes
@@ -12,7 +14,16 @@ import re
 from datetime import datetime
 import io
 from .models import ChatSession, ChatMessage, FileAttachment
-from .services.rag_chatbot_service import RAGChatbotService
+from .services.rag_chatbot_service import get_rag_service
+from .services.corpus_registry import corpus_registry
+from .services.query_embedding_cache import query_embedding_cache
+from .services.user_embedding_service import user_matrix_cache
+from .services.answer_cache import answer_cache
+from .services.semantic_cache import semantic_cache
+from .services.fallback_stats import fallback_stats
+from .services.context_assembler import context_stats
+from .services.tracing import latency_histograms
+from .services import tracing
 try:
     from .services.autogen_education_system import EnhancedEducationSystem
     AUTOGEN_AVAILABLE = True
@@ -26,8 +37,8 @@ def chatbot_view(request):
         message = request.POST.get('message', '')
         user_id = request.user.id if request.user.is_authenticated else None
         
-        # Khởi tạo RAG service từ Chatbot app
-        rag_service = RAGChatbotService()
+        # RAG service dùng chung cho cả process (corpus chỉ load một lần)
+        rag_service = get_rag_service()
         
         if user_id:
             # Sử dụng cả dữ liệu cá nhân và chung
@@ -113,16 +124,73 @@ def upload_file(request):
             'error': str(e)
         }, status=500)
 
+FILE_CREATION_KEYWORDS = ['tạo bài giảng', 'tạo bài tập', 'tạo bài kiểm tra', 'tạo đề thi', 'tạo lesson', 'tạo exercise', 'tạo test']
+
+def is_file_creation_request(user_message):
+    return any(keyword in user_message.lower() for keyword in FILE_CREATION_KEYWORDS)
+
+def start_chat_turn(session_id, user_id, user_message, file_ids):
+    """Lấy / tạo session, lưu tin nhắn của user và gắn các file đã upload. Returns: (session, user_msg)"""
+    # Get or create session
+    if session_id:
+        session, created = ChatSession.objects.get_or_create(
+            session_id=session_id,
+            defaults={'user_id': user_id, 'title': 'Chat with Files'}
+        )
+    else:
+        session = ChatSession.objects.create(
+            user_id=user_id,
+            title='Chat with Files'
+        )
+    
+    # Create user message
+    user_msg = ChatMessage.objects.create(
+        session=session,
+        message_type='user',
+        content=user_message
+    )
+    
+    # Attach files to message if any
+    if file_ids:
+        attachments = FileAttachment.objects.filter(id__in=file_ids)
+        for attachment in attachments:
+            # Create a copy of the attachment for this message
+            FileAttachment.objects.create(
+                message=user_msg,
+                file=attachment.file,
+                original_name=attachment.original_name,
+                file_type=attachment.file_type,
+                file_size=attachment.file_size,
+                mime_type=attachment.mime_type
+            )
+            # Delete the temporary message that was created during upload
+            if attachment.message.content.startswith('[File uploaded:'):
+                attachment.message.delete()
+    return session, user_msg
+
+def with_server_timing(response, request_trace):
+    """Gắn thời gian từng bước của request vào header Server-Timing (response streaming: phần trước token đầu)"""
+    if tracing.enabled():
+        response['Server-Timing'] = request_trace.server_timing()
+    return response
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def chatbot_api(request):
-    """API endpoint cho RAG chatbot"""
+    """API endpoint cho RAG chatbot (mỗi request một trace: log JSON + header Server-Timing)"""
+    with tracing.trace('chatbot_api') as request_trace:
+        response = _chatbot_api(request)
+    return with_server_timing(response, request_trace)
+
+def _chatbot_api(request):
     try:
         data = json.loads(request.body)
         user_message = data.get('message', '')
         session_id = data.get('session_id', '')
         user_id = data.get('user_id', None)
         file_ids = data.get('file_ids', [])  # List of file IDs attached to this message
+        # Client hỗ trợ đọc stream gửi "stream": true để nhận câu trả lời dạng Server-Sent Events
+        stream = bool(data.get('stream')) or 'text/event-stream' in request.headers.get('Accept', '')
         
         if not user_message.strip() and not file_ids:
             return JsonResponse({
@@ -130,48 +198,18 @@ def chatbot_api(request):
                 'error': 'Message hoặc file không được để trống'
             })
         
-        # Get or create session
-        if session_id:
-            session, created = ChatSession.objects.get_or_create(
-                session_id=session_id,
-                defaults={'user_id': user_id, 'title': 'Chat with Files'}
-            )
-        else:
-            session = ChatSession.objects.create(
-                user_id=user_id,
-                title='Chat with Files'
-            )
-            session_id = session.session_id
-        
-        # Create user message
-        user_msg = ChatMessage.objects.create(
-            session=session,
-            message_type='user',
-            content=user_message
-        )
-        
-        # Attach files to message if any
-        if file_ids:
-            attachments = FileAttachment.objects.filter(id__in=file_ids)
-            for attachment in attachments:
-                # Create a copy of the attachment for this message
-                FileAttachment.objects.create(
-                    message=user_msg,
-                    file=attachment.file,
-                    original_name=attachment.original_name,
-                    file_type=attachment.file_type,
-                    file_size=attachment.file_size,
-                    mime_type=attachment.mime_type
-                )
-                # Delete the temporary message that was created during upload
-                if attachment.message.content.startswith('[File uploaded:'):
-                    attachment.message.delete()
+        with tracing.span("db.write"):
+            session, user_msg = start_chat_turn(session_id, user_id, user_message, file_ids)
+        session_id = session.session_id
         
         # Phân biệt giữa sinh file và chat thường
         try:
             # Kiểm tra xem có phải yêu cầu tạo file không
-            file_creation_keywords = ['tạo bài giảng', 'tạo bài tập', 'tạo bài kiểm tra', 'tạo đề thi', 'tạo lesson', 'tạo exercise', 'tạo test']
-            is_file_creation = any(keyword in user_message.lower() for keyword in file_creation_keywords)
+            is_file_creation = is_file_creation_request(user_message)
+
+            if stream and not is_file_creation:
+                # Chat thường qua RAG: trả từng token ngay khi có, JSON bên dưới vẫn là fallback
+                return stream_rag_response(session, user_msg, user_message, user_id)
             
             if is_file_creation and AUTOGEN_AVAILABLE:
                 # Sử dụng hệ thống hybrid AutoGen + RAG
@@ -200,7 +238,7 @@ def chatbot_api(request):
                 else:
                     # Fallback về RAG nếu hybrid thất bại
                     print("⚠️ Hybrid system thất bại, fallback về RAG")
-                    rag_service = RAGChatbotService()
+                    rag_service = get_rag_service()
                     if user_id:
                         bot_response = rag_service.answer_question_with_user_context(user_message, str(user_id))
                     else:
@@ -209,7 +247,7 @@ def chatbot_api(request):
             else:
                 # Sử dụng RAG cho chat thường
                 print(f"🔍 Sử dụng RAG cho: {user_message}")
-                rag_service = RAGChatbotService()
+                rag_service = get_rag_service()
                 
                 if user_id:
                     # Sử dụng cả dữ liệu cá nhân và chung
@@ -221,11 +259,12 @@ def chatbot_api(request):
                 bot_response = f"[🔍 RAG Chatbot]\n\n{bot_response}"
             
             # Create bot message
-            bot_msg = ChatMessage.objects.create(
-                session=session,
-                message_type='bot',
-                content=bot_response
-            )
+            with tracing.span("db.write"):
+                bot_msg = ChatMessage.objects.create(
+                    session=session,
+                    message_type='bot',
+                    content=bot_response
+                )
             
             # Check if response contains file creation request
             generated_files = []
@@ -287,10 +326,60 @@ def chatbot_api(request):
             'error': str(e)
         }, status=500)
 
+def _sse_event(event, data):
+    """Một sự kiện Server-Sent Events, data dạng JSON (giữ nguyên xuống dòng trong text)"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, cls=DjangoJSONEncoder)}\n\n"
+
+def stream_rag_response(session, user_msg, user_message, user_id):
+    """
+    StreamingHttpResponse (text/event-stream) cho câu trả lời RAG:
+    meta -> token... -> done. Tin nhắn bot được lưu một lần khi stream kết thúc.
+    """
+    rag_service = get_rag_service()
+    prefix = "[🔍 RAG Chatbot]\n\n"
+
+    def events():
+        # Phần sinh câu trả lời chạy sau khi header đã gửi: trace riêng, log khi stream kết thúc
+        stream_trace = tracing.Trace('chatbot_stream')
+        parts = [prefix]
+        bot_msg = None
+        yield _sse_event('meta', {'session_id': session.session_id, 'message_id': user_msg.id})
+        try:
+            with tracing.activate(stream_trace):
+                yield _sse_event('token', {'text': prefix})
+                print(f"🔍 Sử dụng RAG (streaming) cho: {user_message}")
+                for delta in rag_service.stream_answer(user_message, str(user_id) if user_id else None):
+                    parts.append(delta)
+                    yield _sse_event('token', {'text': delta})
+        except Exception as e:
+            print(f"Lỗi trong RAG streaming: {e}")
+            yield _sse_event('error', {'error': str(e)})
+        finally:
+            # Lưu cả khi client ngắt kết nối giữa chừng để lịch sử không mất phần đã sinh
+            with tracing.activate(stream_trace), tracing.span("db.write"):
+                bot_msg = ChatMessage.objects.create(
+                    session=session,
+                    message_type='bot',
+                    content=''.join(parts)
+                )
+            tracing.finish(stream_trace)
+        yield _sse_event('done', {
+            'text': ''.join(parts),
+            'type': 'rag_response',
+            'files': [],
+            'bot_message_id': bot_msg.id
+        })
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    # Tắt buffering của nginx để token tới trình duyệt ngay
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @login_required
 def user_profile_view(request):
     """View để xem profile của user"""
-    rag_service = RAGChatbotService()
+    rag_service = get_rag_service()
     profile = rag_service.get_user_profile(str(request.user.id))
     
     return JsonResponse(profile or {'error': 'No profile found'})
@@ -301,13 +390,161 @@ def list_users_view(request):
     if not request.user.is_staff:
         return JsonResponse({'error': 'Permission denied'})
     
-    rag_service = RAGChatbotService()
+    rag_service = get_rag_service()
     users = rag_service.list_users_with_embeddings()
     
     return JsonResponse({'users': users})
 
+@csrf_exempt
+@require_http_methods(["POST"])
+async def chatbot_api_async(request):
+    """
+    Bản async của chatbot_api cho chat RAG, dùng khi chạy dưới ASGI (The_Chalk/asgi.py): trong lúc chờ
+    OpenAI worker không bị chiếm thread, nên một process giữ được hàng trăm cuộc chat cùng lúc.
+    Cùng định dạng request / response (JSON hoặc SSE). Yêu cầu tạo file chuyển sang chatbot_api.
+    """
+    with tracing.trace('chatbot_api_async') as request_trace:
+        response = await _chatbot_api_async(request)
+    return with_server_timing(response, request_trace)
+
+async def _chatbot_api_async(request):
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({
+            'success': False,
+            'error': 'Invalid JSON data'
+        }, status=400)
+
+    user_message = data.get('message', '')
+    if is_file_creation_request(user_message):
+        # AutoGen + sinh file vẫn đồng bộ
+        return await sync_to_async(chatbot_api)(request)
+
+    session_id = data.get('session_id', '')
+    user_id = data.get('user_id', None)
+    file_ids = data.get('file_ids', [])
+    stream = bool(data.get('stream')) or 'text/event-stream' in request.headers.get('Accept', '')
+    if not user_message.strip() and not file_ids:
+        return JsonResponse({
+            'success': False,
+            'error': 'Message hoặc file không được để trống'
+        })
+
+    try:
+        with tracing.span("db.write"):
+            session, user_msg = await sync_to_async(start_chat_turn)(session_id, user_id, user_message, file_ids)
+        rag_service = await sync_to_async(get_rag_service)()
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+    if stream:
+        return stream_rag_response_async(rag_service, session, user_msg, user_message, user_id)
+
+    try:
+        print(f"🔍 Sử dụng RAG (async) cho: {user_message}")
+        if user_id:
+            bot_response = await rag_service.aanswer_question_with_user_context(user_message, str(user_id))
+        else:
+            bot_response = await rag_service.aanswer_question(user_message)
+        bot_response = f"[🔍 RAG Chatbot]\n\n{bot_response}"
+        response_type = 'rag_response'
+    except Exception as e:
+        print(f"Lỗi trong RAG chatbot: {e}")
+        bot_response = f"Xin lỗi, tôi hiện không thể xử lý câu hỏi '{user_message}'. Hệ thống chatbot đang được cập nhật. Vui lòng thử lại sau."
+        response_type = 'simple_response'
+
+    with tracing.span("db.write"):
+        await ChatMessage.objects.acreate(
+            session=session,
+            message_type='bot',
+            content=bot_response
+        )
+    return JsonResponse({
+        'success': True,
+        'response': {
+            'text': bot_response,
+            'type': response_type,
+            'files': []
+        },
+        'session_id': session.session_id,
+        'message_id': user_msg.id
+    })
+
+def stream_rag_response_async(rag_service, session, user_msg, user_message, user_id):
+    """Như stream_rag_response nhưng với async generator (ASGI gửi từng token không cần thread riêng)"""
+    prefix = "[🔍 RAG Chatbot]\n\n"
+
+    async def events():
+        stream_trace = tracing.Trace('chatbot_stream')
+        parts = [prefix]
+        bot_msg = None
+        yield _sse_event('meta', {'session_id': session.session_id, 'message_id': user_msg.id})
+        try:
+            with tracing.activate(stream_trace):
+                yield _sse_event('token', {'text': prefix})
+                print(f"🔍 Sử dụng RAG (async streaming) cho: {user_message}")
+                async for delta in rag_service.astream_answer(user_message, str(user_id) if user_id else None):
+                    parts.append(delta)
+                    yield _sse_event('token', {'text': delta})
+        except Exception as e:
+            print(f"Lỗi trong RAG streaming: {e}")
+            yield _sse_event('error', {'error': str(e)})
+        finally:
+            # Lưu cả khi client ngắt kết nối giữa chừng để lịch sử không mất phần đã sinh
+            with tracing.activate(stream_trace), tracing.span("db.write"):
+                bot_msg = await ChatMessage.objects.acreate(
+                    session=session,
+                    message_type='bot',
+                    content=''.join(parts)
+                )
+            tracing.finish(stream_trace)
+        yield _sse_event('done', {
+            'text': ''.join(parts),
+            'type': 'rag_response',
+            'files': [],
+            'bot_message_id': bot_msg.id
+        })
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@login_required
+def corpus_stats_view(request):
+    """Thống kê corpus RAG và cache embedding câu hỏi trong worker hiện tại (chỉ admin)"""
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Permission denied'})
+
+    return JsonResponse({
+        'pid': os.getpid(),
+        'corpora': corpus_registry.stats(),
+        'query_embedding_cache': query_embedding_cache.stats(),
+        'user_matrix_cache': user_matrix_cache.stats(),
+        'answer_cache': answer_cache.stats(),
+        'semantic_cache': semantic_cache.stats(),
+        'fallback': fallback_stats.stats(),
+        'prompt_context': context_stats.stats(),
+    })
+
+@login_required
+def trace_stats_view(request):
+    """Histogram độ trễ từng bước (span) và bộ đếm token / cache của worker hiện tại (chỉ admin)"""
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Permission denied'})
+
+    return JsonResponse(dict(latency_histograms.stats(), pid=os.getpid(), tracing=tracing.enabled()))
+
 def generate_content_file(user_message, bot_response, session):
     """Generate a downloadable HTML file based on chatbot response"""
+    with tracing.span("file.generate"):
+        return _generate_content_file(user_message, bot_response, session)
+
+def _generate_content_file(user_message, bot_response, session):
     try:
         # Determine file type based on user request
         file_type = 'document'
@@ -712,22 +949,23 @@ def generate_content_file(user_message, bot_response, session):
         file_obj = ContentFile(html_content.encode('utf-8'))
         file_obj.name = filename
         
-        # Create a bot message for the file
-        file_message = ChatMessage.objects.create(
-            session=session,
-            message_type='bot',
-            content=f'Đã tạo file HTML: {filename}'
-        )
-        
-        # Create file attachment
-        attachment = FileAttachment.objects.create(
-            message=file_message,
-            file=file_obj,
-            original_name=filename,
-            file_type=file_type,
-            file_size=len(html_content.encode('utf-8')),
-            mime_type=mime_type
-        )
+        with tracing.span("db.write"):
+            # Create a bot message for the file
+            file_message = ChatMessage.objects.create(
+                session=session,
+                message_type='bot',
+                content=f'Đã tạo file HTML: {filename}'
+            )
+            
+            # Create file attachment (ghi file lên storage)
+            attachment = FileAttachment.objects.create(
+                message=file_message,
+                file=file_obj,
+                original_name=filename,
+                file_type=file_type,
+                file_size=len(html_content.encode('utf-8')),
+                mime_type=mime_type
+            )
         
         return attachment
         
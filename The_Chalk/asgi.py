@@ -5,6 +5,9 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+
+Chạy bằng một ASGI server (vd. `uvicorn The_Chalk.asgi:application --workers 2`) để các view async
+(`/chatbot/api/async/`) chờ OpenAI mà không chiếm thread: mỗi worker giữ được nhiều cuộc chat cùng lúc.
 """
 
 import os